@@ -0,0 +1,128 @@
+# async_db.py
+# Awaitable facade over database.py. Every call runs on a small dedicated
+# thread pool so SQLite I/O and fsyncs never block the bot's event loop.
+import os
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+import database
+import metrics
+
+DB_THREADS = int(os.getenv("DB_THREADS", "4"))
+
+_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+# long admin jobs (chunked archival and bulk grants that pause between
+# chunks, full-table reconciles) run here, one at a time, so they never hold
+# one of the DB_THREADS handlers are waiting for
+_maintenance = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-maintenance")
+
+_QUEUE_WAIT = metrics.histogram("shi_db_executor_wait_seconds", "Time DB calls wait for a free DB thread")
+metrics.gauge("shi_db_executor_queue_depth", "DB calls queued for a DB thread", lambda: _executor._work_queue.qsize())
+
+def _queued(fn: Callable, submitted: float) -> Callable:
+    def call():
+        _QUEUE_WAIT.observe(time.perf_counter() - submitted)
+        return fn()
+    return call
+
+async def run(fn: Callable, *args, **kwargs) -> Any:
+    """Run a blocking database callable on the DB executor."""
+    loop = asyncio.get_running_loop()
+    call = functools.partial(fn, *args, **kwargs)
+    if metrics.ENABLED:
+        call = _queued(call, time.perf_counter())
+    return await loop.run_in_executor(_executor, call)
+
+async def transact(user_id: int, fn: Callable, *args, **kwargs) -> Any:
+    """Run fn inside a single database.transaction() on user_id's shard, on
+    one DB thread. Everything fn writes must live in that file."""
+    def unit():
+        with database._user_db(user_id), database.transaction():
+            return fn(*args, **kwargs)
+    return await run(unit)
+
+def _wrap(fn: Callable) -> Callable:
+    timed = metrics.timed(metrics.DB_CALL, fn.__name__)(fn)
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await run(timed, *args, **kwargs)
+    return wrapper
+
+def _wrap_maintenance(fn: Callable) -> Callable:
+    timed = metrics.timed(metrics.DB_CALL, fn.__name__)(fn)
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_maintenance, functools.partial(timed, *args, **kwargs))
+    return wrapper
+
+def shutdown(wait: bool=True):
+    """Stop the executor and close its pooled connections."""
+    _maintenance.shutdown(wait=wait)
+    _executor.shutdown(wait=wait)
+    database.stop_ledger()
+    database.close_connections()
+
+# ----------------- settings -----------------
+get_setting = _wrap(database.get_setting)
+get_settings = _wrap(database.get_settings)
+set_setting = _wrap(database.set_setting)
+
+# ----------------- users -----------------
+register_user = _wrap(database.register_user)
+get_user_safe = _wrap(database.get_user_safe)
+get_user = get_user_safe
+update_shi = _wrap(database.update_shi)
+set_shi = _wrap(database.set_shi)
+update_stars = _wrap(database.update_stars)
+add_coins = _wrap(database.add_coins)
+set_coins = _wrap(database.set_coins)
+get_leaderboard = _wrap(database.get_leaderboard)
+get_rank = _wrap(database.get_rank)
+
+# ----------------- items / shop -----------------
+get_items = _wrap(database.get_items)
+get_catalog = _wrap(database.get_catalog)
+add_item = _wrap(database.add_item)
+buy_item = _wrap(database.buy_item)
+
+# ----------------- battles / coins -> SHI -----------------
+record_battle = _wrap(database.record_battle)
+record_battles = _wrap(database.record_battles)
+get_fighters = _wrap(database.get_fighters)
+coins_to_shi_convert = _wrap(database.coins_to_shi_convert)
+battle_outcome = _wrap(database.battle_outcome)
+
+# ----------------- daily reward -----------------
+claim_daily = _wrap(database.claim_daily)
+
+# ----------------- referrals -----------------
+add_referral = _wrap(database.add_referral)
+referral_tiers = _wrap(database.referral_tiers)
+get_referral_stats = _wrap(database.get_referral_stats)
+get_referral_overview = _wrap(database.get_referral_overview)
+
+# ----------------- guilds -----------------
+create_guild = _wrap(database.create_guild)
+join_guild = _wrap(database.join_guild)
+leave_guild = _wrap(database.leave_guild)
+get_user_guilds = _wrap(database.get_user_guilds)
+get_guild_info = _wrap(database.get_guild_info)
+get_guild_leaderboard = _wrap(database.get_guild_leaderboard)
+
+# ----------------- bulk grants / airdrops -----------------
+bulk_update_shi = _wrap_maintenance(database.bulk_update_shi)
+airdrop = _wrap_maintenance(database.airdrop)
+
+# ----------------- admin / reporting -----------------
+get_stats = _wrap(database.get_stats)
+reconcile_stats = _wrap_maintenance(database.reconcile_stats)
+get_transactions = _wrap(database.get_transactions)
+flush_ledger = _wrap(database.flush_ledger)
+
+# ----------------- ledger retention -----------------
+archive_ledger = _wrap_maintenance(database.archive_ledger)
+get_archived_transactions = _wrap(database.get_archived_transactions)
@@ -0,0 +1,146 @@
+# battle.py
+# Battle resolution. A fighter's strength is
+#   level + BATTLE_POWER_WEIGHT * power + luck (0..BATTLE_LUCK)
+# where power is the total item power cached on the user row (database.py
+# keeps it current in buy_item), so a single battle is O(1) on the cached
+# user record and never touches the inventory.
+#
+# tournament() and guild_round() resolve whole brackets / rosters a round at
+# a time, vectorized with NumPy when it is installed (pure Python otherwise),
+# and record every result with one bulk write to battles. NumPy is imported on
+# the first batch call, so processes that only run single battles never load it.
+import os
+import random
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import database
+
+np = None
+_np_loaded = False
+
+def _load_numpy():
+    global np, _np_loaded
+    if not _np_loaded:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:  # optional: batch mode falls back to plain Python
+            pass
+        _np_loaded = True
+
+BATTLE_POWER_WEIGHT = float(os.getenv("BATTLE_POWER_WEIGHT", "1"))
+BATTLE_LUCK = int(os.getenv("BATTLE_LUCK", "5"))
+NPC_MIN = int(os.getenv("BATTLE_NPC_MIN", "3"))
+NPC_MAX = int(os.getenv("BATTLE_NPC_MAX", "18"))
+
+# ----------------- single battles -----------------
+def strength(level: int, power: int, rng=random) -> float:
+    return int(level) + BATTLE_POWER_WEIGHT * int(power or 0) + rng.randint(0, BATTLE_LUCK)
+
+def fight_npc(user: Dict[str, Any], rng=random) -> Tuple[bool, float, int]:
+    """One battle against a random NPC for a user dict (get_user_safe).
+    Returns (win, player strength, NPC strength)."""
+    mine = strength(user["level"], user.get("power", 0), rng)
+    npc = rng.randint(NPC_MIN, NPC_MAX)
+    return mine >= npc, mine, npc
+
+# ----------------- batch mode -----------------
+class _Roster:
+    """Fighters as parallel columns: NumPy arrays when available, lists otherwise."""
+
+    def __init__(self, fighters: Sequence[Tuple[int, int, int]]):
+        ids, levels, powers = zip(*fighters) if fighters else ((), (), ())
+        if np is not None:
+            self.ids = np.array(ids, dtype=np.int64)
+            self.levels = np.array(levels, dtype=np.float64)
+            self.powers = np.array(powers, dtype=np.float64)
+        else:
+            self.ids, self.levels, self.powers = list(ids), list(levels), list(powers)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def take(self, index) -> "_Roster":
+        sub = _Roster.__new__(_Roster)
+        if np is not None:
+            sub.ids, sub.levels, sub.powers = self.ids[index], self.levels[index], self.powers[index]
+        else:
+            sub.ids, sub.levels, sub.powers = ([col[i] for i in index] for col in (self.ids, self.levels, self.powers))
+        return sub
+
+def _rng(seed: Optional[int]):
+    return np.random.default_rng(seed) if np is not None else random.Random(seed)
+
+def _duel(a: _Roster, b: _Roster, rng) -> List[bool]:
+    """a[i] vs b[i] for every i in one pass; True where a wins (ties are a coin flip)."""
+    n = len(a)
+    if np is not None:
+        sa = a.levels + BATTLE_POWER_WEIGHT * a.powers + rng.integers(0, BATTLE_LUCK + 1, n)
+        sb = b.levels + BATTLE_POWER_WEIGHT * b.powers + rng.integers(0, BATTLE_LUCK + 1, n)
+        return (sa > sb) | ((sa == sb) & (rng.random(n) < 0.5))
+    wins = []
+    for i in range(n):
+        sa = a.levels[i] + BATTLE_POWER_WEIGHT * a.powers[i] + rng.randint(0, BATTLE_LUCK)
+        sb = b.levels[i] + BATTLE_POWER_WEIGHT * b.powers[i] + rng.randint(0, BATTLE_LUCK)
+        wins.append(sa > sb or (sa == sb and rng.random() < 0.5))
+    return wins
+
+def _results(a: _Roster, b: _Roster, a_wins, label: str) -> List[tuple]:
+    a_ids = a.ids.tolist() if np is not None else a.ids
+    b_ids = b.ids.tolist() if np is not None else b.ids
+    wins = a_wins.tolist() if np is not None else a_wins
+    rows = []
+    for x, y, w in zip(a_ids, b_ids, wins):
+        rows.append((x, f"{label}:{y}", w, 0.0, 0))
+        rows.append((y, f"{label}:{x}", not w, 0.0, 0))
+    return rows
+
+def tournament(user_ids, seed: Optional[int]=None, record: bool=True) -> Dict[str, Any]:
+    """Single-elimination bracket over user_ids (unknown and banned users are
+    dropped), seeded randomly; an odd fighter out gets a bye. Each round is
+    one vectorized pass. Returns the champion, per-round sizes and matches."""
+    _load_numpy()
+    rng = _rng(seed)
+    roster = _Roster(sorted(database.get_fighters(user_ids)))
+    order = rng.permutation(len(roster)) if np is not None else rng.sample(range(len(roster)), len(roster))
+    roster = roster.take(order)
+    rows: List[tuple] = []
+    rounds: List[int] = []
+    while len(roster) > 1:
+        rounds.append(len(roster))
+        half = len(roster) // 2
+        a, b = roster.take(range(0, 2 * half, 2)), roster.take(range(1, 2 * half, 2))
+        a_wins = _duel(a, b, rng)
+        rows += _results(a, b, a_wins, "tournament")
+        if np is not None:
+            winners = np.where(a_wins, np.arange(0, 2 * half, 2), np.arange(1, 2 * half, 2))
+            if len(roster) % 2:
+                winners = np.append(winners, len(roster) - 1)
+        else:
+            winners = [2 * i if w else 2 * i + 1 for i, w in enumerate(a_wins)]
+            if len(roster) % 2:
+                winners.append(len(roster) - 1)
+        roster = roster.take(winners)
+    recorded = database.record_battles(rows) if record and rows else 0
+    champion = int(roster.ids[0]) if len(roster) else None
+    return {"players": rounds[0] if rounds else len(roster), "rounds": rounds, "matches": len(rows) // 2,
+            "champion": champion, "recorded": recorded}
+
+def guild_round(side_a, side_b, seed: Optional[int]=None, record: bool=True) -> Dict[str, Any]:
+    """One round between two rosters of user ids: both sides are ranked by
+    power and matched rank for rank (the longer side's extras sit out), all
+    fights resolved in one pass. Returns wins per side and the winner
+    ("a", "b" or None on a draw)."""
+    _load_numpy()
+    rng = _rng(seed)
+    by_power = lambda f: (-f[2], -f[1], f[0])
+    a = sorted(database.get_fighters(side_a), key=by_power)
+    b = sorted(database.get_fighters(side_b), key=by_power)
+    n = min(len(a), len(b))
+    ra, rb = _Roster(a[:n]), _Roster(b[:n])
+    a_wins = _duel(ra, rb, rng) if n else []
+    won = int(sum(a_wins))
+    rows = _results(ra, rb, a_wins, "guild") if n else []
+    recorded = database.record_battles(rows) if record and rows else 0
+    winner = "a" if won * 2 > n else "b" if won * 2 < n else None
+    return {"matches": n, "a_wins": won, "b_wins": n - won, "winner": winner, "recorded": recorded}
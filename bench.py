@@ -0,0 +1,197 @@
+# bench.py
+# Reproducible benchmarks for the database.py hot paths. Each table size runs
+# in its own process against a fresh temp DB_PATH (database.py reads its
+# config at import), seeded deterministically with N users and N rows in each
+# ledger table, then every operation is timed at each thread count.
+#
+#   python bench.py --sizes 10000,100000,1000000 --threads 1,4,16 --out bench.json
+#   python bench.py --compare old.json new.json
+#
+# Results are JSON: run metadata plus, per size / operation / thread count,
+# throughput (ops/s) and latency percentiles in milliseconds.
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import sqlite3
+import tempfile
+import threading
+import subprocess
+from typing import Any, Callable, Dict, List
+
+OPERATIONS = ("get_user_safe", "register_user", "add_coins", "coins_to_shi_convert",
+              "buy_item", "record_battle", "get_leaderboard", "get_stats")
+
+SEED_CHUNK = 50000
+
+# ----------------- child: seed + measure one size -----------------
+def _seed(db, size: int, rng: random.Random):
+    now = int(time.time())
+    for start in range(1, size + 1, SEED_CHUNK):
+        ids = range(start, min(size, start + SEED_CHUNK - 1) + 1)
+        with db.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO users(user_id, username, shi_balance, coins, last_daily) VALUES(?,?,?,?,?)",
+                [(uid, f"player{uid}", rng.uniform(1000, 100000), rng.randint(100, 100000), 0) for uid in ids])
+            conn.executemany(db._TX_SQL, [(rng.randint(1, size), rng.choice(("coins_add", "coins_convert", "buy_item")),
+                                           rng.uniform(0, 10), "SHI", "seed", now - rng.randint(0, 90 * 86400))
+                                          for _ in ids])
+            conn.executemany(db._BATTLE_SQL, [(rng.randint(1, size), "NPC", rng.randint(0, 1), 0.0,
+                                               rng.randint(1, 50), now - rng.randint(0, 90 * 86400)) for _ in ids])
+    db._board.load()
+    db._users.clear()
+
+def _operations(db, size: int) -> Dict[str, Callable[[random.Random], Any]]:
+    item_ids = [it["id"] for it in db.get_items()]
+    new_ids = iter(range(size + 1, 10 ** 12))
+    new_lock = threading.Lock()
+
+    def register(rng):
+        with new_lock:
+            uid = next(new_ids)
+        db.register_user(uid, f"player{uid}")
+
+    user = lambda rng: rng.randint(1, size)
+    return {
+        "get_user_safe": lambda rng: db.get_user_safe(user(rng)),
+        "register_user": register,
+        "add_coins": lambda rng: db.add_coins(user(rng), rng.randint(1, 50)),
+        "coins_to_shi_convert": lambda rng: db.coins_to_shi_convert(user(rng)),
+        "buy_item": lambda rng: db.buy_item(user(rng), rng.choice(item_ids)),
+        "record_battle": lambda rng: db.record_battle(user(rng), "NPC", rng.random() < 0.5, 0.0, rng.randint(1, 50)),
+        "get_leaderboard": lambda rng: db.get_leaderboard(10),
+        "get_stats": lambda rng: db.get_stats(),
+    }
+
+def _percentile(sorted_vals: List[float], p: float) -> float:
+    return sorted_vals[min(len(sorted_vals) - 1, int(p * len(sorted_vals)))]
+
+def _measure(fn: Callable[[random.Random], Any], threads: int, ops: int, seed: int) -> Dict[str, float]:
+    per_thread = max(1, ops // threads)
+    barrier = threading.Barrier(threads + 1)
+    samples: List[List[float]] = [[] for _ in range(threads)]
+
+    def worker(i: int):
+        rng = random.Random(seed * 1000 + i)
+        out = samples[i]
+        barrier.wait()
+        for _ in range(per_thread):
+            t = time.perf_counter()
+            fn(rng)
+            out.append(time.perf_counter() - t)
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    barrier.wait()
+    t0 = time.perf_counter()
+    for t in pool:
+        t.join()
+    wall = time.perf_counter() - t0
+    lat = sorted(x for s in samples for x in s)
+    return {"ops": len(lat), "seconds": round(wall, 4), "ops_per_sec": round(len(lat) / wall, 1),
+            "mean_ms": round(sum(lat) / len(lat) * 1000, 4), "p50_ms": round(_percentile(lat, 0.50) * 1000, 4),
+            "p99_ms": round(_percentile(lat, 0.99) * 1000, 4), "max_ms": round(lat[-1] * 1000, 4)}
+
+def run_size(size: int, threads: List[int], ops: int, only: List[str], seed: int) -> Dict[str, Any]:
+    import database as db
+    rng = random.Random(seed)
+    t = time.perf_counter()
+    _seed(db, size, rng)
+    result = {"size": size, "seed_seconds": round(time.perf_counter() - t, 2), "operations": {}}
+    table = _operations(db, size)
+    for name in only:
+        result["operations"][name] = {}
+        for n in threads:
+            db.flush_ledger()
+            result["operations"][name][str(n)] = _measure(table[name], n, ops, seed)
+        db.flush_ledger()
+    result["user_cache"] = db.user_cache_stats()
+    result["db_bytes"] = os.path.getsize(db.DB_PATH)
+    db.stop_ledger()
+    db.close_connections()
+    return result
+
+# ----------------- parent: orchestrate sizes, write JSON -----------------
+def _git_rev() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def _metadata(args) -> Dict[str, Any]:
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "git_rev": _git_rev(),
+            "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(), "cpus": os.cpu_count(),
+            "ops_per_case": args.ops, "seed": args.seed,
+            "env": {k: v for k, v in os.environ.items() if k.startswith(("DB_", "LEDGER_", "USER_CACHE_", "LEADERBOARD_"))}}
+
+def _run_child(size: int, args) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix="shi-bench-", dir=args.tmpdir) as tmp:
+        env = dict(os.environ, DB_PATH=os.path.join(tmp, f"bench_{size}.db"))
+        cmd = [sys.executable, os.path.abspath(__file__), "--child", str(size), "--threads", args.threads,
+               "--ops", str(args.ops), "--only", args.only, "--seed", str(args.seed)]
+        out = subprocess.run(cmd, env=env, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def compare(old_path: str, new_path: str, threshold: float):
+    """Print ops/s change per case; exit 1 if any case regressed past threshold."""
+    with open(old_path) as f:
+        old = {r["size"]: r for r in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = {r["size"]: r for r in json.load(f)["results"]}
+    regressed = False
+    for size in sorted(set(old) & set(new)):
+        for op, by_threads in new[size]["operations"].items():
+            for n, cur in by_threads.items():
+                base = old[size]["operations"].get(op, {}).get(n)
+                if not base:
+                    continue
+                change = cur["ops_per_sec"] / base["ops_per_sec"] - 1
+                flag = ""
+                if change < -threshold:
+                    flag, regressed = "  REGRESSION", True
+                print(f"{size:>8} {op:<22} t={n:<3} {base['ops_per_sec']:>10.1f} -> {cur['ops_per_sec']:>10.1f} "
+                      f"ops/s ({change:+.1%})  p99 {base['p99_ms']:.3f} -> {cur['p99_ms']:.3f} ms{flag}")
+    sys.exit(1 if regressed else 0)
+
+def main():
+    ap = argparse.ArgumentParser(description="database.py benchmarks")
+    ap.add_argument("--sizes", default="10000,100000,1000000", help="user/ledger rows, comma separated")
+    ap.add_argument("--threads", default="1,4,16", help="thread counts, comma separated")
+    ap.add_argument("--ops", type=int, default=2000, help="calls per operation per thread count")
+    ap.add_argument("--only", default=",".join(OPERATIONS), help="operations to run, comma separated")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default="bench.json")
+    ap.add_argument("--tmpdir", default=None, help="where the temp databases go")
+    ap.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    ap.add_argument("--threshold", type=float, default=0.10, help="regression threshold for --compare")
+    ap.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.compare:
+        compare(args.compare[0], args.compare[1], args.threshold)
+        return
+    threads = [int(x) for x in args.threads.split(",")]
+    only = [x for x in args.only.split(",") if x]
+    unknown = set(only) - set(OPERATIONS)
+    if unknown:
+        ap.error(f"unknown operations: {', '.join(sorted(unknown))}")
+    if args.child:
+        print(json.dumps(run_size(args.child, threads, args.ops, only, args.seed)))
+        return
+
+    report = {"meta": _metadata(args), "results": []}
+    for size in (int(x) for x in args.sizes.split(",")):
+        print(f"size {size}...", file=sys.stderr)
+        report["results"].append(_run_child(size, args))
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {args.out}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
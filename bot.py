@@ -1,69 +1,210 @@
-import os
 import random
+import asyncio
 import logging
+import time
 import datetime
-from dotenv import load_dotenv
+import functools
+import collections
+# metrics first: its import starts the startup report clock; config next: it
+# loads config.env before database.py and the rest read the environment
+import metrics
+import config
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler,
-    MessageHandler, filters, ContextTypes, PreCheckoutQueryHandler
+    MessageHandler, filters, ContextTypes, PreCheckoutQueryHandler,
+    TypeHandler, ApplicationHandlerStop, BaseUpdateProcessor
 )
 import database
+import async_db
+import conversation
+import ratelimit
+import battle
 
-load_dotenv("config.env")
+# every setting below is typed and read once; see config.py
+CONFIG = config.get()
 
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-OWNER_ID = int(os.getenv("OWNER_ID", "0"))
-CURRENCY_NAME = os.getenv("CURRENCY_NAME", "SHI")
-STARS_PER_SHI = int(database.get_setting("STARS_PER_SHI", os.getenv("STARS_PER_SHI","5")))
-DAILY_SHI = float(database.get_setting("DAILY_SHI", os.getenv("DAILY_SHI","1")))
-COINS_PER_SHI = int(os.getenv("COINS_PER_SHI","100"))
+# per-user dialog state (TTL-bounded; STATE_BACKEND=sqlite to share it)
+conv_state = conversation.make_store()
 
-buying_shi_users = {}
+flood = ratelimit.FloodControl()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("SHI-BOT")
 
 # ----------------- HELPERS -----------------
+# settings are served from database.py's in-memory cache, so these are cheap
+# enough to call on every update and always reflect admin changes; the cache
+# still probes (or reloads) SQLite now and then, so it is read via async_db
+async def stars_per_shi() -> int:
+    return int(await async_db.get_setting("STARS_PER_SHI", str(CONFIG.stars_per_shi)))
+
 def admin_check(user_id:int):
-    return user_id == OWNER_ID
+    return user_id == CONFIG.owner_id
 
+# ----------------- RENDER CACHE -----------------
+# Keyboards are immutable, so static ones are built once and shared. The shop
+# view is rebuilt only when database.py reports a new catalog version.
+@functools.lru_cache(maxsize=None)
 def back_keyboard():
     return InlineKeyboardMarkup([[InlineKeyboardButton("↩️ بازگشت", callback_data="start")]])
 
+@functools.lru_cache(maxsize=None)
+def main_menu_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("👤 پروفایل", callback_data="profile")],
+        [InlineKeyboardButton("⚔️ مبارزه", callback_data="battle")],
+        [InlineKeyboardButton("🛒 فروشگاه", callback_data="shop")],
+        [InlineKeyboardButton(f"💫 خرید {CONFIG.currency_name} با Stars", callback_data="buy_shi")]
+    ])
+
+@functools.lru_cache(maxsize=None)
 def admin_keyboard():
     kb = [
         [InlineKeyboardButton("آمار", callback_data="admin_stats"), InlineKeyboardButton("آیتم‌ها", callback_data="admin_items")],
-        [InlineKeyboardButton("تراکنش‌ها", callback_data="admin_txs")],
+        [InlineKeyboardButton("تراکنش‌ها", callback_data="admin_txs"), InlineKeyboardButton("رفرال‌ها", callback_data="admin_refs")],
         [InlineKeyboardButton("بازگشت", callback_data="start")]
     ]
     return InlineKeyboardMarkup(kb)
 
+_shop_view = {"version": None, "text": "", "markup": None}
+
+async def shop_view():
+    """Return (text, markup) for the shop, re-rendered only on catalog change.
+    The catalog version check goes through async_db like every DB read."""
+    version, items = await async_db.get_catalog()
+    if _shop_view["version"] != version:
+        lines = []
+        kb = []
+        for it in items:
+            lines.append(f"• {it['name']} | power:{it['power']} | قیمت: {it['price_shi']} {CONFIG.currency_name}")
+            kb.append([InlineKeyboardButton(f"خرید {it['name']}", callback_data=f"buyitem_{it['id']}")])
+        kb.append([InlineKeyboardButton("↩️ بازگشت", callback_data="start")])
+        _shop_view.update(version=version, text="\n".join(lines), markup=InlineKeyboardMarkup(kb))
+    return _shop_view["text"], _shop_view["markup"]
+
+# ----------------- METRICS -----------------
+CALLBACK_ROUTES = frozenset({"start", "profile", "battle", "shop", "buy_shi", "admin_stats", "admin_items", "admin_txs",
+                             "admin_refs"})
+
+def callback_route(update: Update) -> str:
+    """Bounded route label for a callback query (buyitem_<id> folded)."""
+    data = update.callback_query.data or ""
+    if data.startswith("buyitem_"):
+        return "buyitem_*"
+    return data if data in CALLBACK_ROUTES else "other"
+
+metrics.gauge("shi_flood_dropped_total", "Updates dropped by flood control",
+              lambda: dict(flood.dropped), label="reason", type_="counter")
+metrics.gauge("shi_conversation_state_entries", "Pending dialog states held in memory",
+              lambda: len(conv_state) if isinstance(conv_state, conversation.MemoryStateStore) else 0)
+
+# ----------------- UPDATE ORDERING -----------------
+def update_key(update: object):
+    """Who an update belongs to: the user, else the chat, else None."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    return update.effective_chat.id if update.effective_chat else None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Handles up to max_concurrent_updates updates at once, but each user's
+    updates one at a time in arrival order. on_done() is called as each
+    update finishes."""
+
+    def __init__(self, max_concurrent_updates: int, on_done=None):
+        super().__init__(max_concurrent_updates)
+        self.on_done = on_done
+        self._waiting = {}  # key -> deque of updates queued behind the running one
+
+    async def do_process_update(self, update, coroutine):
+        # called in arrival order, each holding a concurrency slot. An update
+        # for a user with one already running is handed to that one and frees
+        # its slot, so a busy user never holds more than one.
+        key = update_key(update)
+        waiting = None
+        if key is not None:
+            waiting = self._waiting.get(key)
+            if waiting is not None:
+                waiting.append(coroutine)
+                return
+            waiting = self._waiting[key] = collections.deque()
+        try:
+            await self._run(coroutine)
+            while waiting:
+                await self._run(waiting.popleft())
+        finally:
+            if key is not None:
+                del self._waiting[key]
+
+    async def _run(self, coroutine):
+        try:
+            await coroutine
+        except Exception:
+            # PTB routes handler errors to the error handlers; this only
+            # keeps the updates queued behind this one running
+            logger.exception("update processing failed")
+        finally:
+            if self.on_done:
+                self.on_done()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# ----------------- FLOOD CONTROL -----------------
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs before every handler (group -1) and stops updates over the per-user
+    or global budget, and repeated presses of the same button."""
+    if metrics.startup_mark("first_update"):
+        logger.info("startup report (seconds since start): %s", metrics.startup_report())
+    user = update.effective_user
+    if user is None or update.pre_checkout_query or (update.message and update.message.successful_payment):
+        return  # never drop payments
+    query = update.callback_query
+    dedupe_key = (query.message.message_id if query.message else None, query.data) if query else None
+    if flood.allow(user.id, dedupe_key):
+        return
+    if query:
+        try:
+            await query.answer()
+        except Exception:
+            pass
+    raise ApplicationHandlerStop
+
 # ----------------- START -----------------
+def referrer_from_args(args):
+    """Referrer id from a t.me/<bot>?start=ref_<id> deep link, else None."""
+    payload = args[0] if args else ""
+    payload = payload[4:] if payload.startswith("ref_") else payload
+    return int(payload) if payload.isdigit() else None
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    database.register_user(user.id, user.username)
+    created = await async_db.register_user(user.id, user.username)
     text = "به بازی خوش آمدی! منو رو باز کن."
-    keyboard = [
-        [InlineKeyboardButton("👤 پروفایل", callback_data="profile")],
-        [InlineKeyboardButton("⚔️ مبارزه", callback_data="battle")],
-        [InlineKeyboardButton("🛒 فروشگاه", callback_data="shop")],
-        [InlineKeyboardButton(f"💫 خرید {CURRENCY_NAME} با Stars", callback_data="buy_shi")]
-    ]
+    # only a brand-new user can be referred; add_referral refuses repeats
+    # and cycles itself
+    referrer = referrer_from_args(context.args) if update.message else None
+    if created and referrer is not None and await async_db.add_referral(referrer, user.id) is not None:
+        text = "با دعوت یک دوست اومدی! " + text
     if update.message:
-        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        await update.message.reply_text(text, reply_markup=main_menu_keyboard())
     elif update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        await update.callback_query.edit_message_text(text, reply_markup=main_menu_keyboard())
 
 # ----------------- BUTTON HANDLER -----------------
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    u = database.get_user(user_id)
+    u = await async_db.get_user(user_id)
     if not u:
-        database.register_user(user_id, query.from_user.username)
-        u = database.get_user(user_id)
+        await async_db.register_user(user_id, query.from_user.username)
+        u = await async_db.get_user(user_id)
     data = query.data
 
     if data == "start":
@@ -72,19 +213,17 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data == "profile":
         await query.edit_message_text(
-            f"پروفایل تو:\n💰 {CURRENCY_NAME}: {u['shi_balance']}\n🪙 سکه: {u['coins']}\n"
-            f"⭐ استارز: {u['stars_balance']}\n🎚️ Level: {u['level']}  EXP: {u['exp']}",
+            f"پروفایل تو:\n💰 {CONFIG.currency_name}: {u['shi_balance']}\n🪙 سکه: {u['coins']}\n"
+            f"⭐ استارز: {u['stars_balance']}\n🎚️ Level: {u['level']}  EXP: {u['exp']}\n💪 قدرت: {u['power']}",
             reply_markup=back_keyboard()
         ); return
 
     if data == "battle":
-        base = int(u['level']) + random.randint(0,5)
-        npc = random.randint(3, 18)
-        win = base >= npc
+        # level + cached item power + luck vs a random NPC
+        win, _, _ = battle.fight_npc(u)
         reward_coins = random.randint(10,50)
-        database.add_coins(user_id, reward_coins)
-        shi_from_coins = database.coins_to_shi_convert(user_id, coins_per_shi=COINS_PER_SHI, shi_per_chunk=0.01)
-        database.record_battle(user_id, "NPC", win, shi_from_coins, reward_coins)
+        shi_from_coins = await async_db.battle_outcome(user_id, "NPC", win, reward_coins,
+                                                       coins_per_shi=CONFIG.coins_per_shi, shi_per_chunk=0.01)
         if win:
             text = f"🎉 بردی! سکه گرفتیش: {reward_coins}\nتبدیل سکه -> SHI: {shi_from_coins:.2f}"
         else:
@@ -92,34 +231,136 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(text, reply_markup=back_keyboard()); return
 
     if data == "shop":
-        items = database.get_items()
-        lines = []
-        kb = []
-        for it in items:
-            lines.append(f"• {it['name']} | power:{it['power']} | قیمت: {it['price_shi']} {CURRENCY_NAME}")
-            kb.append([InlineKeyboardButton(f"خرید {it['name']}", callback_data=f"buyitem_{it['id']}")])
-        kb.append([InlineKeyboardButton("↩️ بازگشت", callback_data="start")])
-        await query.edit_message_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(kb)); return
+        text, markup = await shop_view()
+        await query.edit_message_text(text, reply_markup=markup); return
 
     if data.startswith("buyitem_"):
         item_id = int(data.split("_",1)[1])
-        ok = database.buy_item(user_id, item_id)
+        ok = await async_db.buy_item(user_id, item_id)
         await query.edit_message_text("✅ خرید موفق!" if ok else "⛔ SHI کافی نیست!", reply_markup=back_keyboard()); return
 
     if data == "buy_shi":
-        buying_shi_users[user_id] = True
+        await conv_state.aset(f"buy_shi:{user_id}", True, ttl=CONFIG.buy_shi_ttl)
         await query.edit_message_text(
-            f"چند واحد {CURRENCY_NAME} می‌خوای بخری؟ (یک عدد بفرست)\nنرخ فعلی: هر {CURRENCY_NAME} = {database.get_setting('STARS_PER_SHI',str(STARS_PER_SHI))} ⭐",
+            f"چند واحد {CONFIG.currency_name} می‌خوای بخری؟ (یک عدد بفرست)\nنرخ فعلی: هر {CONFIG.currency_name} = {await stars_per_shi()} ⭐",
             reply_markup=back_keyboard()
         ); return
 
+    if data == "admin_stats" and admin_check(user_id):
+        await query.edit_message_text(format_stats(await async_db.get_stats()), reply_markup=admin_keyboard()); return
+
+    if data == "admin_refs" and admin_check(user_id):
+        await query.edit_message_text(format_referrals(await async_db.get_referral_overview()),
+                                      reply_markup=admin_keyboard()); return
+
 # ----------------- HIDDEN ADMIN -----------------
+def format_stats(s) -> str:
+    lines = [
+        f"👥 کاربران: {s['users']}",
+        f"💰 کل {CONFIG.currency_name}: {s['total_shi']:.2f}",
+        f"🪙 کل سکه: {s['total_coins']}",
+        f"⭐ کل استارز: {s['total_stars']}",
+        f"🧾 تراکنش‌ها: {s['transactions']}",
+        f"⚔️ مبارزه‌ها: {s['battles']}",
+    ]
+    lines += [f"  • {t}: {n}" for t, n in s["tx_by_type"].items()]
+    return "\n".join(lines)
+
+def format_referrals(r) -> str:
+    lines = [
+        f"🔗 رفرال‌ها: {r['referrals']} (از {r['referrers']} معرف)",
+        f"🌳 عمیق‌ترین زنجیره: {r['max_depth']} سطح",
+        f"🎁 پاداش پرداختی: {r['rewards_paid']:.2f} {CONFIG.currency_name}",
+    ]
+    lines += [f"  {i+1}. {t['user_id']} - زیرمجموعه: {t['downline']} (مستقیم: {t['direct']})"
+              for i, t in enumerate(r["top"])]
+    return "\n".join(lines)
+
 async def hidden_admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if not admin_check(user_id):
         return
     await update.message.reply_text("🔒 پنل ادمین باز شد", reply_markup=admin_keyboard())
 
+async def reconcile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not admin_check(update.effective_user.id):
+        return
+    result = await async_db.reconcile_stats()
+    drift = result["drift"]
+    text = "✅ آمار بدون اختلاف است." if not drift else "⚠️ اختلاف اصلاح شد:\n" + "\n".join(f"{k}: {v:+}" for k, v in drift.items())
+    await update.message.reply_text(text, reply_markup=admin_keyboard())
+
+async def tournament_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/tournament [n]: knockout bracket between the top n leaderboard players."""
+    if not admin_check(update.effective_user.id):
+        return
+    try:
+        n = int(context.args[0]) if context.args else CONFIG.tournament_size
+    except ValueError:
+        await update.message.reply_text("استفاده: /tournament [تعداد بازیکن]"); return
+    top = await async_db.get_leaderboard(max(2, n))
+    result = await async_db.run(battle.tournament, [u["user_id"] for u in top])
+    if result["champion"] is None:
+        await update.message.reply_text("بازیکن کافی برای تورنمنت نیست."); return
+    names = {u["user_id"]: u["username"] or u["user_id"] for u in top}
+    await update.message.reply_text(
+        f"🏟️ تورنمنت {result['players']} نفره در {len(result['rounds'])} دور ({result['matches']} مبارزه)\n"
+        f"🏆 قهرمان: {names.get(result['champion'], result['champion'])}", reply_markup=admin_keyboard())
+
+async def archive_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not admin_check(update.effective_user.id):
+        return
+    await update.message.reply_text("⏳ بایگانی تراکنش‌های قدیمی شروع شد...")
+    result = await async_db.archive_ledger()
+    await update.message.reply_text(
+        f"🗄️ بایگانی شد: {result['transactions']} تراکنش، {result['battles']} مبارزه\n"
+        f"صفحات آزاد شده: {result['vacuumed_pages']}", reply_markup=admin_keyboard())
+
+AIRDROP_USAGE = ("استفاده: /airdrop <مقدار> [SHI|COINS|XTR] [all | guild <id> | active <روز> | level <حداقل>]\n"
+                 "مثال: /airdrop 0.5 SHI active 7")
+_AIRDROP_FILTERS = {"guild": "guild_id", "active": "active_days", "level": "min_level"}
+
+def parse_airdrop_args(args):
+    """(amount, currency, filter) from /airdrop arguments; raises ValueError."""
+    if not args:
+        raise ValueError("missing amount")
+    amount = float(args[0])
+    rest = list(args[1:])
+    currency = "SHI"
+    if rest and rest[0].upper() in ("SHI", "COINS", "XTR"):
+        currency = rest.pop(0).upper()
+    flt = {}
+    if rest and rest[0] == "all":
+        rest.pop(0)
+    while rest:
+        key = _AIRDROP_FILTERS.get(rest.pop(0))
+        if key is None or not rest:
+            raise ValueError("bad filter")
+        flt[key] = float(rest.pop(0)) if key == "active_days" else int(rest.pop(0))
+    return amount, currency, flt
+
+async def airdrop_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not admin_check(update.effective_user.id):
+        return
+    try:
+        amount, currency, flt = parse_airdrop_args(context.args)
+    except ValueError:
+        await update.message.reply_text(AIRDROP_USAGE)
+        return
+    status = await update.message.reply_text("⏳ ایردراپ در حال اجرا...")
+    loop = asyncio.get_running_loop()
+    last_edit = [0.0]
+
+    def progress(done, total):
+        # called on the DB thread after each chunk; edit at most every 2s
+        now = time.monotonic()
+        if now - last_edit[0] >= 2:
+            last_edit[0] = now
+            asyncio.run_coroutine_threadsafe(status.edit_text(f"⏳ ایردراپ: {done}/{total} کاربر"), loop)
+
+    result = await async_db.airdrop(flt, amount, currency=currency, progress=progress)
+    await status.edit_text(f"✅ ایردراپ انجام شد: {result['users']} کاربر، مجموع {result['amount']:g} {result['currency']}")
+
 # ----------------- HANDLE TEXT -----------------
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -129,19 +370,17 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await hidden_admin_cmd(update, context)
         return
 
-    if buying_shi_users.get(user_id):
+    if await conv_state.apop(f"buy_shi:{user_id}"):
         if not txt.isdigit():
             await update.message.reply_text("لطفاً فقط عدد بفرست.")
-            buying_shi_users[user_id] = False
             return
         amount_shi = int(txt)
-        stars_per_shi = int(database.get_setting("STARS_PER_SHI", str(STARS_PER_SHI)))
-        stars_needed = amount_shi * stars_per_shi
-        invoice = LabeledPrice(label=f"{amount_shi} {CURRENCY_NAME}", amount=stars_needed)
+        stars_needed = amount_shi * await stars_per_shi()
+        invoice = LabeledPrice(label=f"{amount_shi} {CONFIG.currency_name}", amount=stars_needed)
         try:
             await context.bot.send_invoice(
                 chat_id=user_id,
-                title=f"خرید {amount_shi} {CURRENCY_NAME}",
+                title=f"خرید {amount_shi} {CONFIG.currency_name}",
                 description=f"پرداخت با Telegram Stars",
                 payload=f"buy_{amount_shi}_{user_id}",
                 provider_token="",
@@ -152,7 +391,6 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logger.exception("send_invoice failed")
             await update.message.reply_text("مشکل در ارسال فاکتور. بعداً تلاش کن.")
-        buying_shi_users[user_id] = False
         return
 
     await update.message.reply_text("از منو استفاده کنید یا /start رو بزنین.", reply_markup=back_keyboard())
@@ -160,28 +398,93 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ----------------- DAILY -----------------
 async def daily_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    database.register_user(user_id, update.effective_user.username)
-    u = database.get_user(user_id)
-    last = int(u.get("last_daily", 0))
-    now = int(datetime.datetime.utcnow().timestamp())
-    if now - last < 24*3600:
+    await async_db.register_user(user_id, update.effective_user.username)
+    reward = await async_db.claim_daily(user_id, int(time.time()))
+    if reward is None:
         await update.message.reply_text("پاداش روزانه قبلاً گرفته شده. فردا بیا.", reply_markup=back_keyboard())
         return
-    daily_shi = float(database.get_setting("DAILY_SHI", str(DAILY_SHI)))
-    minc = int(database.get_setting("DAILY_COINS_MIN","10"))
-    maxc = int(database.get_setting("DAILY_COINS_MAX","30"))
-    coins = random.randint(minc, maxc)
-    database.update_shi(user_id, daily_shi)
-    database.add_coins(user_id, coins)
-    database.set_setting(f"user_{user_id}_last_daily", str(now))
-    await update.message.reply_text(f"🎁 پاداش روزانه: {daily_shi} {CURRENCY_NAME} و {coins} سکه دریافت شد!", reply_markup=back_keyboard())
+    reward_shi, coins = reward
+    await update.message.reply_text(f"🎁 پاداش روزانه: {reward_shi} {CONFIG.currency_name} و {coins} سکه دریافت شد!", reply_markup=back_keyboard())
 
 # ----------------- LEADERBOARD -----------------
 async def leaderboard_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    top_users = database.get_leaderboard()
-    lines = [f"{i+1}. {u['username']} - {u['shi_balance']} {CURRENCY_NAME}" for i,u in enumerate(top_users)]
+    top_users = await async_db.get_leaderboard()
+    lines = [f"{i+1}. {u['username']} - {u['shi_balance']} {CONFIG.currency_name}" for i,u in enumerate(top_users)]
+    rank = await async_db.get_rank(update.effective_user.id)
+    if rank is not None:
+        lines.append(f"\nرتبه تو: {rank}")
     await update.message.reply_text("🏆 لیدربورد:\n" + "\n".join(lines), reply_markup=back_keyboard())
 
+# ----------------- REFERRALS -----------------
+async def invite_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/invite: your deep link and how your referral tree has grown."""
+    user = update.effective_user
+    await async_db.register_user(user.id, user.username)
+    r = await async_db.get_referral_stats(user.id)
+    tiers = " / ".join(f"{t:g}" for t in await async_db.referral_tiers())
+    levels = "\n".join(f"  سطح {d}: {n}" for d, n in r["levels"].items())
+    await update.message.reply_text(
+        f"🔗 لینک دعوت تو:\nhttps://t.me/{context.bot.username}?start=ref_{user.id}\n"
+        f"🎁 پاداش هر ثبت‌نام ({CONFIG.currency_name}، سطح ۱ به بعد): {tiers}\n"
+        f"👥 دعوت مستقیم: {r['direct']}  |  کل زیرمجموعه: {r['downline']}" + (f"\n{levels}" if levels else ""),
+        reply_markup=back_keyboard())
+
+# ----------------- GUILDS -----------------
+# totals come from database.py's trigger-kept guild_stats, so these answer in
+# constant time however large a guild is
+GUILD_NAME_MAX = 32
+
+def format_guild(g) -> str:
+    return (f"🛡️ {g['name']} (#{g['id']})\n👥 اعضا: {g['member_count']}\n"
+            f"💰 مجموع {CONFIG.currency_name}: {g['total_shi']:.2f}\n💪 قدرت کل: {g['total_power']}\n🏅 رتبه: {g['rank']}")
+
+async def guild_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/guild [id]: a guild's totals (default: your first guild)."""
+    user_id = update.effective_user.id
+    if context.args:
+        if not context.args[0].isdigit():
+            await update.message.reply_text("استفاده: /guild [شناسه گیلد]"); return
+        guild_id = int(context.args[0])
+    else:
+        mine = await async_db.get_user_guilds(user_id)
+        if not mine:
+            await update.message.reply_text("عضو هیچ گیلدی نیستی. /createguild <نام> یا /joinguild <شناسه>"); return
+        guild_id = mine[0]
+    g = await async_db.get_guild_info(guild_id)
+    await update.message.reply_text(format_guild(g) if g else "گیلد پیدا نشد.", reply_markup=back_keyboard())
+
+async def guilds_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    top = await async_db.get_guild_leaderboard()
+    if not top:
+        await update.message.reply_text("هنوز گیلدی ساخته نشده.", reply_markup=back_keyboard()); return
+    lines = [f"{i+1}. {g['name']} - {g['total_shi']:.2f} {CONFIG.currency_name} | 👥 {g['member_count']} | 💪 {g['total_power']}"
+             for i, g in enumerate(top)]
+    await update.message.reply_text("🏰 برترین گیلدها:\n" + "\n".join(lines), reply_markup=back_keyboard())
+
+async def createguild_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    name = " ".join(context.args).strip()[:GUILD_NAME_MAX]
+    if not name:
+        await update.message.reply_text("استفاده: /createguild <نام>"); return
+    await async_db.register_user(user.id, user.username)
+    gid = await async_db.create_guild(name, user.id)
+    await update.message.reply_text(f"✅ گیلد «{name}» ساخته شد. شناسه: {gid}", reply_markup=back_keyboard())
+
+async def joinguild_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("استفاده: /joinguild <شناسه>"); return
+    await async_db.register_user(user.id, user.username)
+    ok = await async_db.join_guild(int(context.args[0]), user.id)
+    await update.message.reply_text("✅ به گیلد پیوستی!" if ok else "گیلد پیدا نشد.", reply_markup=back_keyboard())
+
+async def leaveguild_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("استفاده: /leaveguild <شناسه>"); return
+    await async_db.leave_guild(int(context.args[0]), user_id)
+    await update.message.reply_text("از گیلد خارج شدی.", reply_markup=back_keyboard())
+
 # ----------------- PRECHECKOUT & PAYMENT -----------------
 async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.pre_checkout_query
@@ -199,12 +502,12 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
         if parts[0] == "buy":
             amount_shi = int(parts[1])
         else:
-            amount_shi = max(1, int(int(sp.total_amount) // STARS_PER_SHI))
+            amount_shi = max(1, int(int(sp.total_amount) // await stars_per_shi()))
     except:
-        amount_shi = max(1, int(int(sp.total_amount) // STARS_PER_SHI))
-    database.update_shi(user_id, amount_shi)
-    database.set_setting("last_payment_ts", str(int(datetime.datetime.now().timestamp())))
-    await update.message.reply_text(f"✅ پرداخت موفق! {amount_shi} {CURRENCY_NAME} به حساب شما اضافه شد.", reply_markup=back_keyboard())
+        amount_shi = max(1, int(int(sp.total_amount) // await stars_per_shi()))
+    await async_db.update_shi(user_id, amount_shi)
+    await async_db.set_setting("last_payment_ts", str(int(datetime.datetime.now().timestamp())))
+    await update.message.reply_text(f"✅ پرداخت موفق! {amount_shi} {CONFIG.currency_name} به حساب شما اضافه شد.", reply_markup=back_keyboard())
 
 # ----------------- ERROR HANDLER -----------------
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
@@ -215,25 +518,110 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     except:
         pass
 
+# ----------------- LIFECYCLE -----------------
+async def archive_loop(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await async_db.archive_ledger()
+        except Exception:
+            logger.exception("scheduled ledger archival failed")
+
+async def on_startup(app):
+    # schema check (DDL only when a migration is pending), then all settings
+    # in one query so handlers start on a warm cache
+    await async_db.run(database.init_db)
+    await async_db.get_settings()
+    metrics.start_server()
+    if CONFIG.archive_interval > 0:
+        app.bot_data["archive_task"] = asyncio.create_task(archive_loop(CONFIG.archive_interval))
+    limiter = app.bot.rate_limiter
+    if isinstance(limiter, ratelimit.PacedRateLimiter):
+        metrics.gauge("shi_outbound_retries_total", "Bot API calls retried after a 429",
+                      lambda: limiter.retries, type_="counter")
+    metrics.startup_mark("app_ready")
+
+async def on_shutdown(app):
+    task = app.bot_data.pop("archive_task", None)
+    if task is not None:
+        task.cancel()
+    metrics.stop_server()
+    async_db.shutdown()
+
 # ----------------- MAIN -----------------
+def build_application(token: str=None, base_url: str=None, concurrent_updates=None, rate_limiter=True, request=None):
+    """Assemble the Application with every handler. concurrent_updates may be
+    an int (above 1, updates of different users run concurrently and each
+    user's stay in order) or a telegram.ext.BaseUpdateProcessor; request
+    replaces the HTTP transport (loadtest.py passes an in-process stub)."""
+    builder = ApplicationBuilder().token(token or CONFIG.bot_token)
+    if base_url or CONFIG.bot_api_base_url:
+        builder = builder.base_url(base_url or CONFIG.bot_api_base_url)
+    if rate_limiter:
+        builder = builder.rate_limiter(ratelimit.PacedRateLimiter())
+    concurrent_updates = concurrent_updates or CONFIG.concurrent_updates
+    if isinstance(concurrent_updates, int) and concurrent_updates > 1:
+        concurrent_updates = PerUserUpdateProcessor(concurrent_updates)
+    builder = builder.concurrent_updates(concurrent_updates)
+    if request is not None:
+        builder = builder.request(request)
+    else:
+        # PTB's default pool is a single connection, which would serialize every
+        # outbound call no matter how many updates run concurrently
+        n = getattr(concurrent_updates, "max_concurrent_updates", concurrent_updates)
+        builder = builder.connection_pool_size(max(8, n))
+    app = builder.post_init(on_startup).post_shutdown(on_shutdown).build()
+    timed = metrics.timed_handler
+    app.add_handler(TypeHandler(Update, flood_guard), group=-1)
+    app.add_handler(CommandHandler("start", timed("start")(start)))
+    app.add_handler(CommandHandler("daily", timed("daily")(daily_cmd)))
+    app.add_handler(CommandHandler("leaderboard", timed("leaderboard")(leaderboard_cmd)))
+    app.add_handler(CommandHandler("invite", timed("invite")(invite_cmd)))
+    app.add_handler(CommandHandler("guild", timed("guild")(guild_cmd)))
+    app.add_handler(CommandHandler("guilds", timed("guilds")(guilds_cmd)))
+    app.add_handler(CommandHandler("createguild", timed("createguild")(createguild_cmd)))
+    app.add_handler(CommandHandler("joinguild", timed("joinguild")(joinguild_cmd)))
+    app.add_handler(CommandHandler("leaveguild", timed("leaveguild")(leaveguild_cmd)))
+    app.add_handler(CommandHandler("shayan7", timed("admin")(hidden_admin_cmd)))
+    app.add_handler(CommandHandler("reconcile", timed("reconcile")(reconcile_cmd)))
+    app.add_handler(CommandHandler("archive", timed("archive")(archive_cmd)))
+    app.add_handler(CommandHandler("tournament", timed("tournament")(tournament_cmd)))
+    app.add_handler(CommandHandler("airdrop", timed("airdrop")(airdrop_cmd)))
+    app.add_handler(CallbackQueryHandler(timed("button", callback_route)(button)))
+    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), timed("text")(handle_text)))
+    app.add_handler(PreCheckoutQueryHandler(timed("precheckout")(precheckout_callback)))
+    app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, timed("payment")(successful_payment_callback)))
+    app.add_error_handler(error_handler)
+    return app
+
 def main():
-    if not BOT_TOKEN:
+    if not CONFIG.bot_token:
         print("لطفا BOT_TOKEN رو در config.env بذار.")
         return
+    if CONFIG.workers > 0:
+        import workers
+        workers.run(CONFIG.workers)
+        return
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("daily", daily_cmd))
-    app.add_handler(CommandHandler("leaderboard", leaderboard_cmd))
-    app.add_handler(CommandHandler("shayan7", hidden_admin_cmd))
-    app.add_handler(CallbackQueryHandler(button))
-    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text))
-    app.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-    app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
-    app.add_error_handler(error_handler)
-
+    app = build_application()
     print("Bot started")
-    app.run_polling()
+    if CONFIG.bot_mode == "webhook":
+        # needs python-telegram-bot[webhooks]. On SIGINT/SIGTERM the listener
+        # stops accepting first, then Application.stop() drains every update
+        # already received before post_shutdown closes the database.
+        app.run_webhook(
+            listen=CONFIG.webhook_listen,
+            port=CONFIG.webhook_port,
+            url_path=CONFIG.webhook_path,
+            webhook_url=CONFIG.webhook_url or None,
+            secret_token=CONFIG.webhook_secret or None,
+            # setWebhook accepts 1..100
+            max_connections=min(100, max(40, CONFIG.concurrent_updates)),
+        )
+    else:
+        app.run_polling()
+
+metrics.startup_mark("import")
 
 if __name__ == "__main__":
     main()
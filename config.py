@@ -0,0 +1,70 @@
+# config.py
+# Bot process configuration, read once into a frozen, typed Config. Importing
+# this module loads config.env into the environment (without overriding
+# variables already set), so import it before database.py and the other
+# modules that read their own tuning knobs at import.
+#
+#   cfg = config.get()            # cached for the life of the process
+#   cfg = config.Config.from_env({"BOT_MODE": "webhook", ...})
+import os
+import functools
+from dataclasses import dataclass, fields
+from typing import Mapping
+
+from dotenv import load_dotenv
+
+CONFIG_FILE = os.getenv("CONFIG_FILE", "config.env")
+load_dotenv(CONFIG_FILE)
+
+@dataclass(frozen=True)
+class Config:
+    """Each field is read from the upper-cased variable of the same name."""
+    bot_token: str = ""
+    owner_id: int = 0
+    currency_name: str = "SHI"
+    coins_per_shi: int = 100
+    # default rate; the STARS_PER_SHI setting overrides it at runtime
+    stars_per_shi: int = 5
+    # update ingestion: "polling" or "webhook"
+    bot_mode: str = "polling"
+    bot_api_base_url: str = ""  # e.g. a local fake Bot API
+    concurrent_updates: int = 1
+    webhook_listen: str = "0.0.0.0"
+    webhook_port: int = 8443
+    webhook_path: str = "telegram"
+    webhook_url: str = ""  # public URL Telegram posts to
+    webhook_secret: str = ""
+    # >0: one ingress process fans updates out to this many worker processes
+    # (see workers.py)
+    workers: int = 0
+    # seconds between background ledger archival runs (0 = only via /archive)
+    archive_interval: float = 0.0
+    buy_shi_ttl: float = 300.0
+    tournament_size: int = 64
+
+    def __post_init__(self):
+        if self.bot_mode not in ("polling", "webhook"):
+            raise ValueError(f"BOT_MODE must be polling or webhook, not {self.bot_mode!r}")
+        if self.concurrent_updates < 1:
+            raise ValueError("CONCURRENT_UPDATES must be at least 1")
+        if self.workers < 0:
+            raise ValueError("WORKERS must not be negative")
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str]=os.environ) -> "Config":
+        """Build a Config from env; unset or empty variables keep the default."""
+        values = {}
+        for f in fields(cls):
+            name = f.name.upper()
+            raw = env.get(name)
+            if raw is None or raw == "":
+                continue
+            try:
+                values[f.name] = f.type(raw)
+            except ValueError:
+                raise ValueError(f"{name}={raw!r} is not a valid {f.type.__name__}") from None
+        return cls(**values)
+
+@functools.lru_cache(maxsize=None)
+def get() -> Config:
+    return Config.from_env()
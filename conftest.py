@@ -0,0 +1,21 @@
+# conftest.py
+# database.py reads DB_PATH and friends at import, so point every in-process
+# test at a throwaway file before any test module imports it. Tests share
+# that file and take fresh user ids from the uid fixture.
+import os
+import itertools
+import tempfile
+
+import pytest
+
+_TMP = tempfile.mkdtemp(prefix="shi-test-")
+os.environ["DB_PATH"] = os.path.join(_TMP, "shi.db")
+os.environ["DB_SHARDS"] = "0"
+os.environ.pop("LEDGER_ARCHIVE_PATH", None)
+
+_ids = itertools.count(1_000_000)
+
+@pytest.fixture
+def uid():
+    """A user id no other test has touched."""
+    return next(_ids)
@@ -0,0 +1,121 @@
+# conversation.py
+# Short-lived per-user dialog state (e.g. "waiting for an amount"), with
+# per-key TTLs and a memory cap. STATE_BACKEND=sqlite keeps it in the shared
+# database instead, so several bot processes see the same state.
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+import database
+import async_db
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_TTL = float(os.getenv("STATE_TTL", "600"))
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "100000"))
+
+class MemoryStateStore:
+    """In-process store. Every operation is O(1): entries live in an
+    OrderedDict in least-recently-set order, expire lazily on read, and the
+    oldest are evicted once max_entries is reached."""
+
+    def __init__(self, ttl: float=STATE_TTL, max_entries: int=STATE_MAX_ENTRIES, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._data: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= self._clock():
+            self.delete(key)
+            return None
+        return entry[0]
+
+    def set(self, key: str, value: Any, ttl: Optional[float]=None):
+        expires = self._clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            self._sweep()
+
+    def pop(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.pop(key, None)
+        if entry is None or entry[1] <= self._clock():
+            return None
+        return entry[0]
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _sweep(self):
+        # evict past the cap, then drop a few expired entries from the old end
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+        now = self._clock()
+        for _ in range(8):
+            if not self._data:
+                break
+            key, (_, expires) = next(iter(self._data.items()))
+            if expires > now:
+                break
+            del self._data[key]
+
+    # async API used by handlers; memory operations never block
+    async def aget(self, key: str) -> Optional[Any]:
+        return self.get(key)
+
+    async def aset(self, key: str, value: Any, ttl: Optional[float]=None):
+        self.set(key, value, ttl)
+
+    async def apop(self, key: str) -> Optional[Any]:
+        return self.pop(key)
+
+class SQLiteStateStore:
+    """Store backed by database.py's conversation_state table. Expired rows
+    are ignored on read and purged every purge_every writes."""
+
+    def __init__(self, ttl: float=STATE_TTL, purge_every: int=1000):
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._writes = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        return database.state_get(key)
+
+    def set(self, key: str, value: Any, ttl: Optional[float]=None):
+        database.state_set(key, value, time.time() + (self.ttl if ttl is None else ttl))
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            database.purge_state()
+
+    def pop(self, key: str) -> Optional[Any]:
+        return database.state_pop(key)
+
+    def delete(self, key: str):
+        database.state_pop(key)
+
+    async def aget(self, key: str) -> Optional[Any]:
+        return await async_db.run(self.get, key)
+
+    async def aset(self, key: str, value: Any, ttl: Optional[float]=None):
+        await async_db.run(self.set, key, value, ttl)
+
+    async def apop(self, key: str) -> Optional[Any]:
+        return await async_db.run(self.pop, key)
+
+def make_store(backend: str=STATE_BACKEND):
+    if backend == "sqlite":
+        return SQLiteStateStore()
+    if backend == "memory":
+        return MemoryStateStore()
+    raise ValueError(f"unknown STATE_BACKEND: {backend}")
@@ -3,23 +3,243 @@ import os
 import sqlite3
 import time
 import json
-from typing import Optional, Dict, Any, List
+import random
+import threading
+import queue
+import atexit
+import functools
+import logging
+import bisect
+import heapq
+import zlib
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Tuple
+
+import metrics
 
 DB_PATH = os.getenv("DB_PATH", "shi.db")
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "16384"))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "30"))
+
+# ledger (transactions/battles) write mode: "direct" writes each row inside the
+# caller's transaction; "group" queues rows and group-commits them in batches
+LEDGER_MODE = os.getenv("LEDGER_MODE", "direct")
+LEDGER_BATCH_SIZE = int(os.getenv("LEDGER_BATCH_SIZE", "500"))
+LEDGER_FLUSH_MS = int(os.getenv("LEDGER_FLUSH_MS", "200"))
+LEDGER_QUEUE_MAX = int(os.getenv("LEDGER_QUEUE_MAX", "20000"))
+LEDGER_PUT_TIMEOUT = float(os.getenv("LEDGER_PUT_TIMEOUT", "2"))
+# PRAGMA synchronous for the flusher connection: OFF | NORMAL | FULL
+LEDGER_DURABILITY = os.getenv("LEDGER_DURABILITY", "NORMAL").upper()
+
+# how often (seconds) cached settings are checked against the DB's version
+SETTINGS_CHECK_INTERVAL = float(os.getenv("SETTINGS_CHECK_INTERVAL", "1"))
+CATALOG_CHECK_INTERVAL = float(os.getenv("CATALOG_CHECK_INTERVAL", "5"))
+# seconds between catch-ups of the in-memory leaderboard with balance changes
+# made by other processes (read from board_log; 0 disables)
+LEADERBOARD_RESYNC = float(os.getenv("LEADERBOARD_RESYNC", "300"))
+# user-row LRU: max entries, and max age in seconds (0 = no expiry)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "0"))
+# ledger retention: rows older than this many days are rolled up into daily
+# summaries and moved to the archive file, ARCHIVE_CHUNK rows per transaction
+LEDGER_RETENTION_DAYS = float(os.getenv("LEDGER_RETENTION_DAYS", "90"))
+LEDGER_ARCHIVE_PATH = os.getenv("LEDGER_ARCHIVE_PATH", "") or os.path.splitext(DB_PATH)[0] + "-archive.db"
+ARCHIVE_CHUNK = int(os.getenv("ARCHIVE_CHUNK", "5000"))
+ARCHIVE_PAUSE_MS = int(os.getenv("ARCHIVE_PAUSE_MS", "50"))
+# bulk grants / airdrops: users per transaction and pause between chunks
+BULK_CHUNK = int(os.getenv("BULK_CHUNK", "2000"))
+BULK_PAUSE_MS = int(os.getenv("BULK_PAUSE_MS", "20"))
+# SHI paid per level up the referral chain, direct referrer first (the
+# REFERRAL_TIERS setting overrides it)
+REFERRAL_TIERS = os.getenv("REFERRAL_TIERS", "0.5,0.2,0.1")
+
+# user sharding: with DB_SHARDS=N > 0, per-user tables (including guild
+# memberships) live in N files next to DB_PATH (<stem>-shard<i>.db) chosen by
+# a hash of user_id, and DB_PATH keeps the shared tables (settings, items,
+# guilds, referrals, conversation state)
+DB_SHARDS = int(os.getenv("DB_SHARDS", "0"))
+
+logger = logging.getLogger("SHI-DB")
 
-def _connect():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+# ----------------- connections -----------------
+# One long-lived connection per thread and file (sqlite3 connections must not
+# be used concurrently). Connections are opened lazily, tuned once, and reused
+# for the life of the thread so statement caches stay warm. _connect() returns
+# the connection for the file selected by _using() (DB_PATH by default), and
+# the first call in the process runs init_db() unless an entry point already did.
+_local = threading.local()
+_conns: List[sqlite3.Connection] = []
+_conns_lock = threading.Lock()
+_db_version: Optional[int] = None
+_init_lock = threading.Lock()
+
+def _open(path: str) -> sqlite3.Connection:
+    # autocommit at the driver level; write transactions are opened explicitly
+    # by transaction() so several operations can share one commit
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=DB_BUSY_TIMEOUT,
+                           cached_statements=256, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    # only takes effect on a new, empty file (so before journal_mode writes
+    # the header); existing files need enable_incremental_vacuum()
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def _current_path() -> str:
+    return getattr(_local, "path", None) or DB_PATH
+
+def _connect() -> sqlite3.Connection:
+    if _db_version is None and not getattr(_local, "migrating", False):
+        init_db()
+    path = _current_path()
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        conn = conns[path] = _open(path)
+        with _conns_lock:
+            _conns.append(conn)
     return conn
 
+# ----------------- sharding -----------------
+def shard_paths(n: Optional[int]=None, base: Optional[str]=None) -> List[str]:
+    """Files holding per-user tables: [DB_PATH] when unsharded."""
+    n = DB_SHARDS if n is None else n
+    base = base or DB_PATH
+    if n <= 0:
+        return [base]
+    stem, ext = os.path.splitext(base)
+    return [f"{stem}-shard{i}{ext or '.db'}" for i in range(n)]
+
+def shard_of(user_id: int, n: Optional[int]=None) -> int:
+    n = DB_SHARDS if n is None else n
+    return zlib.crc32(str(int(user_id)).encode()) % n if n > 0 else 0
+
+def _all_paths() -> List[str]:
+    return list(dict.fromkeys([DB_PATH] + shard_paths()))
+
+_SHARD_PATHS = shard_paths()
+
+@contextmanager
+def _using(path: str):
+    """Route _connect()/transaction() on this thread to path."""
+    prev = getattr(_local, "path", None)
+    _local.path = path
+    try:
+        yield
+    finally:
+        _local.path = prev
+
+def _user_db(user_id: int):
+    return _using(_SHARD_PATHS[shard_of(user_id)])
+
+def _global_db():
+    return _using(DB_PATH)
+
+def _per_user(fn):
+    """Run fn(user_id, ...) against user_id's shard."""
+    @functools.wraps(fn)
+    def wrapper(user_id, *args, **kwargs):
+        with _user_db(user_id):
+            return fn(user_id, *args, **kwargs)
+    return wrapper
+
+def _shards():
+    """Yield each shard's connection in turn, with _connect()/transaction()
+    routed to it while the caller's loop body runs (scatter-gather)."""
+    for path in _SHARD_PATHS:
+        with _using(path):
+            yield _connect()
+
+def _shared(fn):
+    """Run fn against the global file (shared tables)."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _global_db():
+            return fn(*args, **kwargs)
+    return wrapper
+
+@contextmanager
+def transaction():
+    """Unit of work: everything inside runs in one write transaction with a
+    single commit. Nested uses (including the public write functions below)
+    join the outermost transaction, so they compose atomically::
+
+        with database.transaction():
+            database.add_coins(uid, 10)
+            database.record_battle(uid, "NPC", True, 0.0, 10)
+    """
+    conn = _connect()
+    depth = getattr(_local, "depth", 0)
+    if depth:
+        if conn is not _local.tx_conn:
+            raise RuntimeError("a transaction cannot span database files (shards)")
+        _local.depth = depth + 1
+        try:
+            yield conn
+        finally:
+            _local.depth = depth
+        return
+    # take the write lock up front; a deferred read->write upgrade can fail
+    # with SQLITE_BUSY under WAL without honouring the busy timeout
+    if metrics.ENABLED:
+        t = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        _LOCK_WAIT.observe(time.perf_counter() - t)
+    else:
+        conn.execute("BEGIN IMMEDIATE")
+    _local.depth = 1
+    _local.tx_conn = conn
+    _local.hooks = hooks = []
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        _local.depth = 0
+        _local.tx_conn = None
+        _local.hooks = []
+    for fn in hooks:
+        try:
+            fn()
+        except Exception:
+            logger.exception("after-commit hook failed")
+
+_LOCK_WAIT = metrics.histogram("shi_db_write_lock_wait_seconds", "Time spent waiting in BEGIN IMMEDIATE")
+
+def close_connections():
+    """Close every pooled connection (call on shutdown or after fork)."""
+    with _conns_lock:
+        for c in _conns:
+            try:
+                c.close()
+            except sqlite3.Error:
+                pass
+        _conns.clear()
+    _local.__dict__.clear()
+
+def _after_commit(fn):
+    """Run fn once the enclosing transaction has committed (dropped on rollback)."""
+    _local.hooks.append(fn)
+
 def _column_exists(conn: sqlite3.Connection, table: str, col: str) -> bool:
     cur = conn.execute(f"PRAGMA table_info({table})")
     return any(r["name"] == col for r in cur.fetchall())
 
-def _init_db():
-    conn = _connect()
-    cur = conn.cursor()
-
+# ----------------- schema -----------------
+# Ordered migrations; PRAGMA user_version records the last one applied, so a
+# database that is already current skips all DDL on startup. Each step must be
+# idempotent (databases created before versioning start at 0).
+def _m1_base_schema(cur: sqlite3.Cursor):
     # users
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
@@ -117,7 +337,25 @@ def _init_db():
     )
     """)
 
-    conn.commit()
+    # leaderboard order
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_shi ON users(shi_balance DESC)")
+
+    # meta: change counters used to invalidate in-process caches
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS meta (
+      keyname TEXT PRIMARY KEY,
+      value INTEGER DEFAULT 0
+    )
+    """)
+    for table, key in (("settings", "settings_version"), ("items", "items_version")):
+        cur.execute("INSERT OR IGNORE INTO meta(keyname, value) VALUES(?, 0)", (key,))
+        for op in ("INSERT", "UPDATE", "DELETE"):
+            cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {key}_{op.lower()} AFTER {op} ON {table}
+            BEGIN
+              UPDATE meta SET value = value + 1 WHERE keyname='{key}';
+            END
+            """)
 
     # seed default settings and sample items
     cur.execute("INSERT OR IGNORE INTO settings(keyname, value) VALUES(?,?)", ("STARS_PER_SHI", os.getenv("STARS_PER_SHI","5")))
@@ -135,245 +373,1681 @@ def _init_db():
         ]
         cur.executemany("INSERT INTO items(name, power, price_shi) VALUES (?,?,?)", sample)
 
-    conn.commit()
-    conn.close()
+def _m2_hot_indexes(cur: sqlite3.Cursor):
+    # per-user history and membership lookups
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_ts ON transactions(user_id, ts)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_battles_user_ts ON battles(user_id, ts)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_guild_members_user ON guild_members(user_id)")
+
+def _m3_aggregates(cur: sqlite3.Cursor):
+    # O(1) totals for get_stats(), maintained by triggers so every writer
+    # (including the ledger flusher and external tools) keeps them current.
+    # Ledger counts are lifetime counts: deleting ledger rows leaves them alone.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS stats (
+      id INTEGER PRIMARY KEY CHECK (id = 1),
+      users INTEGER DEFAULT 0,
+      total_shi REAL DEFAULT 0,
+      total_coins INTEGER DEFAULT 0,
+      total_stars INTEGER DEFAULT 0,
+      transactions INTEGER DEFAULT 0,
+      battles INTEGER DEFAULT 0
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tx_counts (
+      type TEXT PRIMARY KEY,
+      n INTEGER DEFAULT 0,
+      amount REAL DEFAULT 0
+    )
+    """)
+    cur.execute("INSERT OR IGNORE INTO stats(id) VALUES(1)")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS stats_users_insert AFTER INSERT ON users
+    BEGIN
+      UPDATE stats SET users = users + 1, total_shi = total_shi + NEW.shi_balance,
+        total_coins = total_coins + NEW.coins, total_stars = total_stars + NEW.stars_balance WHERE id=1;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS stats_users_delete AFTER DELETE ON users
+    BEGIN
+      UPDATE stats SET users = users - 1, total_shi = total_shi - OLD.shi_balance,
+        total_coins = total_coins - OLD.coins, total_stars = total_stars - OLD.stars_balance WHERE id=1;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS stats_users_update AFTER UPDATE OF shi_balance, coins, stars_balance ON users
+    BEGIN
+      UPDATE stats SET total_shi = total_shi + NEW.shi_balance - OLD.shi_balance,
+        total_coins = total_coins + NEW.coins - OLD.coins,
+        total_stars = total_stars + NEW.stars_balance - OLD.stars_balance WHERE id=1;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS stats_transactions_insert AFTER INSERT ON transactions
+    BEGIN
+      UPDATE stats SET transactions = transactions + 1 WHERE id=1;
+      INSERT INTO tx_counts(type, n, amount) VALUES(NEW.type, 1, NEW.amount)
+        ON CONFLICT(type) DO UPDATE SET n = n + 1, amount = amount + excluded.amount;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS stats_battles_insert AFTER INSERT ON battles
+    BEGIN
+      UPDATE stats SET battles = battles + 1 WHERE id=1;
+    END
+    """)
+    _recompute_stats(cur)
+
+def _m4_last_daily_to_users(cur: sqlite3.Cursor):
+    # daily claims used to be stored as one settings row per user
+    cur.execute("""
+    UPDATE users SET last_daily = (
+      SELECT MAX(users.last_daily, CAST(value AS INTEGER)) FROM settings
+      WHERE keyname = 'user_' || users.user_id || '_last_daily')
+    WHERE EXISTS (SELECT 1 FROM settings WHERE keyname = 'user_' || users.user_id || '_last_daily')
+    """)
+    cur.execute(r"DELETE FROM settings WHERE keyname LIKE 'user\_%\_last\_daily' ESCAPE '\'")
+
+def _m5_conversation_state(cur: sqlite3.Cursor):
+    # short-lived per-user dialog state shared by every bot process
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS conversation_state (
+      key TEXT PRIMARY KEY,
+      value TEXT,
+      expires_at REAL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_conversation_state_expires ON conversation_state(expires_at)")
+
+def _m6_ledger_rollups(cur: sqlite3.Cursor):
+    # daily per-user summaries of ledger rows moved out by archive_ledger()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tx_daily (
+      day INTEGER,
+      user_id INTEGER,
+      type TEXT,
+      currency TEXT,
+      n INTEGER DEFAULT 0,
+      amount REAL DEFAULT 0,
+      PRIMARY KEY (user_id, day, type, currency)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS battle_daily (
+      day INTEGER,
+      user_id INTEGER,
+      n INTEGER DEFAULT 0,
+      wins INTEGER DEFAULT 0,
+      reward_shi REAL DEFAULT 0,
+      reward_coins INTEGER DEFAULT 0,
+      PRIMARY KEY (user_id, day)
+    ) WITHOUT ROWID
+    """)
+
+def _m7_user_power(cur: sqlite3.Cursor):
+    # cached total item power per user (sum of qty * items.power), kept current
+    # by buy_item so a battle never needs the inventory join
+    _add_column(cur, "users", "power", "INTEGER NOT NULL DEFAULT 0")
+    # items live in DB_PATH (migrated first); shard files only hold inventory
+    with _global_db():
+        powers = [tuple(r) for r in _connect().execute("SELECT id, power FROM items")]
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS _item_power(id INTEGER PRIMARY KEY, power INTEGER)")
+    cur.executemany("INSERT OR REPLACE INTO temp._item_power(id, power) VALUES(?,?)", powers)
+    cur.execute("""
+      UPDATE users SET power = (
+        SELECT COALESCE(SUM(i.qty * p.power), 0) FROM inventory i JOIN temp._item_power p ON p.id = i.item_id
+        WHERE i.user_id = users.user_id)
+      WHERE user_id IN (SELECT user_id FROM inventory)
+    """)
+    cur.execute("DROP TABLE temp._item_power")
+
+def _m8_guild_stats(cur: sqlite3.Cursor):
+    # per-guild totals kept by triggers, like stats. Memberships are per-user
+    # rows (they live in the member's shard), so each file holds partial
+    # totals over its own members and readers sum them across shards.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS guild_stats (
+      guild_id INTEGER PRIMARY KEY,
+      member_count INTEGER NOT NULL DEFAULT 0,
+      total_shi REAL NOT NULL DEFAULT 0,
+      total_power INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_guild_stats_shi ON guild_stats(total_shi DESC)")
+    # the WHERE true keeps SQLite from reading ON CONFLICT as a join constraint
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS guild_members_insert AFTER INSERT ON guild_members
+    BEGIN
+      INSERT INTO guild_stats(guild_id, member_count, total_shi, total_power)
+        SELECT NEW.guild_id, 1, COALESCE(u.shi_balance, 0), COALESCE(u.power, 0)
+        FROM (SELECT 1) LEFT JOIN users u ON u.user_id = NEW.user_id WHERE true
+        ON CONFLICT(guild_id) DO UPDATE SET member_count = member_count + 1,
+          total_shi = total_shi + excluded.total_shi, total_power = total_power + excluded.total_power;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS guild_members_delete AFTER DELETE ON guild_members
+    BEGIN
+      UPDATE guild_stats SET member_count = member_count - 1,
+        total_shi = total_shi - COALESCE((SELECT shi_balance FROM users WHERE user_id = OLD.user_id), 0),
+        total_power = total_power - COALESCE((SELECT power FROM users WHERE user_id = OLD.user_id), 0)
+      WHERE guild_id = OLD.guild_id;
+      DELETE FROM guild_stats WHERE guild_id = OLD.guild_id AND member_count <= 0;
+    END
+    """)
+    # one probe of idx_guild_members_user per balance change; a no-op for
+    # users without a guild
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS guild_users_update AFTER UPDATE OF shi_balance, power ON users
+    WHEN NEW.shi_balance != OLD.shi_balance OR NEW.power != OLD.power
+    BEGIN
+      UPDATE guild_stats SET total_shi = total_shi + NEW.shi_balance - OLD.shi_balance,
+        total_power = total_power + NEW.power - OLD.power
+      WHERE guild_id IN (SELECT guild_id FROM guild_members WHERE user_id = NEW.user_id);
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS guild_users_insert AFTER INSERT ON users
+    BEGIN
+      UPDATE guild_stats SET total_shi = total_shi + NEW.shi_balance, total_power = total_power + NEW.power
+      WHERE guild_id IN (SELECT guild_id FROM guild_members WHERE user_id = NEW.user_id);
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS guild_users_delete AFTER DELETE ON users
+    BEGIN
+      UPDATE guild_stats SET total_shi = total_shi - OLD.shi_balance, total_power = total_power - OLD.power
+      WHERE guild_id IN (SELECT guild_id FROM guild_members WHERE user_id = OLD.user_id);
+    END
+    """)
+    path = _current_path()
+    if DB_SHARDS > 0 and path != DB_PATH and _local.upgrading_from > 0:
+        # a shard from before version 8 kept its users' memberships in
+        # DB_PATH: move this shard's share over once. New files start empty.
+        with _global_db():
+            rows = [tuple(r) for r in _connect().execute("SELECT guild_id, user_id, joined_ts FROM guild_members")]
+        mine = [r for r in rows if _SHARD_PATHS[shard_of(r[1])] == path]
+        cur.executemany("INSERT OR IGNORE INTO guild_members(guild_id, user_id, joined_ts) VALUES(?,?,?)", mine)
+        # files cannot share a transaction: the moved rows leave DB_PATH once
+        # this shard has committed them
+        def forget():
+            with _global_db(), transaction() as conn:
+                conn.executemany("DELETE FROM guild_members WHERE guild_id=? AND user_id=?", [r[:2] for r in mine])
+        _after_commit(forget)
+    _rebuild_guild_stats(cur)
+
+def _rebuild_guild_stats(cur: sqlite3.Cursor):
+    cur.execute("DELETE FROM guild_stats")
+    cur.execute("""
+      INSERT INTO guild_stats(guild_id, member_count, total_shi, total_power)
+      SELECT m.guild_id, COUNT(*), COALESCE(SUM(u.shi_balance), 0), COALESCE(SUM(u.power), 0)
+      FROM guild_members m LEFT JOIN users u ON u.user_id = m.user_id
+      GROUP BY m.guild_id
+    """)
+
+def _m9_referral_closure(cur: sqlite3.Cursor):
+    # one referrer per user (the earliest row wins), and the ancestor closure
+    # of the referral forest so reward tiers and tree stats are index reads
+    cur.execute("DELETE FROM referrals WHERE id NOT IN (SELECT MIN(id) FROM referrals GROUP BY referred)")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_referrals_referred ON referrals(referred)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS referral_paths (
+      ancestor INTEGER NOT NULL,
+      descendant INTEGER NOT NULL,
+      depth INTEGER NOT NULL,
+      PRIMARY KEY (descendant, ancestor)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_referral_paths_ancestor ON referral_paths(ancestor, depth)")
+    _rebuild_referral_paths(cur)
+
+def _rebuild_referral_paths(cur: sqlite3.Cursor):
+    # one recursive walk over the whole forest; the depth bound only matters
+    # if older rows happen to form a cycle
+    cur.execute("DELETE FROM referral_paths")
+    cur.execute("""
+      WITH RECURSIVE chain(ancestor, descendant, depth) AS (
+        SELECT referrer, referred, 1 FROM referrals WHERE referrer != referred
+        UNION
+        SELECT r.referrer, c.descendant, c.depth + 1 FROM chain c JOIN referrals r ON r.referred = c.ancestor
+        WHERE r.referrer != c.descendant AND c.depth < (SELECT COUNT(*) FROM referrals)
+      )
+      INSERT INTO referral_paths(ancestor, descendant, depth)
+      SELECT ancestor, descendant, MIN(depth) FROM chain GROUP BY ancestor, descendant
+    """)
+
+def _m10_board_log(cur: sqlite3.Cursor):
+    # the users whose balance or name changed, newest last, one row each, so a
+    # process can catch its in-memory leaderboard up on other processes'
+    # writes without rescanning users. seq is read before REPLACE drops the
+    # user's old row, and writers are serialized per file, so it only grows.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS board_log (
+      seq INTEGER PRIMARY KEY,
+      user_id INTEGER NOT NULL UNIQUE
+    )
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS board_log_users_update AFTER UPDATE OF shi_balance, username ON users
+    WHEN NEW.shi_balance IS NOT OLD.shi_balance OR NEW.username IS NOT OLD.username
+    BEGIN
+      INSERT OR REPLACE INTO board_log(seq, user_id)
+        VALUES((SELECT COALESCE(MAX(seq), 0) + 1 FROM board_log), NEW.user_id);
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS board_log_users_insert AFTER INSERT ON users
+    BEGIN
+      INSERT OR REPLACE INTO board_log(seq, user_id)
+        VALUES((SELECT COALESCE(MAX(seq), 0) + 1 FROM board_log), NEW.user_id);
+    END
+    """)
+
+MIGRATIONS = [
+    (1, _m1_base_schema),
+    (2, _m2_hot_indexes),
+    (3, _m3_aggregates),
+    (4, _m4_last_daily_to_users),
+    (5, _m5_conversation_state),
+    (6, _m6_ledger_rollups),
+    (7, _m7_user_power),
+    (8, _m8_guild_stats),
+    (9, _m9_referral_closure),
+    (10, _m10_board_log),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def _add_column(cur: sqlite3.Cursor, table: str, col: str, decl: str):
+    if not _column_exists(cur.connection, table, col):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {col} {decl}")
+
+def schema_version() -> int:
+    return _connect().execute("PRAGMA user_version").fetchone()[0]
+
+def _migrate_file(path: str) -> int:
+    with _using(path):
+        current = schema_version()
+        if current >= SCHEMA_VERSION:
+            return current
+        # steps that move data between files check this (0 = a new file)
+        _local.upgrading_from = current
+        for version, step in MIGRATIONS:
+            if version <= current:
+                continue
+            with transaction() as conn:
+                # re-check under the write lock: another process may have got here first
+                if schema_version() >= version:
+                    continue
+                step(conn.cursor())
+                conn.execute(f"PRAGMA user_version={version}")
+            logger.info("%s migrated to schema version %d", path, version)
+        return schema_version()
+
+def migrate() -> int:
+    """Apply pending migrations in order, one transaction each, to DB_PATH and
+    every shard. Every file gets the full schema; shards only use the per-user
+    tables and DB_PATH only the shared ones. Returns the schema version."""
+    return min(_migrate_file(path) for path in _all_paths())
 
-_init_db()
+def init_db() -> int:
+    """Make the database usable: migrate every file once per process. When
+    the files are current this is one PRAGMA user_version read per file and
+    no DDL. Safe to call from any thread, any number of times; returns the
+    schema version."""
+    global _db_version
+    if _db_version is None:
+        with _init_lock:
+            if _db_version is None:
+                t = time.perf_counter()
+                _local.migrating = True
+                try:
+                    version = migrate()
+                finally:
+                    _local.migrating = False
+                logger.info("database ready: schema version %d, %d file(s), %.1f ms",
+                            version, len(_all_paths()), (time.perf_counter() - t) * 1000)
+                metrics.startup_mark("db_ready")
+                _db_version = version
+    return _db_version
 
 # ----------------- helpers -----------------
 def _row_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
     return {k: row[k] for k in row.keys()}
 
+# ----------------- ledger -----------------
+_TX_SQL = "INSERT INTO transactions(user_id, type, amount, currency, meta, ts) VALUES(?,?,?,?,?,?)"
+_BATTLE_SQL = "INSERT INTO battles(user_id, opponent, win, reward_shi, reward_coins, ts) VALUES(?,?,?,?,?,?)"
+_STOP = object()
+
+class LedgerWriter:
+    """Write-behind queue for append-only ledger rows. Rows are collected on a
+    bounded queue and flushed by one background thread with executemany, one
+    commit per batch, when LEDGER_BATCH_SIZE rows are waiting or
+    LEDGER_FLUSH_MS has passed. A full queue blocks producers (backpressure)
+    for up to LEDGER_PUT_TIMEOUT, after which the row is written inline."""
+
+    def __init__(self, batch_size: int=LEDGER_BATCH_SIZE, flush_ms: int=LEDGER_FLUSH_MS,
+                 maxsize: int=LEDGER_QUEUE_MAX, durability: str=LEDGER_DURABILITY, retries: int=5):
+        if durability not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError(f"invalid LEDGER_DURABILITY: {durability}")
+        self.batch_size = batch_size
+        self.interval = flush_ms / 1000.0
+        self.durability = durability
+        self.retries = retries
+        self._q: "queue.Queue" = queue.Queue(maxsize=maxsize)
+        self._tuned = set()  # files whose writer connection has the durability pragma
+        self._thread = threading.Thread(target=self._run, name="ledger-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, path: str, sql: str, params: tuple):
+        try:
+            self._q.put((path, sql, params), timeout=LEDGER_PUT_TIMEOUT)
+        except queue.Full:
+            logger.warning("ledger queue full; writing row inline")
+            with _using(path), transaction() as conn:
+                conn.execute(sql, params)
+
+    def depth(self) -> int:
+        return self._q.qsize()
+
+    def flush(self):
+        """Block until every queued row has been committed."""
+        self._q.join()
+
+    def stop(self):
+        """Flush what is queued and stop the writer thread."""
+        if self._thread.is_alive():
+            self._q.put(_STOP)
+            self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._q.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._q.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            rows = [b for b in batch if b is not _STOP]
+            stopping = len(rows) != len(batch)
+            if rows:
+                self._write(rows)
+            for _ in batch:
+                self._q.task_done()
+
+    def _write(self, rows: List[tuple]):
+        # one commit per file (shard) touched by the batch
+        by_path: Dict[str, Dict[str, List[tuple]]] = {}
+        for path, sql, params in rows:
+            by_path.setdefault(path, {}).setdefault(sql, []).append(params)
+        for path, by_sql in by_path.items():
+            with _using(path):
+                if path not in self._tuned:
+                    _connect().execute(f"PRAGMA synchronous={self.durability}")
+                    self._tuned.add(path)
+                self._write_file(by_sql)
+
+    def _write_file(self, by_sql: Dict[str, List[tuple]]):
+        for attempt in range(self.retries):
+            try:
+                with transaction() as conn:
+                    for sql, params in by_sql.items():
+                        conn.executemany(sql, params)
+                return
+            except sqlite3.Error:
+                logger.exception("ledger flush failed (attempt %d)", attempt + 1)
+                time.sleep(min(2 ** attempt * 0.1, 2))
+        n = sum(len(p) for p in by_sql.values())
+        logger.error("dropping %d ledger rows after %d attempts", n, self.retries)
+
+_ledger: Optional[LedgerWriter] = None
+_ledger_lock = threading.Lock()
+
+def _ledger_writer() -> LedgerWriter:
+    global _ledger
+    if _ledger is None:
+        with _ledger_lock:
+            if _ledger is None:
+                _ledger = LedgerWriter()
+    return _ledger
+
+def _append(cur: sqlite3.Cursor, sql: str, params: tuple):
+    if LEDGER_MODE == "group":
+        # queue only once the balance change it describes has committed
+        path = getattr(_local, "path", None) or DB_PATH
+        _after_commit(lambda: _ledger_writer().put(path, sql, params))
+    else:
+        cur.execute(sql, params)
+
+def _log_tx(cur: sqlite3.Cursor, user_id: int, type_: str, amount: float, currency: str, meta: str):
+    _append(cur, _TX_SQL, (user_id, type_, amount, currency, meta, int(time.time())))
+
+def flush_ledger():
+    """Commit every queued ledger row (no-op in direct mode)."""
+    if _ledger is not None:
+        _ledger.flush()
+
+def stop_ledger():
+    global _ledger
+    if _ledger is not None:
+        _ledger.stop()
+        _ledger = None
+
+atexit.register(stop_ledger)
+
+@_shared
+def _meta_version(key: str) -> int:
+    row = _connect().execute("SELECT value FROM meta WHERE keyname=?", (key,)).fetchone()
+    return int(row["value"]) if row else 0
+
+class _VersionedCache:
+    """Process-wide copy of a small, rarely written table. Writers in this
+    process drop it after commit; writes from other processes are noticed via
+    a meta counter bumped by triggers, probed at most every `interval` seconds."""
+
+    def __init__(self, meta_key: str, load, interval: float):
+        self.meta_key = meta_key
+        self.version = -1
+        self._load = load
+        self._interval = interval
+        self._value = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.gets = 0
+        self.reloads = 0
+
+    def get(self):
+        self.gets += 1
+        value = self._value
+        if value is None:
+            return self._reload()
+        now = time.monotonic()
+        if now - self._checked >= self._interval:
+            self._checked = now
+            if _meta_version(self.meta_key) != self.version:
+                return self._reload()
+        return value
+
+    def invalidate(self):
+        self._value = None
+
+    def _reload(self):
+        with self._lock, _global_db():
+            # read the version first: a change racing the load only causes a reload
+            version = _meta_version(self.meta_key)
+            value = self._load(_connect())
+            self._value, self.version, self._checked = value, version, time.monotonic()
+            self.reloads += 1
+            return value
+
 # ----------------- settings -----------------
+# Settings are read on hot paths but rarely change, so they are served from
+# memory and invalidated through meta.settings_version.
+def _load_settings(conn: sqlite3.Connection) -> Dict[str, str]:
+    return {r["keyname"]: r["value"] for r in conn.execute("SELECT keyname, value FROM settings")}
+
+_settings = _VersionedCache("settings_version", _load_settings, SETTINGS_CHECK_INTERVAL)
+
+def get_settings() -> Dict[str, str]:
+    return _settings.get()
+
+def invalidate_settings():
+    _settings.invalidate()
+
 def get_setting(key: str, default: Optional[str]=None) -> str:
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("SELECT value FROM settings WHERE keyname=?", (key,))
-    row = cur.fetchone()
-    conn.close()
-    return row["value"] if row else (default if default is not None else "")
+    value = get_settings().get(key)
+    if value is not None:
+        return value
+    return default if default is not None else ""
 
+@_shared
 def set_setting(key: str, value: str):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO settings(keyname, value) VALUES(?,?) ON CONFLICT(keyname) DO UPDATE SET value=excluded.value", (key, value))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO settings(keyname, value) VALUES(?,?) ON CONFLICT(keyname) DO UPDATE SET value=excluded.value", (key, value))
+        _after_commit(_settings.invalidate)
+
+# ----------------- leaderboard -----------------
+class _SortedKeys:
+    """Sorted keys split into buckets of at most 2*load, with a Fenwick tree
+    over the bucket sizes, so add, remove and bisect_left cost O(log n) plus
+    one short list shift instead of moving the whole list."""
+
+    def __init__(self, keys=(), load: int=512):
+        keys = list(keys)  # already sorted
+        self._load = load
+        self._lists = [keys[i:i + load] for i in range(0, len(keys), load)]
+        self._reindex()
+
+    def _reindex(self):
+        # after a bucket is split or dropped
+        self._maxes = [b[-1] for b in self._lists]
+        n = len(self._lists)
+        tree = [0] * (n + 1)
+        for i, b in enumerate(self._lists, 1):
+            tree[i] += len(b)
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self._tree = tree
+        self._len = sum(len(b) for b in self._lists)
+
+    def _bump(self, i: int, delta: int):
+        i += 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _before(self, i: int) -> int:
+        # keys held by buckets [0, i)
+        n = 0
+        while i:
+            n += self._tree[i]
+            i -= i & -i
+        return n
+
+    def __len__(self) -> int:
+        return self._len
+
+    def add(self, key):
+        if not self._lists:
+            self._lists.append([key])
+            self._reindex()
+            return
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+            self._lists[i].append(key)
+            self._maxes[i] = key
+        else:
+            bisect.insort(self._lists[i], key)
+        if len(self._lists[i]) > 2 * self._load:
+            b = self._lists[i]
+            self._lists[i:i + 1] = [b[:self._load], b[self._load:]]
+            self._reindex()
+        else:
+            self._len += 1
+            self._bump(i, 1)
+
+    def remove(self, key) -> bool:
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return False
+        b = self._lists[i]
+        j = bisect.bisect_left(b, key)
+        if b[j] != key:
+            return False
+        del b[j]
+        if not b:
+            del self._lists[i]
+            self._reindex()
+        else:
+            self._maxes[i] = b[-1]
+            self._len -= 1
+            self._bump(i, -1)
+        return True
+
+    def bisect_left(self, key) -> int:
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return self._len
+        return self._before(i) + bisect.bisect_left(self._lists[i], key)
+
+    def head(self, n: int) -> list:
+        return list(itertools.islice(itertools.chain.from_iterable(self._lists), n))
+
+class _Leaderboard:
+    """All users ordered by SHI balance, kept as (-balance, user_id) keys in a
+    _SortedKeys so a balance change, a rank and top-K are each O(log n).
+    Built once from an idx_users_shi scan (merged across shards), then
+    updated after each committed balance change. Every LEADERBOARD_RESYNC
+    seconds a background catch-up reads just the users board_log lists as
+    changed since the last read, to pick up other processes' writes. SQLite
+    is read without the board lock; updates published meanwhile are replayed
+    onto the result."""
+
+    def __init__(self):
+        self._keys = _SortedKeys()
+        self._balance: Dict[int, float] = {}
+        self._names: Dict[int, str] = {}
+        # newest _user_seq published per user, so a late hook can't go back
+        self._seq: Dict[int, int] = {}
+        # last board_log seq read per shard file
+        self._marks: Dict[str, int] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()  # one SQLite read at a time
+        # updates published while SQLite is being read, replayed onto its result
+        self._pending: Optional[List[tuple]] = None
+
+    def _ensure(self):
+        loaded = self._loaded_at
+        if loaded is None:
+            self._build_lock.acquire()
+            if self._loaded_at is None:
+                self._rebuild()
+            else:  # another reader rebuilt it while we waited
+                self._build_lock.release()
+        elif LEADERBOARD_RESYNC and time.monotonic() - loaded > LEADERBOARD_RESYNC:
+            if self._build_lock.acquire(blocking=False):
+                threading.Thread(target=self._catch_up, name="leaderboard-resync", daemon=True).start()
+
+    def load(self):
+        """Rebuild from SQLite now, waiting for a read already running."""
+        self._build_lock.acquire()
+        self._rebuild()
+
+    def _read(self, read, apply):
+        # caller holds _build_lock; released here
+        try:
+            with self._lock:
+                self._pending = []
+            try:
+                result = read()
+            except BaseException:
+                with self._lock:
+                    self._pending = None
+                raise
+            with self._lock:
+                pending, self._pending = self._pending, None
+                apply(result)
+                self._loaded_at = time.monotonic()
+                for args in pending:
+                    self.update(*args)
+        finally:
+            self._build_lock.release()
+
+    def _rebuild(self):
+        def read():
+            marks, streams = {}, []
+            for conn in _shards():
+                # mark first: anything committed after it is caught up later
+                marks[_current_path()] = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM board_log").fetchone()[0]
+                streams.append((-float(r["shi_balance"] or 0), r["user_id"], r["username"]) for r in conn.execute(
+                    "SELECT user_id, username, shi_balance FROM users ORDER BY shi_balance DESC, user_id"))
+            keys: List[Tuple[float, int]] = []
+            balance: Dict[int, float] = {}
+            names: Dict[int, str] = {}
+            for neg, uid, name in heapq.merge(*streams):
+                keys.append((neg, uid))
+                balance[uid] = -neg
+                names[uid] = name
+            return marks, keys, balance, names
+        def apply(result):
+            self._marks, keys, self._balance, self._names = result
+            self._keys = _SortedKeys(keys)
+        self._read(read, apply)
+
+    def _catch_up(self):
+        def read():
+            marks, rows = dict(self._marks), []
+            for conn in _shards():
+                path = _current_path()
+                for r in conn.execute("""
+                  SELECT l.seq, u.user_id, u.username, u.shi_balance FROM board_log l
+                  JOIN users u ON u.user_id = l.user_id WHERE l.seq > ? ORDER BY l.seq
+                """, (marks.get(path, 0),)):
+                    rows.append((r["user_id"], float(r["shi_balance"] or 0), r["username"] or ""))
+                    marks[path] = r["seq"]
+            return marks, rows
+        def apply(result):
+            self._marks, rows = result
+            for uid, balance, name in rows:
+                self._set(uid, balance, name)
+        self._read(read, apply)
+
+    def _set(self, user_id: int, balance: float, username: Optional[str]):
+        if username is not None or user_id not in self._names:
+            self._names[user_id] = username or self._names.get(user_id, "")
+        old = self._balance.get(user_id)
+        if old == balance:
+            return
+        if old is not None:
+            self._keys.remove((-old, user_id))
+        self._balance[user_id] = balance
+        self._keys.add((-balance, user_id))
+
+    def update(self, user_id: int, balance: Optional[float]=None, username: Optional[str]=None, seq: int=0):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((user_id, balance, username, seq))
+            if seq:
+                if seq < self._seq.get(user_id, 0):
+                    return
+                self._seq[user_id] = seq
+            if self._loaded_at is None:
+                return
+            if balance is None:
+                balance = self._balance.get(user_id, 0.0)
+            self._set(user_id, float(balance), username)
+
+    def invalidate(self):
+        """Drop the in-memory order; the next read rebuilds it from SQLite."""
+        with self._lock:
+            self._loaded_at = None
+
+    def top(self, limit: int) -> List[Dict[str, Any]]:
+        self._ensure()
+        with self._lock:
+            return [{"user_id": uid, "username": self._names.get(uid, ""), "shi_balance": -neg}
+                    for neg, uid in self._keys.head(limit)]
+
+    def rank(self, user_id: int) -> Optional[int]:
+        """1-based rank; users with equal balances share a rank."""
+        self._ensure()
+        with self._lock:
+            bal = self._balance.get(user_id)
+            if bal is None:
+                return None
+            return self._keys.bisect_left((-bal,)) + 1
+
+_board = _Leaderboard()
+
+# ----------------- user cache -----------------
+_USER_FIELDS = ("user_id", "username", "shi_balance", "level", "exp",
+                "stars_balance", "coins", "last_daily", "banned", "power")
+
+class UserRecord:
+    __slots__ = _USER_FIELDS + ("seq", "loaded_at")
+
+    def __init__(self, row: sqlite3.Row, seq: int):
+        for f in _USER_FIELDS:
+            setattr(self, f, row[f])
+        # RETURNING hands integral REALs back as int; match what SELECT returns
+        if self.shi_balance is not None:
+            self.shi_balance = float(self.shi_balance)
+        self.seq = seq
+        self.loaded_at = time.monotonic()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {f: getattr(self, f) for f in _USER_FIELDS}
+
+class _UserCache:
+    """Bounded LRU of user rows. Writers put the row returned by their UPDATE
+    after commit (write-through); each carries a sequence number taken while
+    holding the write lock, so a late hook can't overwrite a newer row.
+    Rows read on a miss are only stored if nothing newer got there first."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[int, UserRecord]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> Optional[UserRecord]:
+        with self._lock:
+            rec = self._data.get(user_id)
+            if rec is None or (self.ttl and time.monotonic() - rec.loaded_at > self.ttl):
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return rec
+
+    def put(self, rec: UserRecord, if_absent: bool=False):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            old = self._data.get(rec.user_id)
+            if old is not None and (if_absent or old.seq > rec.seq):
+                if not (self.ttl and time.monotonic() - old.loaded_at > self.ttl):
+                    return
+            self._data[rec.user_id] = rec
+            self._data.move_to_end(rec.user_id)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def refresh(self, rec: UserRecord):
+        """Replace a cached row, but don't add users that aren't cached."""
+        with self._lock:
+            old = self._data.get(rec.user_id)
+            if old is not None and old.seq < rec.seq:
+                self._data[rec.user_id] = rec
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data), "maxsize": self.maxsize}
+
+_users = _UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+_user_seq = itertools.count(1)
+
+def _user_changed(row: Optional[sqlite3.Row], username_changed: bool=False):
+    """Publish a user row written in the current transaction to the cache and
+    leaderboard once it commits. Call with the row from UPDATE ... RETURNING *."""
+    if row is None:
+        return
+    rec = UserRecord(row, next(_user_seq))
+    def publish():
+        _users.put(rec)
+        _board.update(rec.user_id, rec.shi_balance, rec.username if username_changed else None, rec.seq)
+    _after_commit(publish)
+
+def user_cache_stats() -> Dict[str, int]:
+    return _users.stats()
 
 # ----------------- users -----------------
-def register_user(user_id: int, username: Optional[str]=None):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM users WHERE user_id=?", (user_id,))
-    if cur.fetchone() is None:
-        cur.execute("INSERT INTO users(user_id, username) VALUES(?,?)", (user_id, username or ""))
-        conn.commit()
-    else:
-        if username:
-            cur.execute("UPDATE users SET username=? WHERE user_id=?", (username, user_id))
-            conn.commit()
-    conn.close()
+@_per_user
+def register_user(user_id: int, username: Optional[str]=None) -> bool:
+    """Create the user row if missing and keep the username current. Returns
+    True only when the user is new."""
+    cached = _users.get(user_id)
+    if cached is not None and (not username or cached.username == username):
+        return False
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT OR IGNORE INTO users(user_id, username) VALUES(?,?) RETURNING *", (user_id, username or ""))
+        row = cur.fetchone()
+        created = row is not None
+        if row is None and username:
+            cur.execute("UPDATE users SET username=? WHERE user_id=? RETURNING *", (username, user_id))
+            row = cur.fetchone()
+        _user_changed(row, username_changed=True)
+    return created
 
+@_per_user
 def get_user_safe(user_id: int) -> Dict[str, Any]:
+    rec = _users.get(user_id)
+    if rec is not None:
+        return rec.to_dict()
     conn = _connect()
     cur = conn.cursor()
     cur.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
     row = cur.fetchone()
     if row is None:
         # auto-register with defaults
-        cur.execute("INSERT INTO users(user_id, username) VALUES (?,?)", (user_id, ""))
-        conn.commit()
-        cur.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-    d = _row_to_dict(row)
-    conn.close()
-    return d
+        with transaction():
+            cur.execute("INSERT OR IGNORE INTO users(user_id, username) VALUES (?,?)", (user_id, ""))
+            cur.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
+            row = cur.fetchone()
+            _user_changed(row, username_changed=True)
+    else:
+        _users.put(UserRecord(row, 0), if_absent=True)
+    return _row_to_dict(row)
 
 # alias for older code
 get_user = get_user_safe
 
+@_per_user
 def update_shi(user_id: int, delta: float):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET shi_balance = shi_balance + ? WHERE user_id=?", (float(delta), user_id))
-    cur.execute("INSERT INTO transactions(user_id, type, amount, currency, meta, ts) VALUES(?,?,?,?,?,?)",
-                (user_id, "shi_update", float(delta), "SHI", "update_shi", int(time.time())))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET shi_balance = shi_balance + ? WHERE user_id=? RETURNING *", (float(delta), user_id))
+        _user_changed(cur.fetchone())
+        _log_tx(cur, user_id, "shi_update", float(delta), "SHI", "update_shi")
 
+@_per_user
 def set_shi(user_id: int, new_amount: float):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET shi_balance = ? WHERE user_id=?", (float(new_amount), user_id))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET shi_balance = ? WHERE user_id=? RETURNING *", (float(new_amount), user_id))
+        _user_changed(cur.fetchone())
 
+@_per_user
 def update_stars(user_id: int, delta: float):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET stars_balance = stars_balance + ? WHERE user_id=?", (float(delta), user_id))
-    cur.execute("INSERT INTO transactions(user_id, type, amount, currency, meta, ts) VALUES(?,?,?,?,?,?)",
-                (user_id, "stars_update", float(delta), "XTR", "update_stars", int(time.time())))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET stars_balance = stars_balance + ? WHERE user_id=? RETURNING *", (float(delta), user_id))
+        _user_changed(cur.fetchone())
+        _log_tx(cur, user_id, "stars_update", float(delta), "XTR", "update_stars")
 
+@_per_user
 def add_coins(user_id: int, delta: int):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET coins = coins + ? WHERE user_id=?", (int(delta), user_id))
-    cur.execute("INSERT INTO transactions(user_id, type, amount, currency, meta, ts) VALUES(?,?,?,?,?,?)",
-                (user_id, "coins_add", delta, "COINS", f"add_coins:{delta}", int(time.time())))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET coins = coins + ? WHERE user_id=? RETURNING *", (int(delta), user_id))
+        _user_changed(cur.fetchone())
+        _log_tx(cur, user_id, "coins_add", delta, "COINS", f"add_coins:{delta}")
 
+@_per_user
 def set_coins(user_id: int, newval: int):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET coins = ? WHERE user_id=?", (int(newval), user_id))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET coins = ? WHERE user_id=? RETURNING *", (int(newval), user_id))
+        _user_changed(cur.fetchone())
 
 def get_leaderboard(limit: int=10) -> List[Dict[str,Any]]:
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, username, shi_balance FROM users ORDER BY shi_balance DESC LIMIT ?", (limit,))
-    rows = cur.fetchall()
-    conn.close()
-    return [_row_to_dict(r) for r in rows]
+    return _board.top(limit)
+
+def get_rank(user_id: int) -> Optional[int]:
+    """Position of user_id on the SHI leaderboard (1 = richest), or None."""
+    return _board.rank(user_id)
 
 # ----------------- items / shop -----------------
+# The catalog is read on every shop open and changes only through add_item.
+def _load_catalog(conn: sqlite3.Connection) -> Tuple[Dict[str, Any], ...]:
+    return tuple(_row_to_dict(r) for r in conn.execute("SELECT * FROM items ORDER BY id ASC"))
+
+_catalog = _VersionedCache("items_version", _load_catalog, CATALOG_CHECK_INTERVAL)
+
+def get_catalog() -> Tuple[int, Tuple[Dict[str, Any], ...]]:
+    """Return (version, items) from the catalog cache. The items are shared:
+    treat them as read-only. The version changes whenever the catalog does."""
+    items = _catalog.get()
+    return _catalog.version, items
+
 def get_items() -> List[Dict[str,Any]]:
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM items ORDER BY id ASC")
-    rows = cur.fetchall()
-    conn.close()
-    return [_row_to_dict(r) for r in rows]
+    return [dict(it) for it in _catalog.get()]
 
+@_shared
 def add_item(name: str, power: int, price_shi: float):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO items(name, power, price_shi) VALUES(?,?,?)", (name, int(power), float(price_shi)))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO items(name, power, price_shi) VALUES(?,?,?)", (name, int(power), float(price_shi)))
+        _after_commit(_catalog.invalidate)
 
+@_per_user
 def buy_item(user_id: int, item_id: int) -> bool:
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("SELECT price_shi FROM items WHERE id=?", (item_id,))
-    r = cur.fetchone()
-    if r is None:
-        conn.close()
+    # price from the catalog cache: items live in the shared file, not the user's shard
+    item = next((it for it in _catalog.get() if it["id"] == item_id), None)
+    if item is None:
         return False
-    price = float(r["price_shi"])
-    cur.execute("SELECT shi_balance FROM users WHERE user_id=?", (user_id,))
-    u = cur.fetchone()
-    if u is None or float(u["shi_balance"]) < price:
-        conn.close()
-        return False
-    # deduct & add to inventory
-    cur.execute("UPDATE users SET shi_balance = shi_balance - ? WHERE user_id=?", (price, user_id))
-    cur.execute("""
-      INSERT INTO inventory(user_id, item_id, qty)
-      VALUES(?,?,1)
-      ON CONFLICT(user_id, item_id) DO UPDATE SET qty = qty + 1
-    """, (user_id, item_id))
-    cur.execute("INSERT INTO transactions(user_id, type, amount, currency, meta, ts) VALUES(?,?,?,?,?,?)",
-                (user_id, "buy_item", price, "SHI", f"item_id:{item_id}", int(time.time())))
-    conn.commit()
-    conn.close()
+    price = float(item["price_shi"])
+    with transaction() as conn:
+        cur = conn.cursor()
+        # deduct (only if affordable), bump cached power & add to inventory
+        cur.execute("""
+          UPDATE users SET shi_balance = shi_balance - ?, power = power + ?
+          WHERE user_id=? AND shi_balance >= ? RETURNING *
+        """, (price, int(item["power"]), user_id, price))
+        u = cur.fetchone()
+        if u is None:
+            return False
+        _user_changed(u)
+        cur.execute("""
+          INSERT INTO inventory(user_id, item_id, qty)
+          VALUES(?,?,1)
+          ON CONFLICT(user_id, item_id) DO UPDATE SET qty = qty + 1
+        """, (user_id, item_id))
+        _log_tx(cur, user_id, "buy_item", price, "SHI", f"item_id:{item_id}")
     return True
 
 # ----------------- battles / coins -> SHI -----------------
+@_per_user
 def record_battle(user_id:int, opponent:str, win:bool, reward_shi:float, reward_coins:int):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO battles(user_id, opponent, win, reward_shi, reward_coins, ts) VALUES(?,?,?,?,?,?)",
-                (user_id, opponent, int(win), float(reward_shi), int(reward_coins), int(time.time())))
-    conn.commit()
-    conn.close()
+    params = (user_id, opponent, int(win), float(reward_shi), int(reward_coins), int(time.time()))
+    if LEDGER_MODE == "group" and not getattr(_local, "depth", 0):
+        # the ledger row is the only write: queue it without a transaction
+        _ledger_writer().put(getattr(_local, "path", None) or DB_PATH, _BATTLE_SQL, params)
+        return
+    with transaction() as conn:
+        _append(conn.cursor(), _BATTLE_SQL, params)
+
+def get_fighters(user_ids) -> List[Tuple[int, int, int]]:
+    """(user_id, level, power) for each known, unbanned user in user_ids, in
+    no particular order. One query per shard."""
+    ids = json.dumps([int(u) for u in user_ids])
+    return [tuple(r) for conn in _shards() for r in conn.execute(
+        "SELECT user_id, level, power FROM users WHERE user_id IN (SELECT value FROM json_each(?)) AND banned = 0",
+        (ids,))]
 
+def record_battles(rows, ts: Optional[int]=None) -> int:
+    """Bulk-insert (user_id, opponent, win, reward_shi, reward_coins) battle
+    rows: one executemany per shard, bypassing the group-commit queue.
+    Returns the number of rows written."""
+    ts = int(time.time()) if ts is None else int(ts)
+    by_path: Dict[str, List[tuple]] = {}
+    for user_id, opponent, win, reward_shi, reward_coins in rows:
+        by_path.setdefault(_SHARD_PATHS[shard_of(user_id)], []).append(
+            (int(user_id), opponent, int(win), float(reward_shi), int(reward_coins), ts))
+    for path, batch in by_path.items():
+        with _using(path), transaction() as conn:
+            conn.executemany(_BATTLE_SQL, batch)
+    return sum(len(b) for b in by_path.values())
+
+@_per_user
 def coins_to_shi_convert(user_id:int, coins_per_shi:int=100, shi_per_chunk:float=0.01):
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("SELECT coins FROM users WHERE user_id=?", (user_id,))
-    r = cur.fetchone()
-    if not r:
-        conn.close()
-        return 0.0
-    coins = int(r["coins"])
-    chunks = coins // coins_per_shi
-    if chunks <= 0:
-        conn.close()
-        return 0.0
-    shi_to_add = chunks * shi_per_chunk
-    remaining = coins % coins_per_shi
-    cur.execute("UPDATE users SET coins = ? WHERE user_id=?", (remaining, user_id))
-    cur.execute("UPDATE users SET shi_balance = shi_balance + ? WHERE user_id=?", (shi_to_add, user_id))
-    cur.execute("INSERT INTO transactions(user_id, type, amount, currency, meta, ts) VALUES(?,?,?,?,?,?)",
-                (user_id, "coins_convert", shi_to_add, "SHI", f"coins->{shi_to_add}", int(time.time())))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT coins FROM users WHERE user_id=?", (user_id,))
+        r = cur.fetchone()
+        if not r:
+            return 0.0
+        coins = int(r["coins"])
+        chunks = coins // coins_per_shi
+        if chunks <= 0:
+            return 0.0
+        shi_to_add = chunks * shi_per_chunk
+        remaining = coins % coins_per_shi
+        cur.execute("UPDATE users SET coins = ?, shi_balance = shi_balance + ? WHERE user_id=? RETURNING *",
+                    (remaining, shi_to_add, user_id))
+        _user_changed(cur.fetchone())
+        _log_tx(cur, user_id, "coins_convert", shi_to_add, "SHI", f"coins->{shi_to_add}")
     return shi_to_add
 
+@_per_user
+def battle_outcome(user_id:int, opponent:str, win:bool, reward_coins:int,
+                   coins_per_shi:int=100, shi_per_chunk:float=0.01) -> float:
+    """Credit battle coins, convert full coin chunks to SHI and log the battle
+    in a single transaction. Returns the SHI gained from the conversion."""
+    with transaction():
+        add_coins(user_id, reward_coins)
+        shi_from_coins = coins_to_shi_convert(user_id, coins_per_shi=coins_per_shi, shi_per_chunk=shi_per_chunk)
+        record_battle(user_id, opponent, win, shi_from_coins, reward_coins)
+    return shi_from_coins
+
+# ----------------- daily reward -----------------
+DAILY_COOLDOWN = 24 * 3600
+
+@_per_user
+def claim_daily(user_id: int, now: Optional[int]=None) -> Optional[Tuple[float, int]]:
+    """Atomically claim the daily reward: one conditional UPDATE on
+    users.last_daily credits SHI and coins, plus the ledger rows, in a single
+    transaction. Returns (shi, coins), or None if claimed within 24h."""
+    now = int(now if now is not None else time.time())
+    settings = get_settings()
+    shi = float(settings.get("DAILY_SHI") or os.getenv("DAILY_SHI", "1"))
+    coins = random.randint(int(settings.get("DAILY_COINS_MIN") or 10), int(settings.get("DAILY_COINS_MAX") or 30))
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT OR IGNORE INTO users(user_id, username) VALUES(?,?) RETURNING *", (user_id, ""))
+        _user_changed(cur.fetchone(), username_changed=True)
+        cur.execute("""
+          UPDATE users SET last_daily = ?, shi_balance = shi_balance + ?, coins = coins + ?
+          WHERE user_id = ? AND last_daily <= ?
+          RETURNING *
+        """, (now, shi, coins, user_id, now - DAILY_COOLDOWN))
+        r = cur.fetchone()
+        if r is None:
+            return None
+        _user_changed(r)
+        _log_tx(cur, user_id, "daily_reward", shi, "SHI", "daily")
+        _log_tx(cur, user_id, "daily_reward", coins, "COINS", "daily")
+    return shi, coins
+
 # ----------------- referrals -----------------
-def add_referral(referrer:int, referred:int):
+# referrals and their closure table referral_paths (one row per ancestor /
+# descendant pair, depth 1 = direct referrer) are shared. A signup links every
+# ancestor of the referrer to every descendant of the new user in one
+# INSERT ... SELECT; its reward tiers are then one primary-key range read and
+# the rewards one set-based credit per shard.
+def referral_tiers() -> List[float]:
+    raw = get_settings().get("REFERRAL_TIERS") or REFERRAL_TIERS
+    return [float(x) for x in raw.split(",") if x.strip()]
+
+def _referral_rewards(paid: List[Tuple[int, int, float]], referred: int):
+    by_path: Dict[str, List[Tuple[int, float]]] = {}
+    for user_id, _, amount in paid:
+        by_path.setdefault(_SHARD_PATHS[shard_of(user_id)], []).append((user_id, amount))
+    for path, part in by_path.items():
+        with _using(path), transaction() as conn:
+            _bulk_stage(conn)
+            conn.executemany("INSERT INTO temp._bulk(user_id, delta) VALUES(?,?)", part)
+            _bulk_credit_chunk(conn, "SHI", "referral_reward", f"referred:{referred}")
+
+def add_referral(referrer:int, referred:int) -> Optional[List[Tuple[int, int, float]]]:
+    """Record that referrer invited referred and pay referral_tiers() up the
+    chain. Returns the rewards as [(user_id, depth, amount)], or None when
+    refused: a self-referral, a user who already has a referrer, or a
+    referrer inside referred's own downline (which would close a cycle)."""
+    tiers = referral_tiers()
+    # the referral rows are shared and each reward lives in its user's shard;
+    # unsharded everything commits together, sharded the rewards commit right after
+    with _global_db(), transaction() as conn:
+        cur = conn.cursor()
+        if referrer == referred or cur.execute(
+                "SELECT 1 FROM referral_paths WHERE descendant=? AND ancestor=?", (referrer, referred)).fetchone():
+            return None
+        cur.execute("INSERT OR IGNORE INTO referrals(referrer, referred, ts) VALUES(?,?,?)",
+                    (referrer, referred, int(time.time())))
+        if cur.rowcount == 0:
+            return None
+        cur.execute("""
+          INSERT INTO referral_paths(ancestor, descendant, depth)
+          SELECT a.ancestor, d.descendant, a.depth + d.depth + 1
+          FROM (SELECT ancestor, depth FROM referral_paths WHERE descendant = :referrer
+                UNION ALL SELECT :referrer, 0) AS a,
+               (SELECT descendant, depth FROM referral_paths WHERE ancestor = :referred
+                UNION ALL SELECT :referred, 0) AS d
+        """, {"referrer": referrer, "referred": referred})
+        paid = [(r["ancestor"], r["depth"], tiers[r["depth"] - 1]) for r in cur.execute(
+            "SELECT ancestor, depth FROM referral_paths WHERE descendant=? AND depth<=? ORDER BY depth",
+            (referred, len(tiers))) if tiers[r["depth"] - 1] > 0]
+        if DB_SHARDS <= 0:
+            _referral_rewards(paid, referred)
+    if DB_SHARDS > 0:
+        _referral_rewards(paid, referred)
+    return paid
+
+@_shared
+def get_referral_stats(user_id: int) -> Dict[str, Any]:
+    """A user's place in the referral tree: who referred them, their direct
+    invites, whole downline and its size per level."""
     conn = _connect()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO referrals(referrer, referred, ts) VALUES(?,?,?)", (referrer, referred, int(time.time())))
-    cur.execute("INSERT INTO transactions(user_id, type, amount, currency, meta, ts) VALUES(?,?,?,?,?,?)",
-                (referrer, "referral_reward", 0.5, "SHI", f"referred:{referred}", int(time.time())))
-    cur.execute("UPDATE users SET shi_balance = shi_balance + ? WHERE user_id=?", (0.5, referrer))
-    conn.commit()
-    conn.close()
+    row = conn.execute("SELECT referrer FROM referrals WHERE referred=?", (user_id,)).fetchone()
+    levels = {r["depth"]: r["n"] for r in conn.execute(
+        "SELECT depth, COUNT(*) AS n FROM referral_paths WHERE ancestor=? GROUP BY depth ORDER BY depth", (user_id,))}
+    return {"user_id": user_id, "referrer": row["referrer"] if row else None, "direct": levels.get(1, 0),
+            "downline": sum(levels.values()), "levels": levels}
+
+def get_referral_overview(limit: int=10) -> Dict[str, Any]:
+    """Admin summary of the referral forest: sizes, deepest chain, rewards
+    paid (from the per-shard tx_counts) and the top referrers by downline."""
+    with _global_db():
+        conn = _connect()
+        overview = _row_to_dict(conn.execute("""
+          SELECT COUNT(*) AS referrals, COUNT(DISTINCT referrer) AS referrers,
+                 (SELECT COALESCE(MAX(depth), 0) FROM referral_paths) AS max_depth
+          FROM referrals
+        """).fetchone())
+        overview["top"] = [_row_to_dict(r) for r in conn.execute("""
+          SELECT ancestor AS user_id, COUNT(*) AS downline, SUM(depth = 1) AS direct
+          FROM referral_paths GROUP BY ancestor ORDER BY downline DESC, direct DESC LIMIT ?
+        """, (limit,))]
+    overview["rewards_paid"] = 0.0
+    for conn in _shards():
+        r = conn.execute("SELECT amount FROM tx_counts WHERE type='referral_reward'").fetchone()
+        overview["rewards_paid"] += r["amount"] if r else 0.0
+    return overview
+
+# ----------------- conversation state -----------------
+@_shared
+def state_get(key: str, now: Optional[float]=None) -> Optional[Any]:
+    now = time.time() if now is None else now
+    row = _connect().execute("SELECT value FROM conversation_state WHERE key=? AND expires_at > ?", (key, now)).fetchone()
+    return json.loads(row["value"]) if row else None
+
+@_shared
+def state_set(key: str, value: Any, expires_at: float):
+    with transaction() as conn:
+        conn.execute("""
+          INSERT INTO conversation_state(key, value, expires_at) VALUES(?,?,?)
+          ON CONFLICT(key) DO UPDATE SET value=excluded.value, expires_at=excluded.expires_at
+        """, (key, json.dumps(value), float(expires_at)))
+
+@_shared
+def state_pop(key: str, now: Optional[float]=None) -> Optional[Any]:
+    now = time.time() if now is None else now
+    # most free-text messages have no pending state: answer those with a read
+    # instead of taking the write lock
+    if _connect().execute("SELECT 1 FROM conversation_state WHERE key=?", (key,)).fetchone() is None:
+        return None
+    with transaction() as conn:
+        row = conn.execute("DELETE FROM conversation_state WHERE key=? RETURNING value, expires_at", (key,)).fetchone()
+    if row is None or row["expires_at"] <= now:
+        return None
+    return json.loads(row["value"])
+
+@_shared
+def purge_state(now: Optional[float]=None) -> int:
+    """Delete expired conversation state; returns the number of rows removed."""
+    now = time.time() if now is None else now
+    with transaction() as conn:
+        return conn.execute("DELETE FROM conversation_state WHERE expires_at <= ?", (now,)).rowcount
 
 # ----------------- guilds -----------------
+# guilds (name, owner) are shared; memberships and the trigger-kept
+# guild_stats totals live with the members' user rows.
+@_per_user
+def _add_member(user_id: int, guild_id: int) -> bool:
+    with transaction() as conn:
+        cur = conn.execute("INSERT OR IGNORE INTO guild_members(guild_id, user_id, joined_ts) VALUES(?,?,?)",
+                           (guild_id, user_id, int(time.time())))
+        return cur.rowcount > 0
+
 def create_guild(name:str, owner:int) -> int:
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO guilds(name, owner, created_ts) VALUES(?,?,?)", (name, owner, int(time.time())))
-    gid = cur.lastrowid
-    cur.execute("INSERT INTO guild_members(guild_id, user_id, joined_ts) VALUES(?,?,?)", (gid, owner, int(time.time())))
-    conn.commit()
-    conn.close()
+    # unsharded the guild and its first member commit together; sharded the
+    # membership commits right after, in the owner's shard
+    with _global_db(), transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO guilds(name, owner, created_ts) VALUES(?,?,?)", (name, owner, int(time.time())))
+        gid = cur.lastrowid
+        if DB_SHARDS <= 0:
+            _add_member(owner, gid)
+    if DB_SHARDS > 0:
+        _add_member(owner, gid)
     return gid
 
 def join_guild(guild_id:int, user_id:int) -> bool:
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM guilds WHERE id=?", (guild_id,))
-    if not cur.fetchone():
-        conn.close()
-        return False
-    cur.execute("INSERT OR IGNORE INTO guild_members(guild_id, user_id, joined_ts) VALUES(?,?,?)", (guild_id, user_id, int(time.time())))
-    conn.commit()
-    conn.close()
+    with _global_db():
+        if not _connect().execute("SELECT 1 FROM guilds WHERE id=?", (guild_id,)).fetchone():
+            return False
+    _add_member(user_id, guild_id)
     return True
 
 def leave_guild(guild_id:int, user_id:int):
-    conn = _connect()
+    with _user_db(user_id), transaction() as conn:
+        conn.execute("DELETE FROM guild_members WHERE guild_id=? AND user_id=?", (guild_id, user_id))
+
+@_per_user
+def get_user_guilds(user_id: int) -> List[int]:
+    return [r[0] for r in _connect().execute(
+        "SELECT guild_id FROM guild_members WHERE user_id=? ORDER BY joined_ts", (user_id,))]
+
+def _guild_totals(guild_ids: Optional[List[int]]=None) -> Dict[int, Dict[str, Any]]:
+    """guild_stats summed across shards, for guild_ids or every guild."""
+    totals: Dict[int, Dict[str, Any]] = {}
+    where, params = ("WHERE guild_id IN (SELECT value FROM json_each(?))", (json.dumps(guild_ids),)) \
+        if guild_ids is not None else ("", ())
+    for conn in _shards():
+        for r in conn.execute(f"SELECT guild_id, member_count, total_shi, total_power FROM guild_stats {where}", params):
+            t = totals.setdefault(r["guild_id"], {"member_count": 0, "total_shi": 0.0, "total_power": 0})
+            t["member_count"] += r["member_count"]
+            t["total_shi"] += r["total_shi"]
+            t["total_power"] += r["total_power"]
+    return totals
+
+def _guild_names(guild_ids: List[int]) -> Dict[int, sqlite3.Row]:
+    with _global_db():
+        return {r["id"]: r for r in _connect().execute(
+            "SELECT id, name, owner, created_ts FROM guilds WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(guild_ids),))}
+
+def get_guild_leaderboard(limit: int=10) -> List[Dict[str, Any]]:
+    """Top guilds by total member SHI, from the trigger-kept guild_stats
+    (an index walk unsharded; one pass over guild_stats per shard sharded)."""
+    if DB_SHARDS <= 0:
+        rows = _connect().execute("""
+          SELECT guild_id, member_count, total_shi, total_power FROM guild_stats
+          WHERE member_count > 0 ORDER BY total_shi DESC, guild_id LIMIT ?
+        """, (limit,)).fetchall()
+        top = [_row_to_dict(r) for r in rows]
+    else:
+        totals = _guild_totals()
+        top = [dict(t, guild_id=gid) for gid, t in totals.items() if t["member_count"] > 0]
+        top = heapq.nsmallest(limit, top, key=lambda t: (-t["total_shi"], t["guild_id"]))
+    names = _guild_names([t["guild_id"] for t in top])
+    return [dict(t, name=names[t["guild_id"]]["name"] if t["guild_id"] in names else None) for t in top]
+
+def get_guild_info(guild_id: int) -> Optional[Dict[str, Any]]:
+    """Guild row plus member_count, total_shi, total_power and rank (by
+    total_shi), or None if the guild does not exist."""
+    g = _guild_names([guild_id]).get(guild_id)
+    if g is None:
+        return None
+    info = _row_to_dict(g)
+    t = _guild_totals([guild_id]).get(guild_id, {"member_count": 0, "total_shi": 0.0, "total_power": 0})
+    info.update(t)
+    if DB_SHARDS <= 0:
+        info["rank"] = _connect().execute(
+            "SELECT COUNT(*) + 1 FROM guild_stats WHERE total_shi > ? AND member_count > 0", (t["total_shi"],)).fetchone()[0]
+    else:
+        info["rank"] = 1 + sum(1 for o in _guild_totals().values() if o["total_shi"] > t["total_shi"] and o["member_count"] > 0)
+    return info
+
+# ----------------- bulk grants / airdrops -----------------
+# Set-based crediting: each chunk stages (user_id, delta) in a temp table,
+# then one UPDATE ... FROM credits every user and one INSERT ... SELECT writes
+# their ledger rows, all in one short transaction. Ledger rows are written in
+# the same transaction even in group mode, so a chunk is all-or-nothing.
+_BULK_COLUMNS = {"SHI": "shi_balance", "COINS": "coins", "XTR": "stars_balance"}
+# board updates are one insort each; past this many rows a rebuild is cheaper
+
+def _bulk_credit_chunk(conn: sqlite3.Connection, currency: str, type_: str, meta: str) -> int:
+    col = _BULK_COLUMNS[currency]
+    cast = "CAST(b.delta AS INTEGER)" if currency != "SHI" else "b.delta"
     cur = conn.cursor()
-    cur.execute("DELETE FROM guild_members WHERE guild_id=? AND user_id=?", (guild_id, user_id))
-    conn.commit()
-    conn.close()
+    rows = cur.execute(f"""
+      UPDATE users SET {col} = {col} + {cast} FROM temp._bulk AS b
+      WHERE users.user_id = b.user_id RETURNING {", ".join(_USER_FIELDS)}
+    """).fetchall()
+    cur.execute("""
+      INSERT INTO transactions(user_id, type, amount, currency, meta, ts)
+      SELECT user_id, ?, delta, ?, ?, ? FROM temp._bulk WHERE user_id IN (SELECT user_id FROM users)
+    """, (type_, currency, meta, int(time.time())))
+    seqs = [next(_user_seq) for _ in rows]
+    def publish():
+        recs = [UserRecord(r, seq) for r, seq in zip(rows, seqs)]
+        for rec in recs:
+            _users.refresh(rec)
+        if currency == "SHI":
+            for rec in recs:
+                _board.update(rec.user_id, rec.shi_balance, seq=rec.seq)
+    _after_commit(publish)
+    return len(rows)
+
+def _bulk_stage(conn: sqlite3.Connection):
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS _bulk(user_id INTEGER PRIMARY KEY, delta REAL)")
+    conn.execute("DELETE FROM temp._bulk")
+
+def bulk_update_shi(pairs, type_: str="admin_grant", meta: str="bulk_update_shi",
+                    chunk: int=BULK_CHUNK, pause_ms: int=BULK_PAUSE_MS, progress=None) -> Dict[str, Any]:
+    """Add delta SHI to each (user_id, delta) pair. Repeated user ids are
+    summed; unknown users are skipped. Runs chunk pairs per transaction (per
+    shard when sharded) and calls progress(done, total) after each. Returns
+    {"users", "amount"}."""
+    pairs = list(pairs)
+    if DB_SHARDS > 0:
+        pairs.sort(key=lambda p: shard_of(p[0]))
+    credited, amount = 0, 0.0
+    start = 0
+    while start < len(pairs):
+        # a chunk never crosses a shard boundary
+        path = _SHARD_PATHS[shard_of(pairs[start][0])]
+        end = min(start + chunk, len(pairs))
+        if DB_SHARDS > 0:
+            end = start + 1
+            while end < len(pairs) and end - start < chunk and _SHARD_PATHS[shard_of(pairs[end][0])] == path:
+                end += 1
+        part = pairs[start:end]
+        with _using(path), transaction() as conn:
+            _bulk_stage(conn)
+            conn.executemany("""
+              INSERT INTO temp._bulk(user_id, delta) VALUES(?,?)
+              ON CONFLICT(user_id) DO UPDATE SET delta = delta + excluded.delta
+            """, [(int(u), float(d)) for u, d in part])
+            credited += _bulk_credit_chunk(conn, "SHI", type_, meta)
+            amount += conn.execute(
+                "SELECT COALESCE(SUM(delta),0) FROM temp._bulk WHERE user_id IN (SELECT user_id FROM users)").fetchone()[0]
+        start = end
+        if progress:
+            progress(start, len(pairs))
+        if pause_ms and start < len(pairs):
+            time.sleep(pause_ms / 1000.0)
+    return {"users": credited, "amount": amount}
+
+def _airdrop_where(filter: Optional[Dict[str, Any]]) -> Tuple[str, list]:
+    """Translate an airdrop filter into a WHERE clause on users. Supported
+    keys (combined with AND): guild_id, active_days, min_level, max_level.
+    Banned users are always excluded."""
+    clauses, params = ["banned = 0"], []
+    f = dict(filter or {})
+    if "guild_id" in f:
+        # memberships live with their users, so this works on any shard
+        clauses.append("user_id IN (SELECT user_id FROM guild_members WHERE guild_id = ?)")
+        params.append(int(f.pop("guild_id")))
+    if "active_days" in f:
+        # per-user probes of the (user_id, ts) indexes, not a scan of the ledgers
+        since = int(time.time() - float(f.pop("active_days")) * 86400)
+        clauses.append("(last_daily >= ? OR EXISTS (SELECT 1 FROM transactions t WHERE t.user_id = users.user_id AND t.ts >= ?)"
+                       " OR EXISTS (SELECT 1 FROM battles b WHERE b.user_id = users.user_id AND b.ts >= ?))")
+        params += [since, since, since]
+    if "min_level" in f:
+        clauses.append("level >= ?")
+        params.append(int(f.pop("min_level")))
+    if "max_level" in f:
+        clauses.append("level <= ?")
+        params.append(int(f.pop("max_level")))
+    if f:
+        raise ValueError(f"unknown airdrop filter keys: {', '.join(sorted(f))}")
+    return " AND ".join(clauses), params
+
+def airdrop(filter: Optional[Dict[str, Any]], amount: float, currency: str="SHI", meta: str="airdrop",
+            chunk: int=BULK_CHUNK, pause_ms: int=BULK_PAUSE_MS, progress=None) -> Dict[str, Any]:
+    """Credit amount (SHI, COINS or XTR) to every user matching filter (see
+    _airdrop_where; None means everyone). The matching users are resolved
+    once per shard, before any write lock is taken, into temp._airdrop; they
+    are then credited in user_id order, chunk per transaction, and
+    progress(done, total) is called after each."""
+    currency = currency.upper()
+    if currency not in _BULK_COLUMNS:
+        raise ValueError(f"unknown currency: {currency}")
+    where, params = _airdrop_where(filter)
+    total = 0
+    for conn in _shards():
+        # a read against main (temp is private to this connection), so writers
+        # are not held up however long the filter takes
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS _airdrop(user_id INTEGER PRIMARY KEY)")
+        conn.execute("DELETE FROM temp._airdrop")
+        total += conn.execute(f"INSERT INTO temp._airdrop(user_id) SELECT user_id FROM users WHERE {where}",
+                              params).rowcount
+    credited = 0
+    for _ in _shards():
+        last = None
+        while True:
+            with transaction() as conn:
+                _bulk_stage(conn)
+                conn.execute("""
+                  INSERT INTO temp._bulk(user_id, delta)
+                  SELECT user_id, ? FROM temp._airdrop WHERE user_id > ? ORDER BY user_id LIMIT ?
+                """, (float(amount), last if last is not None else -2 ** 63, chunk))
+                last = conn.execute("SELECT MAX(user_id) FROM temp._bulk").fetchone()[0]
+                if last is None:
+                    break
+                credited += _bulk_credit_chunk(conn, currency, "airdrop", meta)
+            if progress:
+                progress(credited, max(total, credited))
+            if pause_ms:
+                time.sleep(pause_ms / 1000.0)
+        _connect().execute("DELETE FROM temp._airdrop")
+    return {"users": credited, "amount": credited * float(amount), "currency": currency}
+
+# ----------------- ledger retention -----------------
+# Old ledger rows are folded into tx_daily/battle_daily and moved to an
+# archive file. Each chunk is two short transactions: copy into the archive
+# (INSERT OR IGNORE, so a retry is harmless), then roll up and delete from the
+# live DB atomically. Lifetime counters in stats/tx_counts are unaffected.
+_ARCHIVE_SPECS = {
+    "transactions": """
+      INSERT INTO tx_daily(day, user_id, type, currency, n, amount)
+      SELECT ts / 86400, user_id, type, currency, COUNT(*), COALESCE(SUM(amount),0)
+      FROM transactions WHERE id IN (SELECT id FROM temp._archive_chunk)
+      GROUP BY ts / 86400, user_id, type, currency
+      ON CONFLICT(user_id, day, type, currency) DO UPDATE SET n = n + excluded.n, amount = amount + excluded.amount
+    """,
+    "battles": """
+      INSERT INTO battle_daily(day, user_id, n, wins, reward_shi, reward_coins)
+      SELECT ts / 86400, user_id, COUNT(*), SUM(win), COALESCE(SUM(reward_shi),0), COALESCE(SUM(reward_coins),0)
+      FROM battles WHERE id IN (SELECT id FROM temp._archive_chunk)
+      GROUP BY ts / 86400, user_id
+      ON CONFLICT(user_id, day) DO UPDATE SET n = n + excluded.n, wins = wins + excluded.wins,
+        reward_shi = reward_shi + excluded.reward_shi, reward_coins = reward_coins + excluded.reward_coins
+    """,
+}
+
+def _archive_schema(conn: sqlite3.Connection, table: str) -> List[str]:
+    """Create archive.<table> (attached) shaped like main.<table>; returns its columns."""
+    cols = [r["name"] for r in conn.execute(f"PRAGMA main.table_info({table})")]
+    conn.execute(f"CREATE TABLE IF NOT EXISTS archive.{table} AS SELECT * FROM main.{table} WHERE 0")
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS archive.{table}_id ON {table}(id)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS archive.{table}_user_ts ON {table}(user_id, ts)")
+    return cols
+
+def _archive_table(conn: sqlite3.Connection, table: str, cutoff: int, chunk: int, pause: float, progress) -> int:
+    col_list = ", ".join(_archive_schema(conn, table))
+    moved = 0
+    while True:
+        # 1) pick the oldest chunk and copy it to the archive; only the archive
+        #    file is written, the live DB is just read
+        conn.execute("BEGIN")
+        try:
+            conn.execute("DELETE FROM temp._archive_chunk")
+            conn.execute(f"INSERT INTO temp._archive_chunk SELECT id FROM main.{table} WHERE ts < ? ORDER BY id LIMIT ?",
+                         (cutoff, chunk))
+            n = conn.execute("SELECT COUNT(*) FROM temp._archive_chunk").fetchone()[0]
+            conn.execute(f"INSERT OR IGNORE INTO archive.{table}({col_list}) SELECT {col_list} FROM main.{table} "
+                         f"WHERE id IN (SELECT id FROM temp._archive_chunk)")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        if n == 0:
+            return moved
+        # 2) roll up and delete from the live DB in one short write transaction
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(_ARCHIVE_SPECS[table])
+            conn.execute(f"DELETE FROM main.{table} WHERE id IN (SELECT id FROM temp._archive_chunk)")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        moved += n
+        if progress:
+            progress(table, moved)
+        if pause:
+            time.sleep(pause)
+
+def archive_ledger(older_than_days: Optional[float]=None, archive_path: Optional[str]=None,
+                   chunk: int=ARCHIVE_CHUNK, pause_ms: int=ARCHIVE_PAUSE_MS, vacuum_pages: int=2000,
+                   now: Optional[float]=None, progress=None) -> Dict[str, int]:
+    """Roll up and archive ledger rows older than older_than_days (default
+    LEDGER_RETENTION_DAYS), chunk rows per transaction, then reclaim freed
+    pages with incremental vacuum. progress(table, rows_moved) is called
+    after each chunk. Each shard has its own archive file (see
+    archive_paths). Returns rows moved per table and pages vacuumed.
+
+    This sleeps pause_ms between chunks; from the bot, call it through
+    async_db.archive_ledger, which runs it on its own maintenance thread
+    rather than the shared DB executor."""
+    days = LEDGER_RETENTION_DAYS if older_than_days is None else older_than_days
+    cutoff = int((time.time() if now is None else now) - days * 86400)
+    flush_ledger()
+    result = dict.fromkeys(list(_ARCHIVE_SPECS) + ["vacuumed_pages"], 0)
+    for path, archive in zip(_SHARD_PATHS, archive_paths(archive_path)):
+        # own connection: ATTACH and the temp table must not leak into the pool
+        conn = _open(path)
+        try:
+            conn.execute("ATTACH DATABASE ? AS archive", (archive,))
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS _archive_chunk(id INTEGER PRIMARY KEY)")
+            for t in _ARCHIVE_SPECS:
+                result[t] += _archive_table(conn, t, cutoff, chunk, pause_ms / 1000.0, progress)
+            result["vacuumed_pages"] += _incremental_vacuum(conn, vacuum_pages, pause_ms / 1000.0)
+            conn.execute("DETACH DATABASE archive")
+        finally:
+            conn.close()
+    logger.info("ledger archived: %s", result)
+    return result
+
+def archive_paths(base: Optional[str]=None) -> List[str]:
+    """Archive file per shard, parallel to shard_paths()."""
+    return shard_paths(base=base or LEDGER_ARCHIVE_PATH)
+
+def _incremental_vacuum(conn: sqlite3.Connection, step: int, pause: float) -> int:
+    if conn.execute("PRAGMA main.auto_vacuum").fetchone()[0] != 2:
+        logger.info("auto_vacuum is not INCREMENTAL; run enable_incremental_vacuum() once to reclaim space")
+        return 0
+    total = 0
+    while True:
+        free = conn.execute("PRAGMA main.freelist_count").fetchone()[0]
+        if free == 0:
+            return total
+        conn.execute(f"PRAGMA main.incremental_vacuum({min(step, free)})").fetchall()
+        total += min(step, free)
+        if pause:
+            time.sleep(pause)
+
+def enable_incremental_vacuum():
+    """Switch an existing database to auto_vacuum=INCREMENTAL. This needs one
+    full VACUUM, which rewrites the file and blocks writers while it runs, so
+    do it during maintenance. New databases start out incremental."""
+    for path in _all_paths():
+        conn = _open(path)
+        try:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+        finally:
+            conn.close()
+
+def get_archived_transactions(user_id: int, limit: int=50, archive_path: Optional[str]=None) -> List[Dict[str, Any]]:
+    """Raw ledger rows for user_id from its archive file (cold history)."""
+    path = archive_paths(archive_path)[shard_of(user_id)]
+    if not os.path.exists(path):
+        return []
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=DB_BUSY_TIMEOUT)
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute("SELECT * FROM transactions WHERE user_id=? ORDER BY id DESC LIMIT ?",
+                            (user_id, limit)).fetchall()
+    except sqlite3.OperationalError:
+        return []
+    finally:
+        conn.close()
+    return [_row_to_dict(r) for r in rows]
 
 # ----------------- admin / reporting -----------------
 def get_stats() -> Dict[str, Any]:
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) AS users FROM users")
-    users = cur.fetchone()["users"]
-    cur.execute("SELECT SUM(shi_balance) AS total_shi FROM users")
-    total_shi = cur.fetchone()["total_shi"] or 0
-    cur.execute("SELECT COUNT(*) AS txs FROM transactions")
-    txs = cur.fetchone()["txs"]
-    conn.close()
-    return {"users": users, "total_shi": total_shi, "transactions": txs}
+    """Totals from the trigger-maintained stats/tx_counts tables (O(1) per
+    shard, summed across shards)."""
+    stats: Dict[str, Any] = {}
+    by_type: Dict[str, int] = {}
+    for conn in _shards():
+        cur = conn.cursor()
+        cur.execute("SELECT users, total_shi, total_coins, total_stars, transactions, battles FROM stats WHERE id=1")
+        for k, v in _row_to_dict(cur.fetchone()).items():
+            stats[k] = stats.get(k, 0) + v
+        for r in cur.execute("SELECT type, n FROM tx_counts"):
+            by_type[r["type"]] = by_type.get(r["type"], 0) + r["n"]
+    stats["tx_by_type"] = dict(sorted(by_type.items()))
+    return stats
+
+def _recompute_stats(cur: sqlite3.Cursor) -> Dict[str, Any]:
+    cur.execute("""
+      SELECT COUNT(*) AS users, COALESCE(SUM(shi_balance),0) AS total_shi,
+             COALESCE(SUM(coins),0) AS total_coins, COALESCE(SUM(stars_balance),0) AS total_stars
+      FROM users
+    """)
+    stats = _row_to_dict(cur.fetchone())
+    # lifetime counts: live rows plus those already rolled up by archive_ledger()
+    # (the rollup tables only exist from schema version 6)
+    rollups = cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='tx_daily'").fetchone() is not None
+    tx_rolled = "(SELECT COALESCE(SUM(n),0) FROM tx_daily)" if rollups else "0"
+    battles_rolled = "(SELECT COALESCE(SUM(n),0) FROM battle_daily)" if rollups else "0"
+    stats["transactions"] = cur.execute(f"SELECT (SELECT COUNT(*) FROM transactions) + {tx_rolled}").fetchone()[0]
+    stats["battles"] = cur.execute(f"SELECT (SELECT COUNT(*) FROM battles) + {battles_rolled}").fetchone()[0]
+    cur.execute("""
+      UPDATE stats SET users=:users, total_shi=:total_shi, total_coins=:total_coins,
+        total_stars=:total_stars, transactions=:transactions, battles=:battles WHERE id=1
+    """, stats)
+    cur.execute("DELETE FROM tx_counts")
+    rolled = "UNION ALL SELECT type, SUM(n), SUM(amount) FROM tx_daily GROUP BY type" if rollups else ""
+    cur.execute(f"""
+      INSERT INTO tx_counts(type, n, amount)
+      SELECT type, SUM(n), SUM(amount) FROM (
+        SELECT type, COUNT(*) AS n, COALESCE(SUM(amount),0) AS amount FROM transactions GROUP BY type
+        {rolled})
+      GROUP BY type
+    """)
+    stats["tx_by_type"] = {r["type"]: r["n"] for r in cur.execute("SELECT type, n FROM tx_counts ORDER BY type")}
+    if cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='guild_stats'").fetchone():
+        _rebuild_guild_stats(cur)
+    return stats
+
+def reconcile_stats() -> Dict[str, Any]:
+    """Recompute the aggregates from scratch (full scans) and store them.
+    Returns {"before": ..., "after": ..., "drift": {key: after - before}}."""
+    flush_ledger()
+    before = get_stats()
+    after: Dict[str, Any] = {"tx_by_type": {}}
+    for _ in _shards():
+        with transaction() as conn:
+            part = _recompute_stats(conn.cursor())
+        for k, v in part.items():
+            if k == "tx_by_type":
+                for t, n in v.items():
+                    after[k][t] = after[k].get(t, 0) + n
+            else:
+                after[k] = after.get(k, 0) + v
+    # ignore float rounding noise on the running SHI total
+    drift = {k: after[k] - before[k] for k in after if k != "tx_by_type" and abs(after[k] - before[k]) > 1e-6}
+    for t in set(before["tx_by_type"]) | set(after["tx_by_type"]):
+        d = after["tx_by_type"].get(t, 0) - before["tx_by_type"].get(t, 0)
+        if d:
+            drift[f"tx:{t}"] = d
+    return {"before": before, "after": after, "drift": drift}
 
 def get_transactions(limit:int=50) -> List[Dict[str,Any]]:
-    conn = _connect()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM transactions ORDER BY id DESC LIMIT ?", (limit,))
-    rows = cur.fetchall()
-    conn.close()
-    return [_row_to_dict(r) for r in rows]
+    if DB_SHARDS <= 0:
+        rows = _connect().execute("SELECT * FROM transactions ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [_row_to_dict(r) for r in rows]
+    # ids are per shard, so merge the newest rows of each shard by time; ts
+    # has one-second resolution, so ties go to the higher id, then the later shard
+    rows = [(r["ts"], r["id"], i, _row_to_dict(r)) for i, conn in enumerate(_shards())
+            for r in conn.execute("SELECT * FROM transactions ORDER BY id DESC LIMIT ?", (limit,))]
+    return [r[-1] for r in heapq.nlargest(limit, rows, key=lambda r: r[:3])]
+
+# ----------------- metrics -----------------
+# read at scrape time only
+metrics.gauge("shi_user_cache_lookups_total", "User cache lookups by result",
+              lambda: {"hit": _users.hits, "miss": _users.misses}, label="result", type_="counter")
+metrics.gauge("shi_user_cache_size", "Rows held in the user cache", lambda: len(_users._data))
+metrics.gauge("shi_table_cache_gets_total", "Settings/catalog cache reads",
+              lambda: {"settings": _settings.gets, "catalog": _catalog.gets}, label="cache", type_="counter")
+metrics.gauge("shi_table_cache_reloads_total", "Settings/catalog cache reloads from SQLite",
+              lambda: {"settings": _settings.reloads, "catalog": _catalog.reloads}, label="cache", type_="counter")
+metrics.gauge("shi_ledger_queue_depth", "Ledger rows waiting for the group-commit writer",
+              lambda: _ledger.depth() if _ledger is not None else 0)
+metrics.gauge("shi_leaderboard_size", "Users held by the in-memory leaderboard", lambda: len(_board._keys))
@@ -0,0 +1,249 @@
+# fakebotapi.py
+# A small local stand-in for the Telegram Bot API, for measuring the bot
+# end to end without a network. It answers the methods bot.py uses, records
+# every outgoing call, pushes synthetic updates either to a webhook or via
+# getUpdates, and measures update -> first reply latency per chat.
+#
+#   python fakebotapi.py --port 8081 --webhook http://127.0.0.1:8443/telegram \
+#       --users 200 --updates 5000
+#   # bot side: BOT_API_BASE_URL=http://127.0.0.1:8081/bot BOT_MODE=webhook ...
+import json
+import time
+import argparse
+import itertools
+import threading
+import statistics
+import urllib.request
+from collections import deque, defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot",
+            "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+# ----------------- synthetic updates -----------------
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+def _user(user_id: int) -> Dict[str, Any]:
+    return {"id": user_id, "is_bot": False, "first_name": f"p{user_id}", "username": f"player{user_id}"}
+
+def _message(user_id: int, text: str) -> Dict[str, Any]:
+    msg = {"message_id": next(_message_ids), "date": int(time.time()),
+           "chat": {"id": user_id, "type": "private"}, "from": _user(user_id), "text": text}
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return msg
+
+def message_update(user_id: int, text: str) -> Dict[str, Any]:
+    return {"update_id": next(_update_ids), "message": _message(user_id, text)}
+
+def callback_update(user_id: int, data: str, message_id: Optional[int]=None) -> Dict[str, Any]:
+    msg = {"message_id": message_id or next(_message_ids), "date": int(time.time()),
+           "chat": {"id": user_id, "type": "private"}, "from": BOT_USER, "text": "menu"}
+    uid = next(_update_ids)
+    return {"update_id": uid, "callback_query": {"id": str(uid), "from": _user(user_id), "chat_instance": str(user_id),
+                                                 "message": msg, "data": data}}
+
+def precheckout_update(user_id: int, payload: str, amount: int) -> Dict[str, Any]:
+    uid = next(_update_ids)
+    return {"update_id": uid, "pre_checkout_query": {"id": str(uid), "from": _user(user_id), "currency": "XTR",
+                                                     "total_amount": amount, "invoice_payload": payload}}
+
+def payment_update(user_id: int, payload: str, amount: int) -> Dict[str, Any]:
+    msg = _message(user_id, "")
+    del msg["text"]
+    msg["successful_payment"] = {"currency": "XTR", "total_amount": amount, "invoice_payload": payload,
+                                 "telegram_payment_charge_id": f"tg{msg['message_id']}",
+                                 "provider_payment_charge_id": f"pp{msg['message_id']}"}
+    return {"update_id": next(_update_ids), "message": msg}
+
+def _update_chat(update: Dict[str, Any]) -> Optional[int]:
+    if "message" in update:
+        return update["message"]["chat"]["id"]
+    if "callback_query" in update:
+        return update["callback_query"]["from"]["id"]
+    return None
+
+# ----------------- API core -----------------
+class FakeBotAPI:
+    """Transport-independent core: handle(method, params) returns the result
+    the real API would. Thread-safe; usable in-process or behind HTTP."""
+
+    def __init__(self):
+        self.calls: List[tuple] = []
+        self.latencies: List[float] = []
+        self._pending = defaultdict(deque)  # chat_id -> push timestamps
+        self._updates: deque = deque()
+        self._updates_ready = threading.Condition()
+        self._lock = threading.Lock()
+
+    # --- incoming side (updates) ---
+    def mark_pushed(self, update: Dict[str, Any]):
+        chat = _update_chat(update)
+        if chat is not None:
+            with self._lock:
+                self._pending[chat].append(time.perf_counter())
+
+    def enqueue(self, update: Dict[str, Any]):
+        """Queue an update for getUpdates (polling mode)."""
+        self.mark_pushed(update)
+        with self._updates_ready:
+            self._updates.append(update)
+            self._updates_ready.notify_all()
+
+    # --- outgoing side (Bot API calls) ---
+    def handle(self, method: str, params: Dict[str, Any]) -> Any:
+        now = time.perf_counter()
+        chat = params.get("chat_id")
+        with self._lock:
+            self.calls.append((method, params, now))
+            if method in ("sendMessage", "editMessageText", "sendInvoice") and chat is not None:
+                pending = self._pending.get(int(chat))
+                if pending:
+                    self.latencies.append(now - pending.popleft())
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method in ("sendMessage", "editMessageText", "sendInvoice"):
+            if chat is None:
+                return True
+            return {"message_id": params.get("message_id") or next(_message_ids), "date": int(time.time()),
+                    "chat": {"id": int(chat), "type": "private"}, "from": BOT_USER,
+                    "text": params.get("text") or params.get("title") or ""}
+        return True
+
+    def _get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + timeout
+        with self._updates_ready:
+            while self._updates and self._updates[0]["update_id"] < offset:
+                self._updates.popleft()
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_ready.wait(deadline - time.monotonic())
+            return list(itertools.islice(self._updates, limit))
+
+    def calls_by_method(self) -> Dict[str, int]:
+        counts: Dict[str, int] = defaultdict(int)
+        for method, _, _ in self.calls:
+            counts[method] += 1
+        return dict(counts)
+
+    def latency_summary(self) -> Dict[str, float]:
+        lat = sorted(self.latencies)
+        if not lat:
+            return {"count": 0}
+        pct = lambda p: lat[min(len(lat) - 1, int(p * len(lat)))] * 1000
+        return {"count": len(lat), "mean_ms": statistics.fmean(lat) * 1000,
+                "p50_ms": pct(0.50), "p99_ms": pct(0.99), "max_ms": lat[-1] * 1000}
+
+# ----------------- HTTP server -----------------
+def _parse_params(body: bytes, content_type: str) -> Dict[str, Any]:
+    if not body:
+        return {}
+    if "json" in content_type:
+        return json.loads(body)
+    params = {}
+    for k, v in parse_qsl(body.decode(), keep_blank_values=True):
+        try:
+            params[k] = json.loads(v)
+        except ValueError:
+            params[k] = v
+    return params
+
+class FakeBotAPIServer:
+    """Serves FakeBotAPI over HTTP at /bot<token>/<method>."""
+
+    def __init__(self, api: Optional[FakeBotAPI]=None, host: str="127.0.0.1", port: int=8081):
+        self.api = api or FakeBotAPI()
+        api = self.api
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+            def do_POST(self):
+                method = self.path.rstrip("/").rsplit("/", 1)[-1]
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                result = api.handle(method, _parse_params(body, self.headers.get("Content-Type", "")))
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-bot-api", daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self) -> "FakeBotAPIServer":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def push_webhook(api: FakeBotAPI, url: str, update: Dict[str, Any], secret: str=""):
+    """POST one update to the bot's webhook, as Telegram would."""
+    req = urllib.request.Request(url, data=json.dumps(update).encode(), method="POST",
+                                 headers={"Content-Type": "application/json"})
+    if secret:
+        req.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+    api.mark_pushed(update)
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        resp.read()
+
+def synthetic_updates(users: int, count: int):
+    """Round-robin mix of the bot's hot paths across `users` players."""
+    script = [("cb", "profile"), ("cb", "battle"), ("cb", "shop"), ("msg", "/daily"), ("cb", "battle")]
+    for i in range(count):
+        kind, data = script[(i // users) % len(script)]
+        user_id = 1000 + i % users
+        yield callback_update(user_id, data) if kind == "cb" else message_update(user_id, data)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--webhook", help="bot webhook URL; omit to serve updates via getUpdates")
+    ap.add_argument("--secret", default="")
+    ap.add_argument("--users", type=int, default=100)
+    ap.add_argument("--updates", type=int, default=1000)
+    ap.add_argument("--rate", type=float, default=0, help="updates per second (0 = as fast as possible)")
+    ap.add_argument("--settle", type=float, default=5, help="seconds to wait for replies at the end")
+    args = ap.parse_args()
+
+    server = FakeBotAPIServer(host=args.host, port=args.port).start()
+    print(f"fake Bot API at {server.base_url}")
+    input("start the bot against it, then press Enter to push updates... ")
+    t0 = time.perf_counter()
+    for n, update in enumerate(synthetic_updates(args.users, args.updates), 1):
+        if args.webhook:
+            push_webhook(server.api, args.webhook, update, args.secret)
+        else:
+            server.api.enqueue(update)
+        if args.rate:
+            time.sleep(max(0.0, t0 + n / args.rate - time.perf_counter()))
+    time.sleep(args.settle)
+    print(json.dumps({"pushed": args.updates, "seconds": time.perf_counter() - t0,
+                      "calls": server.api.calls_by_method(), "latency": server.api.latency_summary()}, indent=2))
+    server.stop()
+
+if __name__ == "__main__":
+    main()
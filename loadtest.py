@@ -0,0 +1,239 @@
+# loadtest.py
+# End-to-end load generator: builds the real Application from bot.py, swaps
+# its HTTP transport for an in-process stub of the Bot API (fakebotapi.py)
+# and replays synthetic player sessions through the update queue, all in one
+# process with no network. Reports handler throughput, per-route latency and
+# event-loop lag. Inbound flood control is off unless --flood is given (it
+# would otherwise drop most of a closed-loop session); the report's "ok" is
+# false, and the exit status 1, if any update was dropped or any session did
+# not reach its invoice and final reply.
+#
+#   python loadtest.py --players 2000 --battles 5 --concurrency 64 --out load.json
+#
+# Each player is a closed loop: it sends one update, waits for the bot to
+# finish handling it, thinks, then sends the next:
+#   /start -> (battle, back) x N -> shop -> buyitem -> back -> buy_shi -> amount
+#   -> pre-checkout -> payment -> /daily -> /leaderboard
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import SimpleUpdateProcessor
+from telegram.request import BaseRequest, RequestData
+
+import fakebotapi
+
+class StubRequest(BaseRequest):
+    """BaseRequest that answers from a FakeBotAPI in-process. api_delay adds
+    a simulated round trip to every call."""
+
+    def __init__(self, api: fakebotapi.FakeBotAPI, api_delay: float=0.0):
+        self.api = api
+        self.api_delay = api_delay
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData]=None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+        if self.api_delay:
+            await asyncio.sleep(self.api_delay)
+        params = request_data.parameters if request_data else {}
+        result = self.api.handle(url.rsplit("/", 1)[-1], params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+class TimedUpdateProcessor(SimpleUpdateProcessor):
+    """Caps concurrency like concurrent_updates=N and records, per update,
+    when handling started and finished so callers can await completion."""
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.waiters: Dict[int, asyncio.Future] = {}
+        self.service: Dict[str, List[float]] = defaultdict(list)
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        t = time.perf_counter()
+        try:
+            await coroutine
+        finally:
+            done = time.perf_counter()
+            if isinstance(update, Update):
+                self.service[route(update)].append(done - t)
+                fut = self.waiters.pop(update.update_id, None)
+                if fut is not None and not fut.done():
+                    fut.set_result(done)
+
+def route(update: Update) -> str:
+    """Metric label for an update: callback data (buyitem_<id> folded), the
+    command, or the update kind."""
+    if update.callback_query:
+        data = update.callback_query.data or ""
+        return "cb:buyitem_*" if data.startswith("buyitem_") else f"cb:{data}"
+    if update.pre_checkout_query:
+        return "precheckout"
+    msg = update.message
+    if msg is not None:
+        if msg.successful_payment:
+            return "payment"
+        if (msg.text or "").startswith("/"):
+            return msg.text.split()[0]
+        return "text"
+    return "other"
+
+def session(user_id: int, battles: int, item_id: int, menu_id: int) -> List[Dict[str, Any]]:
+    payload, amount = f"buy_5_{user_id}", 5 * 5
+    # every press comes from its own message, so the bot's duplicate-press
+    # filter (same message, same button) never sees a repeat
+    ids = iter(range(menu_id, menu_id + 2 * battles + 4))
+    press = lambda data: fakebotapi.callback_update(user_id, data, next(ids))
+    steps = [fakebotapi.message_update(user_id, "/start")]
+    for _ in range(battles):
+        steps += [press("battle"), press("start")]
+    steps += [press("shop"),
+              press(f"buyitem_{item_id}"),
+              press("start"),
+              press("buy_shi"),
+              fakebotapi.message_update(user_id, "5"),
+              fakebotapi.precheckout_update(user_id, payload, amount),
+              fakebotapi.payment_update(user_id, payload, amount),
+              fakebotapi.message_update(user_id, "/daily"),
+              fakebotapi.message_update(user_id, "/leaderboard")]
+    return steps
+
+def _summary(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"count": 0}
+    lat = sorted(samples)
+    pct = lambda p: round(lat[min(len(lat) - 1, int(p * len(lat)))] * 1000, 3)
+    return {"count": len(lat), "mean_ms": round(sum(lat) / len(lat) * 1000, 3), "p50_ms": pct(0.50),
+            "p90_ms": pct(0.90), "p99_ms": pct(0.99), "max_ms": round(lat[-1] * 1000, 3)}
+
+async def _loop_lag(interval: float, out: List[float], stop: asyncio.Event):
+    while not stop.is_set():
+        t = time.perf_counter()
+        await asyncio.sleep(interval)
+        out.append(max(0.0, time.perf_counter() - t - interval))
+
+async def run(args) -> Dict[str, Any]:
+    import bot
+    import database
+    import ratelimit
+
+    if not args.flood:
+        bot.flood = ratelimit.FloodControl(user_rate=1e9, user_burst=1e9, global_rate=1e9, global_burst=1e9,
+                                           dedupe_window=0)
+    api = fakebotapi.FakeBotAPI()
+    processor = TimedUpdateProcessor(args.concurrency)
+    app = bot.build_application(token="123456:LOADTEST", concurrent_updates=processor,
+                                rate_limiter=args.rate_limiter, request=StubRequest(api, args.api_ms / 1000))
+    item_id = min(database.get_items(), key=lambda it: it["price_shi"])["id"]
+    rng = random.Random(args.seed)
+    latency: Dict[str, List[float]] = defaultdict(list)
+    lag: List[float] = []
+    stop = asyncio.Event()
+
+    async def player(user_id: int):
+        await asyncio.sleep(rng.uniform(0, args.ramp))
+        for data in session(user_id, args.battles, item_id, menu_id=user_id * 1000):
+            update = Update.de_json(data, app.bot)
+            fut = asyncio.get_running_loop().create_future()
+            processor.waiters[update.update_id] = fut
+            t = time.perf_counter()
+            await app.update_queue.put(update)
+            latency[route(update)].append(await fut - t)
+            if args.think_ms:
+                await asyncio.sleep(rng.expovariate(1000 / args.think_ms))
+
+    await app.initialize()
+    await app.start()
+    monitor = asyncio.create_task(_loop_lag(0.01, lag, stop))
+    t0 = time.perf_counter()
+    await asyncio.gather(*(player(1_000_000 + i) for i in range(args.players)))
+    wall = time.perf_counter() - t0
+    stop.set()
+    await monitor
+    await app.stop()
+    await app.shutdown()
+
+    total = sum(len(v) for v in latency.values())
+    dropped = sum(bot.flood.dropped.values())
+    # a finished session got its invoice and a reply to its last step (/leaderboard)
+    invoiced, replies = set(), defaultdict(int)
+    for method, params, _ in api.calls:
+        if "chat_id" in params:
+            chat = int(params["chat_id"])
+            replies[chat] += 1
+            if method == "sendInvoice":
+                invoiced.add(chat)
+    expected = 2 * args.battles + 9
+    incomplete = sum(1 for i in range(args.players)
+                     if 1_000_000 + i not in invoiced or replies[1_000_000 + i] < expected)
+    return {
+        "ok": dropped == 0 and incomplete == 0,
+        "dropped_updates": dropped,
+        "incomplete_sessions": incomplete,
+        "config": {k: v for k, v in vars(args).items() if k != "out"},
+        "updates": total,
+        "seconds": round(wall, 3),
+        "updates_per_sec": round(total / wall, 1),
+        "latency": {r: _summary(v) for r, v in sorted(latency.items())},
+        "latency_all": _summary([x for v in latency.values() for x in v]),
+        "service": {r: _summary(v) for r, v in sorted(processor.service.items())},
+        "loop_lag": _summary(lag),
+        "api_calls": api.calls_by_method(),
+        "flood_dropped": dict(bot.flood.dropped),
+        "user_cache": database.user_cache_stats(),
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description="replay synthetic player sessions through bot.py")
+    ap.add_argument("--players", type=int, default=500)
+    ap.add_argument("--battles", type=int, default=5, help="battles per session")
+    ap.add_argument("--concurrency", type=int, default=32, help="concurrent_updates for the Application")
+    ap.add_argument("--think-ms", type=float, default=0, help="mean pause between a player's actions")
+    ap.add_argument("--ramp", type=float, default=1.0, help="seconds over which players start")
+    ap.add_argument("--api-ms", type=float, default=0, help="simulated Bot API round trip")
+    ap.add_argument("--rate-limiter", action="store_true", help="keep the outbound PacedRateLimiter")
+    ap.add_argument("--flood", action="store_true", help="keep inbound flood control (drops are reported)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--db", default=None, help="database file (default: a fresh temp file)")
+    ap.add_argument("--out", default=None, help="write the JSON report here as well")
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    tmp = None
+    if args.db is None:
+        tmp = tempfile.TemporaryDirectory(prefix="shi-load-")
+        args.db = os.path.join(tmp.name, "load.db")
+    # database.py reads its config at import time
+    os.environ["DB_PATH"] = args.db
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    if tmp is not None:
+        tmp.cleanup()
+    if not report["ok"]:
+        logging.error("load test invalid: %d updates dropped, %d of %d sessions incomplete",
+                      report["dropped_updates"], report["incomplete_sessions"], args.players)
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
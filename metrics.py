@@ -0,0 +1,236 @@
+# metrics.py
+# In-process metrics: labelled latency histograms, counters and scrape-time
+# gauges, exposed in Prometheus text format on an optional local HTTP
+# endpoint. With METRICS_PORT unset (the default) the timing decorators hand
+# back the original function and nothing is recorded.
+import os
+import time
+import bisect
+import asyncio
+import logging
+import threading
+import functools
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger("SHI-METRICS")
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_ADDR = os.getenv("METRICS_ADDR", "127.0.0.1")
+ENABLED = METRICS_PORT > 0 or os.getenv("METRICS_ENABLED", "0") == "1"
+
+# seconds; covers cache hits (~10us) up to stalled fsyncs
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str="") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _escape(v: Any) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Histogram:
+    """Cumulative-bucket histogram per label set."""
+
+    def __init__(self, name: str, help: str, labels: Iterable[str]=(), buckets: Tuple[float, ...]=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List[float]] = {}  # counts per bucket + [+Inf, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(k, list(v)) for k, v in self._series.items()]
+        for labels, s in sorted(series):
+            acc = 0
+            for le, n in zip(self.buckets + (float("inf"),), s):
+                acc += n
+                le_label = 'le="+Inf"' if le == float("inf") else f'le="{le!r}"'
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le_label)} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {s[-1]}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, labels)} {acc}")
+        return out
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Iterable[str]=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        out += [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in items]
+        return out
+
+class Gauge:
+    """Read at scrape time from fn(), which returns a number or a
+    {label_value: number} dict (for a single label)."""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], Any], label: Optional[str]=None, type_: str="gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label = label
+        self.type = type_
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        try:
+            value = self.fn()
+        except Exception:
+            logger.exception("gauge %s failed", self.name)
+            return out
+        if isinstance(value, dict):
+            out += [f"{self.name}{_labels((self.label,), (k,))} {v}" for k, v in sorted(value.items())]
+        else:
+            out.append(f"{self.name} {value}")
+        return out
+
+_registry: Dict[str, Any] = {}
+_registry_lock = threading.Lock()
+
+def _register(metric):
+    with _registry_lock:
+        return _registry.setdefault(metric.name, metric)
+
+def histogram(name: str, help: str, labels: Iterable[str]=(), buckets: Tuple[float, ...]=DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help, labels, buckets))
+
+def counter(name: str, help: str, labels: Iterable[str]=()) -> Counter:
+    return _register(Counter(name, help, labels))
+
+def gauge(name: str, help: str, fn: Callable[[], Any], label: Optional[str]=None, type_: str="gauge"):
+    """Register a scrape-time gauge; type_="counter" for monotonic values
+    kept elsewhere (e.g. cache hit totals)."""
+    with _registry_lock:
+        _registry[name] = Gauge(name, help, fn, label, type_)
+
+def render() -> str:
+    with _registry_lock:
+        metrics = [m for _, m in sorted(_registry.items())]
+    lines: List[str] = []
+    for m in metrics:
+        lines += m.render()
+    return "\n".join(lines) + "\n"
+
+# ----------------- timing helpers -----------------
+DB_CALL = histogram("shi_db_call_seconds", "Time spent inside a database.py function", ["function"])
+HANDLER = histogram("shi_handler_seconds", "Update handler latency", ["handler", "route"])
+HANDLER_ERRORS = counter("shi_handler_errors_total", "Update handlers that raised", ["handler", "route"])
+
+def timed(hist: Histogram, *labels: str):
+    """Decorator timing a sync function into hist. Identity when disabled."""
+    def deco(fn):
+        if not ENABLED:
+            return fn
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                hist.observe(time.perf_counter() - t, *labels)
+        return wrapper
+    return deco
+
+def timed_handler(name: str, route: Optional[Callable[[Any], str]]=None):
+    """Decorator for async PTB callbacks (update, context). route(update)
+    gives the route label; it must map to a small fixed set of values."""
+    def deco(fn):
+        if not ENABLED:
+            return fn
+        @functools.wraps(fn)
+        async def wrapper(update, context):
+            label = route(update) if route else ""
+            t = time.perf_counter()
+            try:
+                return await fn(update, context)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                HANDLER_ERRORS.inc(name, label)
+                raise
+            finally:
+                HANDLER.observe(time.perf_counter() - t, name, label)
+        return wrapper
+    return deco
+
+# ----------------- startup report -----------------
+# Seconds from this module's import (entry points import it before anything
+# heavy) to each cold-start phase: "import" (bot.py loaded), "db_ready"
+# (database.init_db done), "app_ready" (post-init hooks done) and
+# "first_update" (first update reached the handlers). Recorded whether or
+# not metrics are enabled; exported as shi_startup_seconds{phase}.
+_STARTED = time.perf_counter()
+_startup: Dict[str, float] = {}
+
+def startup_mark(phase: str) -> bool:
+    """Record phase the first time it is reached; False if already recorded."""
+    if phase in _startup:
+        return False
+    _startup[phase] = round(time.perf_counter() - _STARTED, 4)
+    return True
+
+def startup_report() -> Dict[str, float]:
+    return dict(sorted(_startup.items(), key=lambda kv: kv[1]))
+
+gauge("shi_startup_seconds", "Seconds from process start to each cold-start phase", startup_report, label="phase")
+
+# ----------------- HTTP endpoint -----------------
+_server: Optional[ThreadingHTTPServer] = None
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_server(port: int=METRICS_PORT, addr: str=METRICS_ADDR) -> Optional[ThreadingHTTPServer]:
+    """Serve /metrics on a daemon thread. No-op when port is 0."""
+    global _server
+    if not port or _server is not None:
+        return _server
+    _server = ThreadingHTTPServer((addr, port), _Handler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("metrics on http://%s:%d/metrics", addr, _server.server_address[1])
+    return _server
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
@@ -0,0 +1,181 @@
+# ratelimit.py
+# Inbound flood control (per-user and global token buckets, duplicate
+# callback suppression) and an outbound rate limiter that paces Bot API
+# calls to Telegram's limits and retries on 429. Clocks and sleep are
+# injectable so both can be driven by a fake clock.
+import os
+import time
+import asyncio
+import logging
+import datetime
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger("SHI-RATELIMIT")
+
+# inbound (updates per second)
+FLOOD_USER_RATE = float(os.getenv("FLOOD_USER_RATE", "3"))
+FLOOD_USER_BURST = float(os.getenv("FLOOD_USER_BURST", "5"))
+FLOOD_GLOBAL_RATE = float(os.getenv("FLOOD_GLOBAL_RATE", "200"))
+FLOOD_GLOBAL_BURST = float(os.getenv("FLOOD_GLOBAL_BURST", "400"))
+FLOOD_DEDUPE_WINDOW = float(os.getenv("FLOOD_DEDUPE_WINDOW", "1.0"))
+
+# outbound (Bot API calls per second); Telegram allows ~30/s overall, about
+# one message per second per private chat and 20 per minute per group
+OUT_GLOBAL_RATE = float(os.getenv("OUT_GLOBAL_RATE", "30"))
+OUT_CHAT_RATE = float(os.getenv("OUT_CHAT_RATE", "1"))
+OUT_CHAT_BURST = float(os.getenv("OUT_CHAT_BURST", "3"))
+OUT_GROUP_RATE = float(os.getenv("OUT_GROUP_RATE", str(20 / 60)))
+OUT_MAX_RETRIES = int(os.getenv("OUT_MAX_RETRIES", "3"))
+
+MAX_TRACKED_KEYS = 100000
+
+class TokenBucket:
+    """Classic token bucket. try_acquire() is all-or-nothing; reserve() always
+    succeeds and returns how long the caller must wait (tokens may go
+    negative, which queues later callers behind earlier ones)."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "clock")
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float]=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, n: float=1) -> bool:
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def reserve(self, n: float=1) -> float:
+        self._refill()
+        self.tokens -= n
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class _BucketMap:
+    """Per-key buckets with LRU eviction so idle keys don't accumulate."""
+
+    def __init__(self, rate: float, capacity: float, clock, max_keys: int=MAX_TRACKED_KEYS):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+
+    def get(self, key: Hashable, rate: Optional[float]=None) -> TokenBucket:
+        b = self._buckets.get(key)
+        if b is None:
+            b = self._buckets[key] = TokenBucket(rate or self.rate, self.capacity, self.clock)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return b
+
+class FloodControl:
+    """Decides whether an incoming update should be processed."""
+
+    def __init__(self, user_rate: float=FLOOD_USER_RATE, user_burst: float=FLOOD_USER_BURST,
+                 global_rate: float=FLOOD_GLOBAL_RATE, global_burst: float=FLOOD_GLOBAL_BURST,
+                 dedupe_window: float=FLOOD_DEDUPE_WINDOW, clock: Callable[[], float]=time.monotonic):
+        self.clock = clock
+        self.dedupe_window = dedupe_window
+        self._users = _BucketMap(user_rate, user_burst, clock)
+        self._global = TokenBucket(global_rate, global_burst, clock)
+        self._recent: "OrderedDict[Hashable, float]" = OrderedDict()
+        self.dropped = {"duplicate": 0, "user": 0, "global": 0}
+
+    def allow(self, user_id: int, dedupe_key: Optional[Hashable]=None) -> bool:
+        now = self.clock()
+        if dedupe_key is not None:
+            key = (user_id, dedupe_key)
+            last = self._recent.get(key)
+            self._recent[key] = now
+            self._recent.move_to_end(key)
+            self._expire_recent(now)
+            if last is not None and now - last < self.dedupe_window:
+                self.dropped["duplicate"] += 1
+                return False
+        if not self._users.get(user_id).try_acquire():
+            self.dropped["user"] += 1
+            return False
+        if not self._global.try_acquire():
+            self.dropped["global"] += 1
+            return False
+        return True
+
+    def _expire_recent(self, now: float):
+        while self._recent:
+            key, ts = next(iter(self._recent.items()))
+            if now - ts < self.dedupe_window and len(self._recent) <= MAX_TRACKED_KEYS:
+                break
+            del self._recent[key]
+
+def _retry_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if isinstance(ra, datetime.timedelta) else float(ra)
+
+class PacedRateLimiter(BaseRateLimiter):
+    """Outbound limiter for ApplicationBuilder().rate_limiter(...). Calls that
+    target a chat wait for a global and a per-chat token; anything else (e.g.
+    answerCallbackQuery) only waits for the global one. A RetryAfter from
+    Telegram pauses the whole limiter for the requested time, then the call is
+    retried up to max_retries times with growing extra backoff."""
+
+    def __init__(self, global_rate: float=OUT_GLOBAL_RATE, chat_rate: float=OUT_CHAT_RATE,
+                 chat_burst: float=OUT_CHAT_BURST, group_rate: float=OUT_GROUP_RATE,
+                 max_retries: int=OUT_MAX_RETRIES, clock: Callable[[], float]=time.monotonic,
+                 sleep: Callable[[float], Any]=asyncio.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate, clock)
+        self._chats = _BucketMap(chat_rate, chat_burst, clock)
+        self._paused_until = 0.0
+        self.retries = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def _wait_turn(self, chat_id: Any):
+        pause = self._paused_until - self.clock()
+        if pause > 0:
+            await self.sleep(pause)
+        delay = self._global.reserve()
+        if chat_id is not None:
+            group = isinstance(chat_id, int) and chat_id < 0
+            delay = max(delay, self._chats.get(chat_id, self.group_rate if group else None).reserve())
+        if delay > 0:
+            await self.sleep(delay)
+
+    async def process_request(self, callback, args, kwargs, endpoint: str, data: Dict[str, Any], rate_limit_args):
+        chat_id = data.get("chat_id")
+        attempt = 0
+        while True:
+            await self._wait_turn(chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.retries += 1
+                wait = _retry_seconds(e) + 0.5 * 2 ** (attempt - 1)
+                logger.warning("%s hit flood control; retrying in %.1fs", endpoint, wait)
+                self._paused_until = max(self._paused_until, self.clock() + wait)
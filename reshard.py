@@ -0,0 +1,214 @@
+# reshard.py
+# Offline re-sharding: copies a database laid out with --from N shards into a
+# new set of files laid out with --to M shards (0 = a single unsharded file),
+# placing every per-user row by database.shard_of(user_id, M). Run it with the
+# bot stopped. The source files are only read; the new files are written next
+# to --out and swapping them in (or pointing DB_PATH/DB_SHARDS at them) is
+# left to the operator.
+#
+#   DB_PATH=shi.db python reshard.py --from 0 --to 4 --out new/shi.db
+#   DB_PATH=new/shi.db DB_SHARDS=4 python bot.py
+#
+# Shared tables (settings, items, guilds, referrals, conversation state) are
+# copied with the main file. Ledger rows (live and archived) are renumbered per
+# target file in time order, archive first, so ids stay unique within a shard
+# and its archive.
+import os
+import sys
+import glob
+import json
+import heapq
+import sqlite3
+import argparse
+from typing import Any, Dict, Iterator, List
+
+USER_TABLES = ("users", "inventory", "guild_members", "tx_daily", "battle_daily")
+LEDGER_TABLES = ("transactions", "battles")
+BATCH = 10000
+
+def _columns(conn: sqlite3.Connection, schema: str, table: str) -> List[str]:
+    return [r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+def _open_ro(path: str) -> sqlite3.Connection:
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+def _schema_version(path: str) -> int:
+    conn = _open_ro(path)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+def _has_table(conn: sqlite3.Connection, table: str) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone() is not None
+
+class _Target:
+    """One output shard file plus its archive, written in one transaction."""
+
+    def __init__(self, db, path: str, archive: str):
+        self.path = path
+        self.conn = db._open(path)
+        self.conn.execute("ATTACH DATABASE ? AS archive", (archive,))
+        self.pending: Dict[str, List[tuple]] = {}
+        self.sql: Dict[str, str] = {}
+        self.next_id: Dict[str, int] = {t: 1 for t in LEDGER_TABLES}
+        self.conn.execute("BEGIN IMMEDIATE")
+        # every per-user row comes from the sources, never from the new file
+        for table in USER_TABLES + LEDGER_TABLES:
+            self.conn.execute(f"DELETE FROM {table}")
+
+    def add(self, key: str, sql: str, row: tuple):
+        self.sql[key] = sql
+        rows = self.pending.setdefault(key, [])
+        rows.append(row)
+        if len(rows) >= BATCH:
+            self.conn.executemany(sql, rows)
+            rows.clear()
+
+    def flush(self):
+        for key, rows in self.pending.items():
+            if rows:
+                self.conn.executemany(self.sql[key], rows)
+                rows.clear()
+
+    def commit(self):
+        self.flush()
+        self.conn.commit()
+        self.conn.execute("DETACH DATABASE archive")
+
+def _copy_users(sources: List[str], targets: List["_Target"], to: int, db) -> Dict[str, int]:
+    counts = dict.fromkeys(USER_TABLES, 0)
+    for path in sources:
+        src = _open_ro(path)
+        try:
+            for table in USER_TABLES:
+                if not _has_table(src, table):
+                    continue
+                cols = [c for c in _columns(targets[0].conn, "main", table) if c in _columns(src, "main", table)]
+                uid = cols.index("user_id")
+                sql = f"INSERT INTO {table}({', '.join(cols)}) VALUES({', '.join('?' * len(cols))})"
+                for row in src.execute(f"SELECT {', '.join(cols)} FROM {table}"):
+                    targets[db.shard_of(row[uid], to)].add(table, sql, tuple(row))
+                    counts[table] += 1
+        finally:
+            src.close()
+    return counts
+
+def _ordered(conn: sqlite3.Connection, schema: str, table: str, cols: List[str]) -> Iterator[tuple]:
+    yield from conn.execute(f"SELECT ts, {', '.join(cols)} FROM {schema}.{table} ORDER BY ts, id")
+
+def _copy_ledger(sources: List[str], archives: List[str], targets: List["_Target"], to: int, db) -> Dict[str, int]:
+    counts: Dict[str, int] = {}
+    conns = [_open_ro(p) for p in sources]
+    archived = []
+    try:
+        for conn, archive in zip(conns, archives):
+            if os.path.exists(archive):
+                conn.execute("ATTACH DATABASE ? AS archive", (f"file:{archive}?mode=ro",))
+                archived.append(conn)
+        for table in LEDGER_TABLES:
+            cols = [c for c in _columns(targets[0].conn, "main", table) if c != "id"]
+            uid = cols.index("user_id")
+            for t in targets:
+                db._archive_schema(t.conn, table)
+            for schema in ("archive", "main"):
+                streams = [_ordered(c, schema, table, cols) for c in (conns if schema == "main" else archived)
+                           if _columns(c, schema, table)]
+                sql = f"INSERT INTO {schema}.{table}(id, {', '.join(cols)}) VALUES({', '.join('?' * (len(cols) + 1))})"
+                key = f"{schema}.{table}"
+                counts[key] = 0
+                for row in heapq.merge(*streams, key=lambda r: r[0]):
+                    t = targets[db.shard_of(row[1 + uid], to)]
+                    t.add(key, sql, (t.next_id[table],) + tuple(row[1:]))
+                    t.next_id[table] += 1
+                    counts[key] += 1
+    finally:
+        for c in conns:
+            c.close()
+    return counts
+
+def _count(files: List[str], table: str) -> int:
+    n = 0
+    for path in files:
+        if not os.path.exists(path):
+            continue
+        conn = _open_ro(path)
+        try:
+            if _has_table(conn, table):
+                n += conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        finally:
+            conn.close()
+    return n
+
+def _totals(files: List[str], archives: List[str]) -> Dict[str, int]:
+    totals = {t: _count(files, t) for t in USER_TABLES + LEDGER_TABLES}
+    totals.update({f"archive.{t}": _count(archives, t) for t in LEDGER_TABLES})
+    return totals
+
+def reshard(src: str, n_from: int, out: str, n_to: int, archive_src: str) -> Dict[str, Any]:
+    stem = os.path.splitext(out)[0]
+    existing = glob.glob(out) + glob.glob(glob.escape(stem) + "-shard*") + glob.glob(glob.escape(stem) + "-archive*")
+    if existing:
+        raise SystemExit(f"refusing to overwrite {', '.join(sorted(existing))}")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    # database.py reads its layout at import (without touching any file)
+    os.environ["DB_PATH"] = out
+    os.environ["DB_SHARDS"] = str(n_to)
+    os.environ.pop("LEDGER_ARCHIVE_PATH", None)
+    import database as db
+
+    sources = db.shard_paths(n_from, src)
+    src_archives = db.shard_paths(n_from, archive_src)
+    out_paths = db.shard_paths(n_to, out)
+    out_archives = db.archive_paths()
+    # older layouts keep some per-user rows elsewhere; let the bot migrate first
+    for path in dict.fromkeys([src] + sources):
+        version = _schema_version(path)
+        if version != db.SCHEMA_VERSION:
+            raise SystemExit(f"{path} is at schema version {version}, expected {db.SCHEMA_VERSION}; "
+                             "start the bot once on the old layout to migrate it")
+    # the shared tables come along with a copy of the main file; its per-user
+    # rows are re-inserted from the sources, so drop them before init_db()
+    # creates the new files
+    with sqlite3.connect(src) as s, sqlite3.connect(out) as d:
+        s.backup(d)
+    with sqlite3.connect(out) as d:
+        for table in USER_TABLES + LEDGER_TABLES:
+            d.execute(f"DELETE FROM {table}")
+    d.close()
+    db.init_db()
+
+    targets = [_Target(db, p, a) for p, a in zip(out_paths, out_archives)]
+    try:
+        copied = _copy_users(sources, targets, n_to, db)
+        copied.update(_copy_ledger(sources, src_archives, targets, n_to, db))
+        for t in targets:
+            t.commit()
+    finally:
+        for t in targets:
+            t.conn.close()
+    for path in db._all_paths():
+        with db._using(path), db.transaction() as conn:
+            db._recompute_stats(conn.cursor())
+    db.close_connections()
+
+    before, after = _totals(sources, src_archives), _totals(out_paths, out_archives)
+    return {"from": n_from, "to": n_to, "files": out_paths, "archives": out_archives, "copied": copied,
+            "rows_before": before, "rows_after": after, "ok": before == after}
+
+def main():
+    ap = argparse.ArgumentParser(description="copy a SHI database into a different number of user shards")
+    ap.add_argument("--from", dest="n_from", type=int, required=True, help="current DB_SHARDS (0 = unsharded)")
+    ap.add_argument("--to", dest="n_to", type=int, required=True, help="new DB_SHARDS (0 = unsharded)")
+    ap.add_argument("--src", default=os.getenv("DB_PATH", "shi.db"), help="current DB_PATH")
+    ap.add_argument("--archive", default=None, help="current LEDGER_ARCHIVE_PATH (default <src stem>-archive.db)")
+    ap.add_argument("--out", required=True, help="new DB_PATH; shards are written next to it")
+    args = ap.parse_args()
+
+    archive = args.archive or os.path.splitext(args.src)[0] + "-archive.db"
+    report = reshard(args.src, args.n_from, args.out, args.n_to, archive)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report["ok"] else 1)
+
+if __name__ == "__main__":
+    main()
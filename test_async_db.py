@@ -0,0 +1,41 @@
+# test_async_db.py
+# async_db.transact() against a sharded layout; database.py reads DB_SHARDS
+# at import, so the check runs in a fresh interpreter.
+import os
+import sys
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+TRANSACT = """
+import asyncio, database as db, async_db
+
+def win(uid):
+    db.add_coins(uid, 5)
+    db.record_battle(uid, "NPC", True, 0.0, 5)
+
+def fail(uid):
+    db.add_coins(uid, 5)
+    raise ValueError("boom")
+
+async def main():
+    for uid in range(1, 9):
+        db.register_user(uid, "u")
+        await async_db.transact(uid, win, uid)
+        try:
+            await async_db.transact(uid, fail, uid)
+        except ValueError:
+            pass
+        assert db.get_user(uid)["coins"] == 5, uid
+    battles = sum(c.execute("SELECT COUNT(*) FROM battles").fetchone()[0] for c in db._shards())
+    assert battles == 8, battles
+    async_db.shutdown()
+
+asyncio.run(main())
+"""
+
+def test_transact_routes_to_the_users_shard(tmp_path):
+    env = dict(os.environ, PYTHONPATH=HERE, DB_PATH=str(tmp_path / "shi.db"), DB_SHARDS="3")
+    env.pop("LEDGER_ARCHIVE_PATH", None)
+    done = subprocess.run([sys.executable, "-c", TRANSACT], cwd=tmp_path, env=env, capture_output=True, text=True)
+    assert done.returncode == 0, done.stderr
@@ -0,0 +1,29 @@
+# test_bot.py
+import types
+import asyncio
+
+import bot
+
+def test_per_user_processor_keeps_order_within_the_limit(monkeypatch):
+    monkeypatch.setattr(bot, "update_key", lambda update: update.uid)
+    done = []
+    order, running = [], {"now": 0, "peak": 0}
+
+    async def handle(uid, i):
+        running["now"] += 1
+        running["peak"] = max(running["peak"], running["now"])
+        await asyncio.sleep(0.005)
+        order.append((uid, i))
+        running["now"] -= 1
+
+    async def main():
+        proc = bot.PerUserUpdateProcessor(2, on_done=lambda: done.append(1))
+        await asyncio.gather(*(proc.process_update(types.SimpleNamespace(uid=uid), handle(uid, i))
+                               for i in range(5) for uid in (1, 2, 3)))
+        return proc
+
+    proc = asyncio.run(main())
+    for uid in (1, 2, 3):
+        assert [i for u, i in order if u == uid] == list(range(5))
+    assert running["peak"] == 2
+    assert len(done) == 15 and not proc._waiting
@@ -0,0 +1,158 @@
+# test_database.py
+# In-process checks for database.py against the throwaway file set up in
+# conftest.py.
+import bisect
+import random
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import database as db
+
+def test_cached_user_matches_uncached(uid):
+    db.register_user(uid, "cache")
+    db.update_shi(uid, 5)
+    db.add_coins(uid, 3)
+    cached = db.get_user(uid)
+    db._users.clear()
+    fresh = db.get_user(uid)
+    assert cached == fresh
+    assert {k: type(v) for k, v in cached.items()} == {k: type(v) for k, v in fresh.items()}
+    assert repr(cached["shi_balance"]) == "5.0"
+
+def test_sorted_keys_match_a_sorted_list():
+    rng = random.Random(7)
+    keys = db._SortedKeys(load=4)
+    plain = []
+    for _ in range(3000):
+        k = (-float(rng.randint(0, 40)), rng.randint(1, 300))
+        if k in plain and rng.random() < 0.6:
+            assert keys.remove(k)
+            plain.remove(k)
+        elif k not in plain:
+            keys.add(k)
+            bisect.insort(plain, k)
+        probe = (-float(rng.randint(0, 40)),)
+        assert keys.bisect_left(probe) == bisect.bisect_left(plain, probe)
+    assert len(keys) == len(plain)
+    assert keys.head(len(plain) + 5) == plain
+    assert not keys.remove((1.0, -1))
+
+def test_board_ignores_a_late_older_hook(uid):
+    db.register_user(uid, "late")
+    db.get_leaderboard(1)
+    db._board.update(uid, 50.0, seq=10**12 + 2)
+    db._board.update(uid, 7.0, seq=10**12 + 1)
+    assert db._board._balance[uid] == 50.0
+
+def test_board_catches_up_on_other_writers(uid):
+    db.register_user(uid, "other")
+    db.get_leaderboard(1)
+    # another process's write: not published to this process's board
+    with sqlite3.connect(db.DB_PATH) as conn:
+        conn.execute("UPDATE users SET shi_balance = 1e9 WHERE user_id=?", (uid,))
+    assert db.get_leaderboard(1)[0]["user_id"] != uid
+    db._board._build_lock.acquire()
+    db._board._catch_up()
+    assert db.get_leaderboard(1)[0] == {"user_id": uid, "username": "other", "shi_balance": 1e9}
+    assert db.get_rank(uid) == 1
+
+def _battles(uid):
+    return db._connect().execute("SELECT COUNT(*) FROM battles WHERE user_id=?", (uid,)).fetchone()[0]
+
+def test_battle_outcome_rolls_back_as_one(uid, monkeypatch):
+    db.register_user(uid, "atomic")
+    monkeypatch.setattr(db, "_BATTLE_SQL", "INSERT INTO no_such_table VALUES(?,?,?,?,?,?)")
+    with pytest.raises(sqlite3.OperationalError):
+        db.battle_outcome(uid, "NPC", True, 250)
+    monkeypatch.undo()
+    db._users.clear()
+    user = db.get_user(uid)
+    assert (user["coins"], user["shi_balance"], _battles(uid)) == (0, 0.0, 0)
+
+def test_battle_outcome_concurrent_battles_all_count(uid):
+    db.register_user(uid, "busy")
+    def fight(_):
+        return db.battle_outcome(uid, "NPC", True, 30)
+    with ThreadPoolExecutor(8) as pool:
+        gained = sum(pool.map(fight, range(40)))
+    db._users.clear()
+    user = db.get_user(uid)
+    # 40 * 30 coins: 12 full chunks of 100 became 0.12 SHI
+    assert user["coins"] == 0
+    assert user["shi_balance"] == pytest.approx(0.12) == pytest.approx(gained)
+    assert _battles(uid) == 40
+
+@pytest.fixture
+def group_ledger(monkeypatch):
+    monkeypatch.setattr(db, "LEDGER_MODE", "group")
+    yield
+    db.stop_ledger()
+
+def _ledger_rows(uid):
+    return db._connect().execute("SELECT COUNT(*) FROM transactions WHERE user_id=?", (uid,)).fetchone()[0]
+
+def test_group_ledger_keeps_every_row_under_concurrency(group_ledger):
+    uids = range(2_000_000, 2_000_008)
+    for u in uids:
+        db.register_user(u, "grp")
+    def work(u):
+        for _ in range(25):
+            db.update_shi(u, 1)
+            db.record_battle(u, "NPC", True, 0.0, 1)
+    with ThreadPoolExecutor(len(uids)) as pool:
+        list(pool.map(work, uids))
+    db.flush_ledger()
+    db._users.clear()
+    for u in uids:
+        assert db.get_user(u)["shi_balance"] == 25.0
+        assert _ledger_rows(u) == 25 and _battles(u) == 25
+
+def test_group_ledger_queues_nothing_for_a_rolled_back_change(uid, group_ledger):
+    db.register_user(uid, "rollback")
+    with pytest.raises(RuntimeError), db.transaction():
+        db.update_shi(uid, 5)
+        db.record_battle(uid, "NPC", True, 0.0, 1)
+        raise RuntimeError("abort")
+    db.flush_ledger()
+    assert _ledger_rows(uid) == 0 and _battles(uid) == 0
+
+def test_group_ledger_battle_skips_the_write_transaction(uid, group_ledger):
+    db.register_user(uid, "queued")
+    conn = db._connect()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        db.record_battle(uid, "NPC", False, 0.0, 0)
+    finally:
+        conn.set_trace_callback(None)
+    assert not [s for s in statements if s.startswith("BEGIN")]
+    db.flush_ledger()
+    assert _battles(uid) == 1
+
+def test_claim_daily_pays_once_under_concurrency(uid):
+    now = 1_700_000_000
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: db.claim_daily(uid, now=now), range(16)))
+    paid = [r for r in results if r is not None]
+    assert len(paid) == 1
+    shi, coins = paid[0]
+    db._users.clear()
+    user = db.get_user(uid)
+    assert (user["shi_balance"], user["coins"], user["last_daily"]) == (shi, coins, now)
+    assert _ledger_rows(uid) == 2
+    # the cooldown holds until 24h have passed
+    assert db.claim_daily(uid, now=now + db.DAILY_COOLDOWN - 1) is None
+    assert db.claim_daily(uid, now=now + db.DAILY_COOLDOWN) is not None
+
+def test_claim_daily_rolls_back_as_one(uid, monkeypatch):
+    db.register_user(uid, "daily")
+    monkeypatch.setattr(db, "_TX_SQL", "INSERT INTO no_such_table VALUES(?,?,?,?,?,?)")
+    with pytest.raises(sqlite3.OperationalError):
+        db.claim_daily(uid, now=1_700_000_000)
+    monkeypatch.undo()
+    db._users.clear()
+    user = db.get_user(uid)
+    assert (user["shi_balance"], user["coins"], user["last_daily"]) == (0.0, 0, 0)
+    assert db.claim_daily(uid, now=1_700_000_000) is not None
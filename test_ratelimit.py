@@ -0,0 +1,107 @@
+# test_ratelimit.py
+# FloodControl and PacedRateLimiter driven by a fake clock; the limiter's
+# callback is a stub that records when each Bot API call would go out.
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+import ratelimit
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float):
+        self.now += seconds
+
+def _limiter(clock, **kwargs):
+    kwargs.setdefault("global_rate", 1000)
+    return ratelimit.PacedRateLimiter(clock=clock, sleep=clock.sleep, **kwargs)
+
+def _send(limiter, clock, chat_id, n, callback=None):
+    sent = []
+    async def stub():
+        sent.append(clock.now)
+        return True
+    async def main():
+        for _ in range(n):
+            await limiter.process_request(callback or stub, (), {}, "sendMessage", {"chat_id": chat_id}, None)
+    asyncio.run(main())
+    return sent
+
+def test_chat_pacing_bursts_then_one_per_second():
+    clock = FakeClock()
+    limiter = _limiter(clock, chat_rate=1, chat_burst=3)
+    assert _send(limiter, clock, 42, 6) == pytest.approx([0, 0, 0, 1, 2, 3])
+    # another chat has its own budget; the global one is far from empty
+    assert _send(limiter, clock, 43, 3) == pytest.approx([3, 3, 3])
+
+def test_group_chats_use_the_group_rate():
+    clock = FakeClock()
+    limiter = _limiter(clock, chat_burst=1, group_rate=0.5)
+    assert _send(limiter, clock, -100, 3) == pytest.approx([0, 2, 4])
+
+def test_global_rate_paces_calls_without_a_chat():
+    clock = FakeClock()
+    limiter = _limiter(clock, global_rate=2)
+    assert _send(limiter, clock, None, 4) == pytest.approx([0, 0, 0.5, 1.0])
+
+def test_retry_after_pauses_then_retries():
+    clock = FakeClock()
+    limiter = _limiter(clock, chat_burst=10)
+    calls = []
+    async def flaky():
+        calls.append(clock.now)
+        if len(calls) == 1:
+            raise RetryAfter(2)
+        return "ok"
+    async def main():
+        return await limiter.process_request(flaky, (), {}, "sendMessage", {"chat_id": 1}, None)
+    assert asyncio.run(main()) == "ok"
+    # the requested 2s plus the first 0.5s backoff step
+    assert calls == pytest.approx([0, 2.5])
+    assert limiter.retries == 1
+
+def test_retry_after_gives_up_after_max_retries():
+    clock = FakeClock()
+    limiter = _limiter(clock, chat_burst=10, max_retries=2)
+    calls = []
+    async def always():
+        calls.append(clock.now)
+        raise RetryAfter(1)
+    with pytest.raises(RetryAfter):
+        _send(limiter, clock, 1, 1, callback=always)
+    assert calls == pytest.approx([0, 1.5, 3.5])
+
+def test_flood_per_user_bucket():
+    clock = FakeClock()
+    flood = ratelimit.FloodControl(user_rate=2, user_burst=3, global_rate=1000, global_burst=1000, clock=clock)
+    assert [flood.allow(1) for _ in range(4)] == [True, True, True, False]
+    assert flood.allow(2)  # other users are unaffected
+    clock.now = 1.0
+    assert [flood.allow(1) for _ in range(3)] == [True, True, False]
+    assert flood.dropped == {"duplicate": 0, "user": 2, "global": 0}
+
+def test_flood_global_bucket():
+    clock = FakeClock()
+    flood = ratelimit.FloodControl(user_rate=10, user_burst=10, global_rate=1, global_burst=2, clock=clock)
+    assert [flood.allow(uid) for uid in (1, 2, 3)] == [True, True, False]
+    clock.now = 1.0
+    assert flood.allow(4)
+    assert flood.dropped["global"] == 1
+
+def test_flood_drops_duplicate_callbacks():
+    clock = FakeClock()
+    flood = ratelimit.FloodControl(user_rate=100, user_burst=100, dedupe_window=1.0, clock=clock)
+    assert flood.allow(1, (10, "battle"))
+    clock.now = 0.5
+    assert not flood.allow(1, (10, "battle"))
+    assert flood.allow(1, (10, "shop"))   # another button
+    assert flood.allow(2, (10, "battle"))  # another user
+    clock.now = 2.0
+    assert flood.allow(1, (10, "battle"))
+    assert flood.dropped["duplicate"] == 1
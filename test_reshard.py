@@ -0,0 +1,111 @@
+# test_reshard.py
+# End-to-end checks for reshard.py and the guild membership move in schema
+# version 8. database.py reads its layout at import, so every step runs in a
+# fresh interpreter with its own DB_PATH / DB_SHARDS.
+import os
+import sys
+import json
+import sqlite3
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SEED = """
+import database as db
+for u in range(1, 61):
+    db.register_user(u, f"u{u}")
+    db.update_shi(u, u)
+a = db.create_guild("alpha", 1)
+b = db.create_guild("beta", 2)
+for u in range(3, 40):
+    db.join_guild(a if u % 2 else b, u)
+db.join_guild(b, 3)
+db.leave_guild(a, 5)
+db.add_referral(1, 50)
+"""
+
+SNAPSHOT = """
+import json, database as db
+print(json.dumps({
+    "board": db.get_guild_leaderboard(10),
+    "members": {u: db.get_user_guilds(u) for u in range(1, 61)},
+    "stats": {k: v for k, v in db.get_stats().items() if k != "tx_by_type"},
+}))
+"""
+
+def _py(code: str, cwd, **env) -> str:
+    full = dict(os.environ, PYTHONPATH=HERE, **{k: str(v) for k, v in env.items()})
+    full.pop("LEDGER_ARCHIVE_PATH", None)
+    done = subprocess.run([sys.executable, "-c", code], cwd=cwd, env=full, capture_output=True, text=True)
+    assert done.returncode == 0, done.stderr
+    return done.stdout
+
+def _reshard(cwd, src, n_from, out, n_to) -> dict:
+    full = dict(os.environ, PYTHONPATH=HERE)
+    done = subprocess.run([sys.executable, os.path.join(HERE, "reshard.py"), "--from", str(n_from), "--to", str(n_to),
+                           "--src", str(src), "--out", str(out)], cwd=cwd, env=full, capture_output=True, text=True)
+    assert done.returncode == 0, done.stderr
+    return json.loads(done.stdout)
+
+def _snapshot(cwd, path, shards) -> dict:
+    snap = json.loads(_py(SNAPSHOT, cwd, DB_PATH=path, DB_SHARDS=shards))
+    snap["stats"]["total_shi"] = round(snap["stats"]["total_shi"], 6)
+    for g in snap["board"]:
+        g["total_shi"] = round(g["total_shi"], 6)
+    return snap
+
+def test_reshard_round_trip_keeps_guild_members(tmp_path):
+    src = tmp_path / "shi.db"
+    _py(SEED, tmp_path, DB_PATH=src, DB_SHARDS=0)
+    before = _snapshot(tmp_path, src, 0)
+    assert sorted(before["members"]["3"]) == [1, 2]
+    assert before["members"]["5"] == []
+
+    two = tmp_path / "two" / "shi.db"
+    report = _reshard(tmp_path, src, 0, two, 2)
+    assert report["ok"], report
+    assert report["rows_after"]["guild_members"] == report["rows_before"]["guild_members"] == 39
+    # memberships live only with their users, never in the main file
+    with sqlite3.connect(two) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM guild_members").fetchone()[0] == 0
+    assert _snapshot(tmp_path, two, 2) == before
+
+    back = tmp_path / "back" / "shi.db"
+    report = _reshard(tmp_path, two, 2, back, 0)
+    assert report["ok"], report
+    assert _snapshot(tmp_path, back, 0) == before
+
+def test_v8_moves_legacy_memberships_once(tmp_path):
+    main = tmp_path / "shi.db"
+    _py(SEED, tmp_path, DB_PATH=main, DB_SHARDS=2)
+    before = _snapshot(tmp_path, main, 2)
+    # rebuild the pre-8 layout: memberships in DB_PATH, shards at version 7
+    shards = [tmp_path / f"shi-shard{i}.db" for i in range(2)]
+    with sqlite3.connect(main) as m:
+        for path in shards:
+            with sqlite3.connect(path) as s:
+                rows = s.execute("SELECT guild_id, user_id, joined_ts FROM guild_members").fetchall()
+                s.execute("DELETE FROM guild_members")
+                s.execute("PRAGMA user_version=7")
+            m.executemany("INSERT INTO guild_members(guild_id, user_id, joined_ts) VALUES(?,?,?)", rows)
+    _py("import database; database.init_db()", tmp_path, DB_PATH=main, DB_SHARDS=2)
+    with sqlite3.connect(main) as m:
+        assert m.execute("SELECT COUNT(*) FROM guild_members").fetchone()[0] == 0
+    assert _snapshot(tmp_path, main, 2) == before
+    # a shard added later starts empty instead of copying anything
+    report = _reshard(tmp_path, main, 2, tmp_path / "three" / "shi.db", 3)
+    assert report["ok"] and report["rows_after"]["guild_members"] == 39
+
+RECENT = """
+import json, database as db
+print(json.dumps([[r["ts"], r["id"], r["user_id"]] for r in db.get_transactions(25)]))
+"""
+
+def test_sharded_transactions_newest_first(tmp_path):
+    db = tmp_path / "shi.db"
+    _py("import database as db\nfor u in range(1, 41):\n    db.register_user(u, 'u')\n    db.update_shi(u, 1)\n",
+        tmp_path, DB_PATH=db, DB_SHARDS=3)
+    rows = json.loads(_py(RECENT, tmp_path, DB_PATH=db, DB_SHARDS=3))
+    assert len(rows) == 25
+    assert rows == sorted(rows, key=lambda r: (r[0], r[1]), reverse=True)
+    assert json.loads(_py(RECENT, tmp_path, DB_PATH=db, DB_SHARDS=3)) == rows
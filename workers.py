@@ -0,0 +1,362 @@
+# workers.py
+# Multi-process mode (WORKERS=N in config.env): one ingress process receives
+# updates (polling or webhook, per BOT_MODE) and hashes each update's user onto
+# one of N worker processes, each running the full Application from bot.py on
+# its own core. A user always lands on the same worker, and the worker's
+# PerUserUpdateProcessor runs that user's updates in arrival order, so each
+# user's updates are handled in order while different users run in parallel.
+#
+# Workers share state through the SQLite files (WAL handles concurrent
+# processes). Per-process caches stay correct because a user's own writes
+# happen on their worker; for writes made elsewhere (referral rewards,
+# airdrops, admin edits) workers default to a short USER_CACHE_TTL and
+# LEADERBOARD_RESYNC. Settings and the catalog are versioned and need
+# nothing. With DB_SHARDS equal to WORKERS, each worker mostly writes to its
+# own shard file (both use the same user hash).
+#
+# The supervisor watches worker heartbeats, restarts a worker that exits or
+# stops responding (keeping its queued updates), and on SIGINT/SIGTERM stops
+# ingress, lets every worker finish its queue, then exits.
+import os
+import time
+import queue
+import signal
+import asyncio
+import logging
+import threading
+import collections
+import multiprocessing as mp
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger("SHI-WORKERS")
+
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "32"))  # concurrent_updates per worker
+WORKER_QUEUE_MAX = int(os.getenv("WORKER_QUEUE_MAX", "10000"))
+WORKER_HEARTBEAT = float(os.getenv("WORKER_HEARTBEAT", "1"))
+WORKER_HEALTH_TIMEOUT = float(os.getenv("WORKER_HEALTH_TIMEOUT", "20"))
+WORKER_DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", "30"))
+WORKER_RESTART_BACKOFF = float(os.getenv("WORKER_RESTART_BACKOFF", "30"))  # max seconds between restarts
+
+_ctx = mp.get_context("spawn")
+
+# ----------------- worker process -----------------
+def _worker_main(index: int, inbox, heartbeat, taken, processed):
+    # the supervisor coordinates shutdown; a terminal Ctrl+C reaches the whole
+    # process group and must not cut a worker's drain short
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_serve(index, inbox, heartbeat, taken, processed))
+
+async def _serve(index: int, inbox, heartbeat, taken, processed):
+    import bot
+    from telegram import Update
+
+    loop = asyncio.get_running_loop()
+    # taken per update admitted, given back when it finishes: the worker pulls
+    # from its inbox only as fast as it handles updates, so backlog (and
+    # backpressure) stays in the supervisor's bounded queue
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY * 2)
+
+    def done():
+        slots.release()
+        with processed.get_lock():
+            processed.value += 1
+
+    app = bot.build_application(concurrent_updates=bot.PerUserUpdateProcessor(WORKER_CONCURRENCY, on_done=done))
+    await app.initialize()
+    await bot.on_startup(app)
+    await app.start()
+    stopping = asyncio.Event()
+
+    async def admit(data):
+        await slots.acquire()
+        await app.update_queue.put(Update.de_json(data, app.bot))
+
+    def reader():
+        while True:
+            data = inbox.get()
+            if data is None:
+                loop.call_soon_threadsafe(stopping.set)
+                return
+            # from here on the update is this process's: if it dies, the
+            # supervisor re-sends only what was not taken yet
+            taken.value += 1
+            asyncio.run_coroutine_threadsafe(admit(data), loop).result()
+
+    async def beat():
+        while True:
+            heartbeat.value = time.time()
+            await asyncio.sleep(WORKER_HEARTBEAT)
+
+    threading.Thread(target=reader, name=f"worker-{index}-inbox", daemon=True).start()
+    beating = asyncio.create_task(beat())
+    logger.info("worker %d ready (pid %d)", index, os.getpid())
+    await stopping.wait()
+    # stop() handles everything already admitted before returning
+    await app.stop()
+    await app.shutdown()
+    await bot.on_shutdown(app)
+    beating.cancel()
+    logger.info("worker %d drained (%d updates)", index, processed.value)
+
+# ----------------- supervisor / ingress -----------------
+def worker_env(index: int, n: int) -> Dict[str, str]:
+    """Environment overrides for worker index of n."""
+    import config
+    import metrics
+    import ratelimit
+    env = {
+        "WORKER_INDEX": str(index),
+        # only one process runs the background archival loop
+        "ARCHIVE_INTERVAL": str(config.get().archive_interval) if index == 0 else "0",
+        # global budgets are split across workers; per-user ones are not,
+        # since each user is pinned to one worker
+        "FLOOD_GLOBAL_RATE": str(ratelimit.FLOOD_GLOBAL_RATE / n),
+        "FLOOD_GLOBAL_BURST": str(max(1.0, ratelimit.FLOOD_GLOBAL_BURST / n)),
+        "OUT_GLOBAL_RATE": str(ratelimit.OUT_GLOBAL_RATE / n),
+        # a restarted worker keeps its users' dialogs
+        "STATE_BACKEND": os.getenv("STATE_BACKEND", "sqlite"),
+        # pick up writes made by other workers
+        "USER_CACHE_TTL": os.getenv("USER_CACHE_TTL", "30"),
+        "LEADERBOARD_RESYNC": os.getenv("LEADERBOARD_RESYNC", "30"),
+    }
+    if metrics.METRICS_PORT:
+        env["METRICS_PORT"] = str(metrics.METRICS_PORT + 1 + index)
+    return env
+
+class _Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.proc: Optional[mp.Process] = None
+        self.inbox = _ctx.Queue(WORKER_QUEUE_MAX)
+        self.heartbeat = _ctx.Value("d", 0.0, lock=False)
+        self.taken = _ctx.Value("Q", 0, lock=False)  # written by the worker's inbox thread only
+        self.processed = _ctx.Value("Q", 0)
+        # updates put on inbox that the worker has not taken yet (oldest first);
+        # a mp.Queue cannot be read back once its reader dies holding the lock
+        self.unsent = collections.deque()
+        self.trimmed = 0
+        self.started = 0.0
+        self.restarts = 0
+        self.failures = 0  # consecutive quick failures, for backoff
+        self.dispatched = 0
+        self.next_start = 0.0
+
+    def trim(self):
+        while self.trimmed < self.taken.value and self.unsent:
+            self.unsent.popleft()
+            self.trimmed += 1
+
+    def healthy(self, now: float) -> bool:
+        if self.proc is None or not self.proc.is_alive():
+            return False
+        # allow for startup (imports, migrations, cache warm-up) before the first beat
+        last = max(self.heartbeat.value, self.started)
+        return now - last < WORKER_HEALTH_TIMEOUT
+
+class Supervisor:
+    """Owns the worker processes and routes updates to them."""
+
+    def __init__(self, n: int):
+        import bot
+        import database
+        self.n = n
+        self.update_key = bot.update_key
+        self.shard_of = database.shard_of
+        self.workers = [_Worker(i) for i in range(n)]
+        self.stopping = False
+
+    def route(self, update) -> int:
+        """Worker index for an update; updates without a user go to worker 0."""
+        key = self.update_key(update)
+        return self.shard_of(key, self.n) if key is not None else 0
+
+    def _spawn(self, w: _Worker):
+        env = worker_env(w.index, self.n)
+        saved = {k: os.environ.get(k) for k in env}
+        # spawned children inherit os.environ as it is at start(), before any
+        # module (config.env, database.py) reads its settings
+        os.environ.update(env)
+        try:
+            w.proc = _ctx.Process(target=_worker_main, args=(w.index, w.inbox, w.heartbeat, w.taken, w.processed),
+                                  name=f"shi-worker-{w.index}", daemon=False)
+            w.started = time.time()
+            w.proc.start()
+        finally:
+            for k, v in saved.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+
+    def start(self):
+        for w in self.workers:
+            self._spawn(w)
+
+    def _stop(self, w: _Worker):
+        """Make sure a dead or hung worker's process is gone; blocks for up to
+        5s while a hung one gets SIGTERM before SIGKILL."""
+        if w.proc.is_alive():
+            w.proc.terminate()
+            w.proc.join(5)
+            if w.proc.is_alive():
+                w.proc.kill()
+                w.proc.join()
+
+    def _requeue(self, w: _Worker):
+        """Give a stopped worker a fresh inbox holding, in order, the updates
+        it had not taken yet. Updates it had already taken are lost."""
+        w.trim()
+        pending = list(w.unsent)
+        w.inbox.cancel_join_thread()
+        w.inbox.close()
+        w.inbox = _ctx.Queue(max(WORKER_QUEUE_MAX, len(pending)))
+        w.taken.value = w.trimmed = 0
+        for item in pending:
+            w.inbox.put(item)
+        logger.warning("worker %d down (exit code %s); %d queued updates kept", w.index, w.proc.exitcode, len(pending))
+        w.proc = None
+
+    def _reap(self, w: _Worker):
+        self._stop(w)
+        self._requeue(w)
+
+    async def check(self, now: Optional[float]=None):
+        """Restart workers that exited or stopped sending heartbeats. A worker
+        that keeps failing soon after start waits longer each time, up to
+        WORKER_RESTART_BACKOFF seconds."""
+        now = time.time() if now is None else now
+        loop = asyncio.get_running_loop()
+        for w in self.workers:
+            if self.stopping:
+                return
+            if w.proc is not None:
+                if w.healthy(now):
+                    continue
+                quick = now - w.started < WORKER_RESTART_BACKOFF
+                # stopping a hung worker can take seconds: keep ingress running
+                # meanwhile. The inbox swap stays on the loop, next to dispatch().
+                await loop.run_in_executor(None, self._stop, w)
+                self._requeue(w)
+                w.failures = w.failures + 1 if quick else 0
+                w.next_start = now + (min(WORKER_RESTART_BACKOFF, 2 ** (w.failures - 1)) if w.failures else 0)
+            if now >= w.next_start:
+                w.restarts += 1
+                self._spawn(w)
+
+    async def dispatch(self, update):
+        w = self.workers[self.route(update)]
+        data = update.to_dict()
+        w.trim()
+        w.unsent.append(data)
+        try:
+            w.inbox.put_nowait(data)
+        except queue.Full:
+            # worker is behind: block this coroutine (not the loop) until there
+            # is room, which in turn slows ingress down
+            await asyncio.get_running_loop().run_in_executor(None, w.inbox.put, data)
+        w.dispatched += 1
+
+    def drain(self, timeout: float=WORKER_DRAIN_TIMEOUT):
+        """Ask every worker to finish its queue and exit; kill stragglers."""
+        self.stopping = True
+        for w in self.workers:
+            # a worker that is down still has to empty its queue
+            if w.proc is not None and not w.proc.is_alive():
+                self._reap(w)
+            if w.proc is None:
+                self._spawn(w)
+            w.inbox.put(None)
+        deadline = time.monotonic() + timeout
+        for w in self.workers:
+            if w.proc is None:
+                continue
+            w.proc.join(max(0.0, deadline - time.monotonic()))
+            if w.proc.is_alive():
+                logger.error("worker %d did not drain within %.0fs; terminating", w.index, timeout)
+                w.proc.terminate()
+                w.proc.join(5)
+        for w in self.workers:
+            w.inbox.close()
+            w.inbox.join_thread()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        return [{"worker": w.index, "pid": w.proc.pid if w.proc else None, "alive": w.healthy(now),
+                 "queued": _qsize(w.inbox), "dispatched": w.dispatched, "processed": w.processed.value,
+                 "restarts": w.restarts} for w in self.workers]
+
+def _qsize(q) -> int:
+    try:
+        return q.qsize()
+    except NotImplementedError:  # macOS
+        return 0
+
+def _register_metrics(sup: Supervisor):
+    import metrics
+    metrics.gauge("shi_worker_queue_depth", "Updates waiting for each worker",
+                  lambda: {str(w.index): _qsize(w.inbox) for w in sup.workers}, label="worker")
+    metrics.gauge("shi_worker_dispatched_total", "Updates routed to each worker",
+                  lambda: {str(w.index): w.dispatched for w in sup.workers}, label="worker", type_="counter")
+    metrics.gauge("shi_worker_restarts_total", "Worker restarts after a crash or missed heartbeats",
+                  lambda: {str(w.index): w.restarts for w in sup.workers}, label="worker", type_="counter")
+
+async def _ingress(sup: Supervisor):
+    import config
+    import metrics
+    from telegram import Bot
+    from telegram.ext import Updater
+
+    updates: asyncio.Queue = asyncio.Queue()
+    cfg = config.get()
+    tg = Bot(cfg.bot_token, base_url=cfg.bot_api_base_url) if cfg.bot_api_base_url else Bot(cfg.bot_token)
+    updater = Updater(tg, updates)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async def monitor():
+        while not stop.is_set():
+            await sup.check()
+            await asyncio.sleep(WORKER_HEARTBEAT)
+
+    async def pump():
+        while True:
+            update = await updates.get()
+            if update is None:
+                return
+            await sup.dispatch(update)
+
+    _register_metrics(sup)
+    metrics.start_server()
+    sup.start()
+    await updater.initialize()
+    if cfg.bot_mode == "webhook":
+        await updater.start_webhook(listen=cfg.webhook_listen, port=cfg.webhook_port, url_path=cfg.webhook_path,
+                                    webhook_url=cfg.webhook_url or None, secret_token=cfg.webhook_secret or None,
+                                    # setWebhook accepts 1..100
+                                    max_connections=min(100, max(40, WORKER_CONCURRENCY * sup.n)))
+    else:
+        await updater.start_polling()
+    logger.info("ingress up: %d workers, %s mode", sup.n, cfg.bot_mode)
+    tasks = [asyncio.create_task(monitor()), asyncio.create_task(pump())]
+    await stop.wait()
+
+    logger.info("stopping: no new updates, draining workers")
+    await updater.stop()
+    await updater.shutdown()
+    tasks[0].cancel()
+    # hand over whatever ingress already received, in order
+    await updates.put(None)
+    await tasks[1]
+    await loop.run_in_executor(None, sup.drain)
+    metrics.stop_server()
+    logger.info("stopped: %s", sup.stats())
+
+def run(n: int):
+    """Run the ingress + N worker processes until SIGINT/SIGTERM."""
+    import database
+    # migrate once here rather than have N workers race for the write lock
+    database.init_db()
+    asyncio.run(_ingress(Supervisor(n)))